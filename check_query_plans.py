@@ -0,0 +1,270 @@
+"""Checks that the queries of the *_db_helpers modules are served by indexes.
+
+Runs EXPLAIN for every query, as built by the helpers, and fails if the plan has a sequential scan on
+portfolios, transactions or securities.
+The plans only mean something on a realistically sized database, use --seed to fill a local one first.
+Never run --seed against a shared database, it inserts synthetic users, securities and trades.
+tests/test_query_plans.py runs the same checks under pytest, and skips them when no seeded database is reachable.
+
+Usage: python check_query_plans.py [--seed] [--users N] [--holdings N] [--trades-per-holding N] [--securities N]
+"""
+import argparse
+import sys
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.orm import Query, Session
+from sqlalchemy.sql import ClauseElement
+
+from tracker.portfolio.helpers.portfolio_db_helpers import (
+    holdings_query, holdings_version_query, portfolio_by_id_query, returns_query
+)
+from tracker.portfolio.helpers.portfolio_replay_helpers import (
+    LATEST_SNAPSHOTS, LEDGER_AFTER_SNAPSHOTS, snapshots_from_query, user_portfolios_query
+)
+from tracker.securities.helpers.security_db_helpers import search_securities_query
+from tracker.securities.helpers.security_master_helpers import changed_securities_query
+from tracker.transactions.helpers.transaction_db_helpers import (
+    last_transactions_query, lock_portfolio_query, lock_portfolios_query, trade_history_query,
+    transactions_by_id_query
+)
+from tracker.transactions.helpers.transaction_import_helpers import (
+    CREATE_MISSING_PORTFOLIOS, CREATE_STAGING_TABLE, CREATE_TRY_TIMESTAMP, INSERT_TRANSACTIONS, INVALIDATE_SNAPSHOTS,
+    LOCK_PORTFOLIOS, REJECT_BACKDATED_ROWS
+)
+from utils.database_utils import get_db_session
+
+
+# Tables that must never be read with a sequential scan, partitions of transactions included.
+LARGE_TABLES: Tuple[str, ...] = ("portfolios", "transactions", "securities")
+
+# An ORM query, a core statement with its parameters bound, or raw DB-API sql with its parameters.
+Statement = Union[Query, ClauseElement, Tuple[str, Dict]]
+
+SEED_STATEMENTS: Tuple[str, ...] = (
+    """
+    INSERT INTO users (name, userid, password, is_active, created_on)
+    SELECT 'Plan Check ' || n, 'plan_check_' || n, 'plan_check', true, now()
+    FROM generate_series(1, :users) AS n
+    ON CONFLICT (userid) DO NOTHING
+    """,
+    """
+    INSERT INTO securities (name, ticker_symbol, current_price, is_active, created_on, updated_on)
+    SELECT 'Plan Check ' || n, 'PLANCHECK' || n, 100 + n, true, now(), now() - n * interval '1 minute'
+    FROM generate_series(1, :securities) AS n
+    ON CONFLICT (ticker_symbol) DO NOTHING
+    """,
+    """
+    INSERT INTO portfolios (security_id, user_id, average_buy_price, quantity, created_on, updated_on)
+    SELECT securities.id, users.id, 100, :trades_per_holding, now(), now()
+    FROM users
+    JOIN securities ON (securities.id + users.id) % 10 = 0
+    WHERE users.userid LIKE 'plan\\_check\\_%' AND securities.ticker_symbol LIKE 'PLANCHECK%'
+    AND substring(securities.ticker_symbol from 10)::integer <= :held_securities
+    ON CONFLICT ON CONSTRAINT _portfolio_uc DO NOTHING
+    """,
+    "SELECT create_transaction_partitions((current_date - interval '2 years')::date, 3)",
+    """
+    INSERT INTO transactions (
+        portfolio_id, transaction_type, transaction_amount, transaction_quantity, is_valid_trade, created_on, user_id
+    )
+    SELECT portfolios.id, 'BUY', 100, 1, true, now() - random() * interval '2 years', portfolios.user_id
+    FROM portfolios
+    JOIN users ON users.id = portfolios.user_id
+    CROSS JOIN generate_series(1, :trades_per_holding)
+    WHERE users.userid LIKE 'plan\\_check\\_%'
+    """,
+    "ANALYZE users",
+    "ANALYZE securities",
+    "ANALYZE portfolios",
+    "ANALYZE transactions",
+)
+
+
+def seed(session: Session, users: int, holdings: int, trades_per_holding: int, securities: int):
+    """Fills the database with synthetic users, each holding `holdings` securities with `trades_per_holding` trades.
+
+    At least `securities` securities are seeded, so that searching them is worth an index, the first
+    `holdings` * 10 of them are held. Their updated_on are a minute apart, as after months of price updates.
+    """
+    params = {
+        "users": users,
+        "securities": max(holdings * 10, securities),
+        "held_securities": holdings * 10,
+        "trades_per_holding": trades_per_holding
+    }
+    for statement in SEED_STATEMENTS:
+        session.execute(text(statement), params)
+    session.commit()
+
+
+def prepare_import_staging(session: Session):
+    """Creates the empty staging table and function of an import, dropped when the session rolls back."""
+    session.execute(text(CREATE_STAGING_TABLE))
+    session.execute(text(CREATE_TRY_TIMESTAMP))
+
+
+def helper_queries(
+    session: Session, user_id: int, portfolio_id: int, security_id: int, transaction_id: int, created_on: datetime
+) -> Dict[str, Statement]:
+    """The queries run by the db helpers, for a user, one of its portfolios, the held security and its latest trade.
+
+    The queries are built by the helpers themselves, deletes are checked by the query selecting their rows.
+    """
+    now = datetime.now()
+    return {
+        # transaction_db_helpers.get_trade_history
+        "trade history": trade_history_query(user_id=user_id, session=session).limit(101),
+        "trade history of a ticker": trade_history_query(
+            user_id=user_id, session=session, ticker_symbol="PLANCHECK1"
+        ).limit(101),
+        # transaction_db_helpers.get_last_transactions
+        "latest transactions of a portfolio": last_transactions_query(portfolio_id=portfolio_id, session=session),
+        # transaction_db_helpers.lock_portfolio
+        "portfolio of a security": lock_portfolio_query(security_id=security_id, user_id=user_id, session=session),
+        # transaction_db_helpers.execute_bulk_trades
+        "portfolios of a bulk trade": lock_portfolios_query(
+            user_id=user_id, security_ids={security_id}, session=session
+        ),
+        # transaction_db_helpers.delete_last_transaction
+        "portfolio to delete from": portfolio_by_id_query(
+            portfolio_id=portfolio_id, user_id=user_id, session=session, for_update=True
+        ),
+        "latest transactions to delete": last_transactions_query(portfolio_id=portfolio_id, session=session, count=5),
+        "snapshots of the deleted transactions": snapshots_from_query(
+            portfolio_ids=[portfolio_id], created_on=created_on, transaction_id=transaction_id, session=session
+        ),
+        "deleted transactions": transactions_by_id_query(
+            transaction_ids=[transaction_id], oldest_created_on=created_on, session=session
+        ),
+        # portfolio_db_helpers.get_portfolio_data
+        "holdings": holdings_query(user_id=user_id, session=session),
+        # portfolio_db_helpers.get_holdings_version
+        "holdings version": holdings_version_query(user_id=user_id, session=session),
+        # portfolio_db_helpers.calculate_portfolio_returns
+        "total returns": returns_query(user_id=user_id, session=session),
+        "returns of every holding": returns_query(user_id=user_id, session=session, breakdown=True),
+        # portfolio_db_helpers.get_portfolio_by_id
+        "portfolio by id": portfolio_by_id_query(portfolio_id=portfolio_id, user_id=user_id, session=session),
+        # portfolio_replay_helpers.rebuild_user_portfolios
+        "portfolios to replay": user_portfolios_query(user_id=user_id, session=session, for_update=True),
+        "latest snapshots": text(LATEST_SNAPSHOTS).bindparams(user_id=user_id),
+        "ledger after the snapshots": (LEDGER_AFTER_SNAPSHOTS, {"user_id": user_id}),
+        # transaction_import_helpers.import_trades, on an empty staging table
+        "import backdated rows": text(REJECT_BACKDATED_ROWS).bindparams(user_id=user_id),
+        "import missing portfolios": text(CREATE_MISSING_PORTFOLIOS).bindparams(user_id=user_id, now=now),
+        "import portfolios to lock": text(LOCK_PORTFOLIOS).bindparams(user_id=user_id),
+        "import snapshots to drop": text(INVALIDATE_SNAPSHOTS).bindparams(user_id=user_id),
+        "import transactions": text(INSERT_TRANSACTIONS).bindparams(user_id=user_id),
+        # security_master_helpers.SecurityMaster.fetch_changes, after the first refresh
+        "security master changes": changed_securities_query(session=session, since=now),
+        # security_db_helpers.search_securities
+        "security search": search_securities_query(query="PLANCHECK1234", session=session, fuzzy=False).limit(20),
+        "fuzzy security search": search_securities_query(query="TSC", session=session).limit(20),
+    }
+
+
+def seeded_queries(session: Session) -> Optional[Dict[str, Statement]]:
+    """The helper queries for the latest portfolio of the database, None if it has no portfolios.
+
+    Creates the staging table of an import in the session's transaction, roll it back once done.
+    """
+    sample = session.execute(
+        text("SELECT id, user_id, security_id FROM portfolios ORDER BY id DESC LIMIT 1")
+    ).first()
+    if not sample:
+        return None
+
+    latest = last_transactions_query(portfolio_id=sample.id, session=session).first()
+    prepare_import_staging(session)
+    return helper_queries(
+        session, user_id=sample.user_id, portfolio_id=sample.id, security_id=sample.security_id,
+        transaction_id=latest.id if latest else 0, created_on=latest.created_on if latest else datetime.now()
+    )
+
+
+def walk_plan(plan: Dict) -> Iterator[Dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from walk_plan(child)
+
+
+def explain(session: Session, statement: Statement) -> Dict:
+    """Returns the plan of the statement.
+
+    Args:
+        session (Session): The db session.
+        statement (Statement): A query, a statement with its parameters bound, or raw DB-API sql and parameters.
+
+    Returns:
+        Dict: The root node of the plan, as given by EXPLAIN (FORMAT JSON).
+    """
+    if isinstance(statement, tuple):
+        sql, params = statement
+    else:
+        compiled = (statement.statement if isinstance(statement, Query) else statement).compile(
+            dialect=session.bind.dialect
+        )
+        sql, params = str(compiled), compiled.params
+
+    # EXPLAIN without ANALYZE plans the statement without running it, writes included.
+    with session.connection().connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        return cursor.fetchone()[0][0]["Plan"]
+
+
+def sequential_scans(plan: Dict) -> List[str]:
+    """Returns the large tables that the plan reads with a sequential scan.
+
+    Args:
+        plan (Dict): The root node of a plan.
+
+    Returns:
+        List[str]: The tables read with a sequential scan.
+    """
+    return [
+        node["Relation Name"] for node in walk_plan(plan)
+        if "Seq Scan" in node["Node Type"] and node.get("Relation Name", "").startswith(LARGE_TABLES)
+    ]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Fails if a db helper query reads a large table sequentially.")
+    parser.add_argument("--seed", action="store_true", help="Fill the local database with synthetic data first.")
+    parser.add_argument("--users", type=int, default=5000, help="Users to seed.")
+    parser.add_argument("--holdings", type=int, default=20, help="Securities held by every seeded user.")
+    parser.add_argument("--trades-per-holding", type=int, default=10, help="Trades seeded for every holding.")
+    parser.add_argument("--securities", type=int, default=20000, help="Securities to seed at least.")
+    args = parser.parse_args()
+
+    session = get_db_session()
+    try:
+        if args.seed:
+            seed(
+                session, users=args.users, holdings=args.holdings, trades_per_holding=args.trades_per_holding,
+                securities=args.securities
+            )
+
+        queries = seeded_queries(session)
+        if not queries:
+            print("No portfolios found, run with --seed first.")
+            return 1
+
+        failures = 0
+        for name, query in queries.items():
+            tables = sequential_scans(explain(session, query))
+            if tables:
+                failures += 1
+                print(f"FAIL {name}: sequential scan on {', '.join(tables)}")
+            else:
+                print(f"OK   {name}")
+        session.rollback()
+    finally:
+        session.close()
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,9 @@ NOCACHE="$3"
 # Available SHARED SERVICES Are: ["postgresql", "redis"]
 APP_NAME="portfolio-tracker"
 SHARED_SERVICES=("postgresql", "redis")
+# Access tokens are signed with TOKEN_SECRET_KEY, a random one is generated when it is not exported.
+# Tokens issued before a restart stop verifying unless the same key is exported again.
+export TOKEN_SECRET_KEY="${TOKEN_SECRET_KEY:-$(head -c 32 /dev/urandom | base64 | tr -d '\n')}"
 echo "Repository Name: $APP_NAME"
 echo "List Of Shared Services: ${SHARED_SERVICES[@]}"
 echo ""
@@ -0,0 +1,43 @@
+"""Imports a broker contract note csv into a user's ledger.
+
+Usage: python import_trades.py <userid> <path to contract note csv>
+"""
+import argparse
+import sys
+
+from tracker.transactions.helpers.transaction_import_helpers import import_trades
+from tracker.users.helpers.user_db_helper import existing_user
+from utils.database_utils import get_db_session
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Imports a broker contract note csv into a user's ledger.")
+    parser.add_argument("userid", help="The userid of the user whose trades are imported.")
+    parser.add_argument("contract_note", help="Path to the contract note csv.")
+    args = parser.parse_args()
+
+    session = get_db_session()
+    try:
+        user = existing_user(user_id=args.userid, session=session)
+        if not user:
+            print("USER_NOT_FOUND")
+            return 1
+        user_id = user.id
+
+        with open(args.contract_note, "rb") as contract_note:
+            success, _, message, report = import_trades(contract_note=contract_note, user_id=user_id, session=session)
+    finally:
+        session.close()
+
+    print(message)
+    if not success:
+        return 1
+
+    print(f"Imported: {report['imported']}, Rejected: {report['rejected']}")
+    for rejection in report["rejections"]:
+        print(f"Row {rejection['row_number']} ({rejection['ticker_symbol']}): {rejection['reason']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,17 @@
 """The main fastapi server."""
 from fastapi import FastAPI
 
+from tracker.portfolio.helpers.returns_stream_helpers import close_returns_broadcaster, init_returns_broadcaster
+from tracker.portfolio.helpers.valuation_index_helpers import close_valuation_index, init_valuation_index
 from tracker.portfolio.portfolio_apis import portfolio_v1_apis
+from tracker.securities.helpers.price_tick_helpers import close_price_coalescer, init_price_coalescer
+from tracker.securities.helpers.security_master_helpers import close_security_master, init_security_master
 from tracker.securities.security_apis import security_v1_apis
+from tracker.transactions.helpers.group_commit_helpers import close_trade_writer, init_trade_writer
 from tracker.transactions.transaction_apis import transaction_v1_apis
+from tracker.users.helpers.user_utils import check_token_secret_key
 from tracker.users.user_apis import user_v1_apis
+from utils.cache_utils import close_cache, init_cache
 
 
 app = FastAPI(
@@ -17,6 +24,27 @@ app = FastAPI(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    check_token_secret_key()
+    await init_cache()
+    await init_security_master()
+    await init_trade_writer()
+    await init_price_coalescer()
+    await init_valuation_index()
+    await init_returns_broadcaster()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_returns_broadcaster()
+    await close_valuation_index()
+    await close_price_coalescer()
+    await close_trade_writer()
+    await close_security_master()
+    await close_cache()
+
+
 @app.get("/", tags=["System Check"])
 async def root():
     return {"status": True}
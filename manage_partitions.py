@@ -0,0 +1,45 @@
+"""Creates the monthly partitions of the transactions table ahead of time.
+
+Meant to be run daily, eg: from cron. Creating a partition that already exists is a no-op.
+Trades of a month without a partition land in transactions_default. Creating the partition later moves them
+out of the default, which blocks inserts of other months' trades meanwhile, so keep the partitions ahead.
+
+Usage: python manage_partitions.py [--months-ahead N]
+"""
+import argparse
+import sys
+
+from sqlalchemy import text
+
+from utils.constants import TRANSACTION_PARTITION_MONTHS_AHEAD
+from utils.database_utils import get_db_session
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Creates the monthly partitions of the transactions table.")
+    parser.add_argument(
+        "--months-ahead", type=int, default=TRANSACTION_PARTITION_MONTHS_AHEAD,
+        help="Months of partitions to keep ahead of the current one."
+    )
+    args = parser.parse_args()
+
+    session = get_db_session()
+    try:
+        created = session.execute(
+            text("SELECT create_transaction_partitions(current_date, :months_ahead)"),
+            {"months_ahead": args.months_ahead}
+        ).scalar()
+        session.commit()
+    except Exception as e:
+        print("Exception Raised: ", e)
+        session.rollback()
+        return 1
+    finally:
+        session.close()
+
+    print(f"Created {created} partitions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,7 +24,12 @@ class Securities(Base):
 
     __table_args__ = (
         UniqueConstraint(name, ticker_symbol, name='_security_uc'),
-        Index("ix_active_ticker", "ticker_symbol", "is_active"),
+        # Prefix and fuzzy search, needs the pg_trgm extension.
+        Index(
+            'ix_securities_ticker_symbol_trgm', ticker_symbol,
+            postgresql_using='gin', postgresql_ops={'ticker_symbol': 'gin_trgm_ops'}
+        ),
+        Index('ix_securities_name_trgm', name, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
     )
 
 
@@ -50,32 +55,56 @@ class Portfolio(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     security_id = Column(Integer, ForeignKey("securities.id"))
-    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
     average_buy_price = Column(Float, nullable=False)
     quantity = Column(Integer, default=0, nullable=False)
     created_on = Column(DateTime, default=datetime.now)
     updated_on = Column(DateTime, default=datetime.now)
+    version = Column(Integer, default=1, server_default="1", nullable=False)
     security_data = relationship("Securities", backref="securities")
-    transactions = relationship("Transaction", backref="transactions")
+    transactions = relationship(
+        "Transaction", backref="transactions", order_by="[Transaction.created_on, Transaction.id]"
+    )
 
     __table_args__ = (
         UniqueConstraint(security_id, user_id, name='_portfolio_uc'),
-        Index("ix_user_security", "security_id", "user_id"),
+        # Also INCLUDEs id, quantity and average_buy_price, see the c81e5a7f0d34 migration.
+        Index("ix_user_portfolio_holdings", user_id, security_id),
     )
 
 
 class Transaction(Base):
     __tablename__ = "transactions"
 
-    id = Column(Integer, primary_key=True, index=True)
-    portfolio_id = Column(Integer, ForeignKey("portfolios.id"), index=True)
-    transaction_type = Column(ENUM(*TRANSACTION_TYPES, name="transaction_type_enum"), index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    portfolio_id = Column(Integer, ForeignKey("portfolios.id"))
+    transaction_type = Column(ENUM(*TRANSACTION_TYPES, name="transaction_type_enum"))
     transaction_amount = Column(Float, nullable=False)
     transaction_quantity = Column(Integer)
     is_valid_trade = Column(Boolean, default=False)
+    created_on = Column(DateTime, primary_key=True, default=datetime.now)
+    user_id = Column(Integer, ForeignKey("users.id"))
+
+    __table_args__ = (
+        # Both also INCLUDE the columns their queries read, see the c81e5a7f0d34 migration.
+        Index("ix_user_transaction_history", user_id, created_on.desc(), id.desc()),
+        Index("ix_portfolio_latest_transaction", portfolio_id, created_on.desc(), id.desc()),
+        # Monthly partitions are created by create_transaction_partitions, see manage_partitions.py.
+        {"postgresql_partition_by": "RANGE (created_on)"},
+    )
+
+
+class PortfolioSnapshot(Base):
+    __tablename__ = "portfolio_snapshots"
+
+    id = Column(Integer, primary_key=True, index=True)
+    portfolio_id = Column(Integer, ForeignKey("portfolios.id"), nullable=False)
+    transaction_id = Column(Integer, nullable=False)
+    transaction_created_on = Column(DateTime, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    average_buy_price = Column(Float, nullable=False)
     created_on = Column(DateTime, default=datetime.now)
-    user_id = Column(Integer, ForeignKey("users.id"), index=True)
 
     __table_args__ = (
-        Index("ix_valid_transactions", "portfolio_id", "is_valid_trade"),
+        Index("ix_portfolio_latest_snapshot", portfolio_id, transaction_created_on.desc(), transaction_id.desc()),
     )
@@ -0,0 +1,98 @@
+"""Rebuilds or verifies every user's portfolios from the transaction ledger.
+
+Users are sharded by user id across worker processes, every worker rebuilds its users one db transaction at a time.
+
+Usage: python rebuild_portfolios.py [--workers N] [--verify] [--user-id ID]
+"""
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import text
+
+from tracker.portfolio.helpers.portfolio_replay_helpers import rebuild_user_portfolios
+from utils.database_utils import get_db_session, get_master_engine
+
+
+def init_worker():
+    """Drops any pooled connection inherited from the parent, a psycopg2 connection can't be shared across forks."""
+    get_master_engine().dispose()
+
+
+def rebuild_shard(shard: int, workers: int, verify_only: bool, user_id: Optional[int] = None) -> Dict[str, int]:
+    """Rebuilds the portfolios of every user with user_id % workers == shard.
+
+    Args:
+        shard (int): The shard handled by this worker.
+        workers (int): The number of shards.
+        verify_only (bool): Only report the drift, write nothing.
+        user_id (Optional[int], optional): Only rebuild this user. Defaults to None.
+
+    Returns:
+        Dict[str, int]: The number of users rebuilt, drifted portfolios and failed users.
+    """
+    summary = {"users": 0, "drifted": 0, "failed": 0}
+    session = get_db_session()
+    try:
+        if user_id:
+            user_ids = [user_id]
+        else:
+            user_ids = [
+                row.id for row in session.execute(
+                    text("SELECT id FROM users WHERE id % :workers = :shard ORDER BY id"),
+                    {"workers": workers, "shard": shard}
+                )
+            ]
+            session.commit()
+
+        for current_user_id in user_ids:
+            try:
+                drifted = rebuild_user_portfolios(user_id=current_user_id, session=session, verify_only=verify_only)
+            except Exception as e:
+                print("Exception Raised: ", e)
+                session.rollback()
+                summary["failed"] += 1
+                continue
+
+            summary["users"] += 1
+            summary["drifted"] += len(drifted)
+            for portfolio in drifted:
+                print(
+                    f"user {current_user_id} portfolio {portfolio['portfolio_id']}: "
+                    f"stored {portfolio['stored']}, replayed {portfolio['replayed']}",
+                    flush=True
+                )
+    finally:
+        session.close()
+
+    return summary
+
+
+def rebuild_shard_args(args: Tuple) -> Dict[str, int]:
+    return rebuild_shard(*args)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Rebuilds or verifies portfolios from the transaction ledger.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--verify", action="store_true", help="Only report drifted portfolios, write nothing.")
+    parser.add_argument("--user-id", type=int, default=None, help="Only rebuild the portfolios of this user.")
+    args = parser.parse_args()
+
+    workers = 1 if args.user_id else max(args.workers, 1)
+    with Pool(processes=workers, initializer=init_worker) as pool:
+        summaries = pool.map(
+            rebuild_shard_args, [(shard, workers, args.verify, args.user_id) for shard in range(workers)]
+        )
+
+    users = sum(summary["users"] for summary in summaries)
+    drifted = sum(summary["drifted"] for summary in summaries)
+    failed = sum(summary["failed"] for summary in summaries)
+    print(f"{'Verified' if args.verify else 'Rebuilt'} {users} users, {drifted} drifted portfolios, {failed} failed.")
+    return 1 if failed or (args.verify and drifted) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
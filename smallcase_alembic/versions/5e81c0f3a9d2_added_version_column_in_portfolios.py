@@ -0,0 +1,24 @@
+"""Added version column in portfolios
+
+Revision ID: 5e81c0f3a9d2
+Revises: 7d2b9c4e6f10
+Create Date: 2026-10-18 11:48:05.913552
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e81c0f3a9d2'
+down_revision = '7d2b9c4e6f10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('portfolios', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('portfolios', 'version')
@@ -0,0 +1,41 @@
+"""Added portfolio snapshots
+
+Revision ID: 7d2b9c4e6f10
+Revises: a3c5e8f21b7d
+Create Date: 2026-10-18 11:03:17.562390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2b9c4e6f10'
+down_revision = 'a3c5e8f21b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('portfolio_snapshots',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('portfolio_id', sa.Integer(), nullable=False),
+    sa.Column('transaction_id', sa.Integer(), nullable=False),
+    sa.Column('transaction_created_on', sa.DateTime(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('average_buy_price', sa.Float(), nullable=False),
+    sa.Column('created_on', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['portfolio_id'], ['portfolios.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_portfolio_snapshots_id'), 'portfolio_snapshots', ['id'], unique=False)
+    op.create_index(
+        'ix_portfolio_latest_snapshot', 'portfolio_snapshots',
+        ['portfolio_id', sa.text('transaction_created_on DESC'), sa.text('transaction_id DESC')], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_portfolio_latest_snapshot', table_name='portfolio_snapshots')
+    op.drop_index(op.f('ix_portfolio_snapshots_id'), table_name='portfolio_snapshots')
+    op.drop_table('portfolio_snapshots')
@@ -0,0 +1,27 @@
+"""Added latest transaction index
+
+Revision ID: a3c5e8f21b7d
+Revises: cfbbb80ad65d
+Create Date: 2026-10-18 10:12:41.208114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c5e8f21b7d'
+down_revision = 'cfbbb80ad65d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_portfolio_latest_transaction', 'transactions',
+        ['portfolio_id', sa.text('created_on DESC'), sa.text('id DESC')], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_portfolio_latest_transaction', table_name='transactions')
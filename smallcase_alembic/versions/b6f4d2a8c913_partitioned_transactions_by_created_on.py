@@ -0,0 +1,127 @@
+"""Partitioned transactions by created_on
+
+Revision ID: b6f4d2a8c913
+Revises: 5e81c0f3a9d2
+Create Date: 2026-10-18 12:31:44.270918
+
+Turns transactions into a table range partitioned by month on created_on. Needs PostgreSQL 12 or later.
+The existing rows are copied into the new partitions, trades outside the created months land in transactions_default.
+Future partitions are created with `python manage_partitions.py`, which calls create_transaction_partitions.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6f4d2a8c913'
+down_revision = '5e81c0f3a9d2'
+branch_labels = None
+depends_on = None
+
+# Months of partitions created ahead of the current one.
+MONTHS_AHEAD = 3
+
+CREATE_PARTITION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_transaction_partitions(from_date date, months_ahead integer)
+    RETURNS integer AS $$
+    DECLARE
+        partition_start date := date_trunc('month', from_date)::date;
+        last_start date := (date_trunc('month', current_date) + make_interval(months => months_ahead))::date;
+        partition_name text;
+        created integer := 0;
+    BEGIN
+        WHILE partition_start <= last_start LOOP
+            partition_name := 'transactions_' || to_char(partition_start, 'YYYY_MM');
+            IF to_regclass(partition_name) IS NULL THEN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, partition_start, (partition_start + interval '1 month')::date
+                );
+                created := created + 1;
+            END IF;
+            partition_start := (partition_start + interval '1 month')::date;
+        END LOOP;
+        RETURN created;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+TRANSACTION_INDEXES = (
+    ('ix_transactions_id', ['id']),
+    ('ix_transactions_portfolio_id', ['portfolio_id']),
+    ('ix_transactions_transaction_type', ['transaction_type']),
+    ('ix_transactions_user_id', ['user_id']),
+    ('ix_valid_transactions', ['portfolio_id', 'is_valid_trade']),
+    ('ix_portfolio_latest_transaction', ['portfolio_id', sa.text('created_on DESC'), sa.text('id DESC')]),
+)
+
+COLUMNS = "id, portfolio_id, transaction_type, transaction_amount, transaction_quantity, is_valid_trade, created_on, user_id"
+
+
+def upgrade():
+    # Keep the id sequence when the old table is dropped.
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY NONE")
+    op.rename_table('transactions', 'transactions_unpartitioned')
+    op.execute("ALTER INDEX transactions_pkey RENAME TO transactions_unpartitioned_pkey")
+
+    op.execute("""
+        CREATE TABLE transactions (
+            id integer NOT NULL DEFAULT nextval('transactions_id_seq'),
+            portfolio_id integer REFERENCES portfolios (id),
+            transaction_type transaction_type_enum,
+            transaction_amount double precision NOT NULL,
+            transaction_quantity integer,
+            is_valid_trade boolean,
+            created_on timestamp without time zone NOT NULL,
+            user_id integer REFERENCES users (id),
+            PRIMARY KEY (id, created_on)
+        ) PARTITION BY RANGE (created_on)
+    """)
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id")
+    op.execute("CREATE TABLE transactions_default PARTITION OF transactions DEFAULT")
+    op.execute(CREATE_PARTITION_FUNCTION)
+    op.execute(f"""
+        SELECT create_transaction_partitions(
+            coalesce((SELECT min(created_on) FROM transactions_unpartitioned)::date, current_date), {MONTHS_AHEAD}
+        )
+    """)
+
+    op.execute(f"""
+        INSERT INTO transactions ({COLUMNS})
+        SELECT id, portfolio_id, transaction_type, transaction_amount, transaction_quantity, is_valid_trade,
+            coalesce(created_on, now()), user_id
+        FROM transactions_unpartitioned
+    """)
+    op.drop_table('transactions_unpartitioned')
+
+    for index_name, columns in TRANSACTION_INDEXES:
+        op.create_index(index_name, 'transactions', columns, unique=False)
+
+
+def downgrade():
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY NONE")
+    op.rename_table('transactions', 'transactions_partitioned')
+    op.execute("ALTER INDEX transactions_pkey RENAME TO transactions_partitioned_pkey")
+    for index_name, _ in TRANSACTION_INDEXES:
+        op.execute(f"ALTER INDEX {index_name} RENAME TO {index_name}_partitioned")
+
+    op.execute("""
+        CREATE TABLE transactions (
+            id integer NOT NULL DEFAULT nextval('transactions_id_seq') PRIMARY KEY,
+            portfolio_id integer REFERENCES portfolios (id),
+            transaction_type transaction_type_enum,
+            transaction_amount double precision NOT NULL,
+            transaction_quantity integer,
+            is_valid_trade boolean,
+            created_on timestamp without time zone,
+            user_id integer REFERENCES users (id)
+        )
+    """)
+    op.execute("ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id")
+    op.execute(f"INSERT INTO transactions ({COLUMNS}) SELECT {COLUMNS} FROM transactions_partitioned")
+    op.drop_table('transactions_partitioned')
+    op.execute("DROP FUNCTION create_transaction_partitions(date, integer)")
+
+    for index_name, columns in TRANSACTION_INDEXES:
+        op.create_index(index_name, 'transactions', columns, unique=False)
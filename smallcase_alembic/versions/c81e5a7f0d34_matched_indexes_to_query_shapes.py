@@ -0,0 +1,67 @@
+"""Matched indexes to query shapes
+
+Revision ID: c81e5a7f0d34
+Revises: b6f4d2a8c913
+Create Date: 2026-10-18 13:20:09.418736
+
+Replaces the indexes that no query uses with covering indexes for the queries in the *_db_helpers modules.
+Run `python check_query_plans.py` to confirm that none of them falls back to a sequential scan.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81e5a7f0d34'
+down_revision = 'b6f4d2a8c913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Holdings, returns and trade locks filter portfolios on the user first.
+    op.execute("""
+        CREATE INDEX ix_user_portfolio_holdings ON portfolios (user_id, security_id)
+        INCLUDE (id, quantity, average_buy_price)
+    """)
+    # Served by the _portfolio_uc unique index and ix_user_portfolio_holdings.
+    op.drop_index('ix_user_security', table_name='portfolios')
+    op.drop_index(op.f('ix_portfolios_user_id'), table_name='portfolios')
+    # Served by the unique ix_securities_ticker_symbol index.
+    op.drop_index('ix_active_ticker', table_name='securities')
+
+    # The trade history, newest first.
+    op.execute("""
+        CREATE INDEX ix_user_transaction_history ON transactions (user_id, created_on DESC, id DESC)
+        INCLUDE (portfolio_id, transaction_type, transaction_quantity, transaction_amount)
+    """)
+    # The latest trades of a portfolio and the ledger replay, without visiting the heap.
+    op.drop_index('ix_portfolio_latest_transaction', table_name='transactions')
+    op.execute("""
+        CREATE INDEX ix_portfolio_latest_transaction ON transactions (portfolio_id, created_on DESC, id DESC)
+        INCLUDE (transaction_type, transaction_amount, transaction_quantity)
+    """)
+    # Prefixes of the indexes above, or never filtered on.
+    op.drop_index(op.f('ix_transactions_user_id'), table_name='transactions')
+    op.drop_index(op.f('ix_transactions_portfolio_id'), table_name='transactions')
+    op.drop_index(op.f('ix_transactions_transaction_type'), table_name='transactions')
+    op.drop_index('ix_valid_transactions', table_name='transactions')
+
+
+def downgrade():
+    op.create_index('ix_valid_transactions', 'transactions', ['portfolio_id', 'is_valid_trade'], unique=False)
+    op.create_index(op.f('ix_transactions_transaction_type'), 'transactions', ['transaction_type'], unique=False)
+    op.create_index(op.f('ix_transactions_portfolio_id'), 'transactions', ['portfolio_id'], unique=False)
+    op.create_index(op.f('ix_transactions_user_id'), 'transactions', ['user_id'], unique=False)
+    op.drop_index('ix_portfolio_latest_transaction', table_name='transactions')
+    op.create_index(
+        'ix_portfolio_latest_transaction', 'transactions',
+        ['portfolio_id', sa.text('created_on DESC'), sa.text('id DESC')], unique=False
+    )
+    op.drop_index('ix_user_transaction_history', table_name='transactions')
+
+    op.create_index('ix_active_ticker', 'securities', ['ticker_symbol', 'is_active'], unique=False)
+    op.create_index(op.f('ix_portfolios_user_id'), 'portfolios', ['user_id'], unique=False)
+    op.create_index('ix_user_security', 'portfolios', ['security_id', 'user_id'], unique=False)
+    op.drop_index('ix_user_portfolio_holdings', table_name='portfolios')
@@ -0,0 +1,34 @@
+"""Added security search indexes
+
+Revision ID: d4e9a1c7b250
+Revises: c81e5a7f0d34
+Create Date: 2026-10-18 14:05:37.512094
+
+Trigram indexes for the prefix and fuzzy search of securities, needs the pg_trgm extension.
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4e9a1c7b250'
+down_revision = 'c81e5a7f0d34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index(
+        'ix_securities_ticker_symbol_trgm', 'securities', ['ticker_symbol'], unique=False,
+        postgresql_using='gin', postgresql_ops={'ticker_symbol': 'gin_trgm_ops'}
+    )
+    op.create_index(
+        'ix_securities_name_trgm', 'securities', ['name'], unique=False,
+        postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}
+    )
+
+
+def downgrade():
+    op.drop_index('ix_securities_name_trgm', table_name='securities')
+    op.drop_index('ix_securities_ticker_symbol_trgm', table_name='securities')
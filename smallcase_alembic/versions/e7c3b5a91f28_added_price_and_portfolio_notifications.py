@@ -0,0 +1,63 @@
+"""Added price and portfolio notifications
+
+Revision ID: e7c3b5a91f28
+Revises: d4e9a1c7b250
+Create Date: 2026-10-18 14:52:18.903417
+
+Triggers that NOTIFY the workers streaming returns. security_price_changes carries `<security id>:<price>`
+whenever current_price changes, portfolio_changes carries the user id whenever one of their portfolios changes.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7c3b5a91f28'
+down_revision = 'd4e9a1c7b250'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION notify_security_price_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('security_price_changes', NEW.id || ':' || NEW.current_price);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER security_price_changed
+        AFTER UPDATE OF current_price ON securities
+        FOR EACH ROW WHEN (OLD.current_price IS DISTINCT FROM NEW.current_price)
+        EXECUTE PROCEDURE notify_security_price_change()
+    """)
+
+    # Notifications with the same payload are sent once per db transaction, so a trade touching
+    # many holdings of a user notifies once.
+    op.execute("""
+        CREATE OR REPLACE FUNCTION notify_portfolio_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('portfolio_changes', OLD.user_id::text);
+            ELSE
+                PERFORM pg_notify('portfolio_changes', NEW.user_id::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER portfolio_changed
+        AFTER INSERT OR UPDATE OR DELETE ON portfolios
+        FOR EACH ROW EXECUTE PROCEDURE notify_portfolio_change()
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER portfolio_changed ON portfolios")
+    op.execute("DROP FUNCTION notify_portfolio_change()")
+    op.execute("DROP TRIGGER security_price_changed ON securities")
+    op.execute("DROP FUNCTION notify_security_price_change()")
@@ -0,0 +1,107 @@
+"""Move default rows into new partitions
+
+Revision ID: f3b8e2d6c415
+Revises: e7c3b5a91f28
+Create Date: 2026-10-18 16:08:37.512604
+
+Trades of a month without a partition land in transactions_default, and once they have, creating the partition
+of that month fails as the default holds rows of its range. create_transaction_partitions now creates such a
+partition as a plain table, moves the rows of its month out of the default into it, and attaches it.
+The default stays locked against inserts while its rows are moved, reads go through.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8e2d6c415'
+down_revision = 'e7c3b5a91f28'
+branch_labels = None
+depends_on = None
+
+
+CREATE_PARTITION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_transaction_partitions(from_date date, months_ahead integer)
+    RETURNS integer AS $$
+    DECLARE
+        partition_start date := date_trunc('month', from_date)::date;
+        partition_end date;
+        last_start date := (date_trunc('month', current_date) + make_interval(months => months_ahead))::date;
+        partition_name text;
+        created integer := 0;
+    BEGIN
+        WHILE partition_start <= last_start LOOP
+            partition_name := 'transactions_' || to_char(partition_start, 'YYYY_MM');
+            partition_end := (partition_start + interval '1 month')::date;
+            IF to_regclass(partition_name) IS NULL THEN
+                -- No trade of the month may land in the default between the check and the attach.
+                LOCK TABLE transactions_default IN EXCLUSIVE MODE;
+                IF EXISTS (
+                    SELECT 1 FROM transactions_default
+                    WHERE created_on >= partition_start AND created_on < partition_end
+                ) THEN
+                    EXECUTE format(
+                        'CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS, '
+                        'CONSTRAINT %I CHECK (created_on >= %L AND created_on < %L))',
+                        partition_name, partition_name || '_range', partition_start, partition_end
+                    );
+                    EXECUTE format(
+                        'WITH moved AS ('
+                        'DELETE FROM transactions_default WHERE created_on >= %L AND created_on < %L RETURNING *'
+                        ') INSERT INTO %I SELECT * FROM moved',
+                        partition_start, partition_end, partition_name
+                    );
+                    -- The check constraint spares the attach a scan of the new partition.
+                    EXECUTE format(
+                        'ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, partition_start, partition_end
+                    );
+                    EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', partition_name, partition_name || '_range');
+                ELSE
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, partition_start, partition_end
+                    );
+                END IF;
+                created := created + 1;
+            END IF;
+            partition_start := partition_end;
+        END LOOP;
+        RETURN created;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+PREVIOUS_PARTITION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_transaction_partitions(from_date date, months_ahead integer)
+    RETURNS integer AS $$
+    DECLARE
+        partition_start date := date_trunc('month', from_date)::date;
+        last_start date := (date_trunc('month', current_date) + make_interval(months => months_ahead))::date;
+        partition_name text;
+        created integer := 0;
+    BEGIN
+        WHILE partition_start <= last_start LOOP
+            partition_name := 'transactions_' || to_char(partition_start, 'YYYY_MM');
+            IF to_regclass(partition_name) IS NULL THEN
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, partition_start, (partition_start + interval '1 month')::date
+                );
+                created := created + 1;
+            END IF;
+            partition_start := (partition_start + interval '1 month')::date;
+        END LOOP;
+        RETURN created;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.execute(CREATE_PARTITION_FUNCTION)
+
+
+def downgrade():
+    op.execute(PREVIOUS_PARTITION_FUNCTION)
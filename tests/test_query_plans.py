@@ -0,0 +1,64 @@
+"""Checks that the queries of the *_db_helpers modules are served by indexes, see check_query_plans.py.
+
+The checks need a Postgres seeded with `python check_query_plans.py --seed` and are skipped without one.
+Run them from the repository root with `python -m pytest`.
+"""
+from datetime import datetime
+from typing import Dict, Iterator
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from check_query_plans import Statement, explain, helper_queries, seeded_queries, sequential_scans, walk_plan
+from utils.database_utils import get_db_session
+
+
+# The queries are only built, not run, to name them, so an unbound session is enough.
+QUERY_NAMES = list(helper_queries(
+    Session(), user_id=0, portfolio_id=0, security_id=0, transaction_id=0, created_on=datetime.now()
+))
+
+
+@pytest.fixture(scope="module")
+def session() -> Iterator[Session]:
+    session = get_db_session()
+    try:
+        session.execute(text("SELECT 1"))
+    except DBAPIError as e:
+        session.close()
+        pytest.skip(f"No database reachable: {e}")
+
+    yield session
+    session.rollback()
+    session.close()
+
+
+@pytest.fixture(scope="module")
+def queries(session: Session) -> Dict[str, Statement]:
+    queries = seeded_queries(session)
+    if not queries:
+        pytest.skip("No portfolios found, run python check_query_plans.py --seed first.")
+    return queries
+
+
+def test_sequential_scans_walks_the_whole_plan():
+    plan = {
+        "Node Type": "Nested Loop",
+        "Plans": [
+            {"Node Type": "Index Scan", "Relation Name": "portfolios"},
+            {"Node Type": "Hash Join", "Plans": [
+                {"Node Type": "Seq Scan", "Relation Name": "transactions_2026_10"},
+                {"Node Type": "Seq Scan", "Relation Name": "users"},
+            ]},
+        ],
+    }
+
+    assert len(list(walk_plan(plan))) == 5
+    assert sequential_scans(plan) == ["transactions_2026_10"]
+
+
+@pytest.mark.parametrize("name", QUERY_NAMES)
+def test_query_is_served_by_indexes(session: Session, queries: Dict[str, Statement], name: str):
+    assert sequential_scans(explain(session, queries[name])) == []
@@ -1,33 +1,124 @@
-from typing import Dict, List
-from fastapi import Depends
+import asyncio
+import json
+from typing import List
+from fastapi import Depends, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
 
-from tracker.portfolio.helpers.portfolio_db_helpers import calculate_portfolio_returns, get_portfolio_data
-from tracker.portfolio.schemas.portfolio_schemas import PortfolioDataSchema
+from tracker.portfolio.helpers.portfolio_db_helpers import (
+    cached_portfolio_data, calculate_portfolio_returns, get_holdings_version
+)
+from tracker.portfolio.helpers.returns_stream_helpers import get_returns_broadcaster
+from tracker.portfolio.helpers.valuation_index_helpers import get_valuation_index
+from tracker.portfolio.schemas.portfolio_schemas import PortfolioDataSchema, PortfolioReturnsSchema
 from tracker.users.schemas.user_schemas import UserResponse
-from tracker.users.handlers.user_handler import authorise_user
+from tracker.users.handlers.user_handler import authorise_request
+from tracker.users.helpers.user_utils import verify_access_token
+from utils.constants import RETURNS_STREAM_HEARTBEAT_INTERVAL, SERVICE_UNAVAILABLE, UNAUTHORISED_CODE
+from utils.database_utils import get_session, run_db_call
+from utils.etag_utils import etag_headers, etag_matches, make_etag, not_modified
 
 
-async def get_portfolio(user: UserResponse = Depends(authorise_user)) -> List[PortfolioDataSchema]:
+async def get_portfolio(
+    request: Request, response: Response, user: UserResponse = Depends(authorise_request),
+    session: Session = Depends(get_session)
+) -> List[PortfolioDataSchema]:
     """Returns a list of portfolios that the user holds.
 
+    The ETag is derived from the count, the latest updated_on and the versions of the user's portfolios,
+    a matching If-None-Match is answered with a 304 without loading the holdings. The holdings are
+    cached under the same stamp, so a body is never served under a newer ETag than its own.
+
     Args:
-        user (UserResponse, optional): The user details. Defaults to Depends(authorise_user).
+        request (Request): The request.
+        response (Response): The response, used to set the ETag.
+        user (UserResponse, optional): The user details. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Returns:
         List[PortfolioDataSchema]: The list of portfolios.
     """
-    response = get_portfolio_data(user_data=UserResponse(**user))
-    return response
+    user_data = UserResponse(**user)
+    etag = make_etag(*await run_db_call(get_holdings_version, user_id=user_data.id, session=session))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    response.headers.update(etag_headers(etag))
+    holdings = await cached_portfolio_data(user_data=user_data, session=session, version=etag)
+    return holdings
 
 
-async def get_returns(user: UserResponse = Depends(authorise_user)) -> Dict:
+async def get_returns(
+    breakdown: bool = False, user: UserResponse = Depends(authorise_request), session: Session = Depends(get_session)
+) -> PortfolioReturnsSchema:
     """Returns the total returns the user has got.
 
+    Served from the valuation index once it has loaded, from the database until then and whenever
+    the index is reconnecting or could not reload the user.
+
     Args:
-        user (UserResponse, optional): The user data. Defaults to Depends(authorise_user).
+        breakdown (bool, optional): Also return the returns of every holding. Defaults to False.
+        user (UserResponse, optional): The user data. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Returns:
-        Dict: The return json.
+        PortfolioReturnsSchema: The return json.
     """
-    response = calculate_portfolio_returns(user_data=UserResponse(**user))
+    valuation_index = get_valuation_index()
+    if valuation_index.is_current(user["id"]):
+        return valuation_index.returns(user["id"], breakdown=breakdown)
+
+    response = await run_db_call(
+        calculate_portfolio_returns, user_data=UserResponse(**user), session=session, breakdown=breakdown
+    )
     return response
+
+
+async def stream_returns(request: Request, token: str = "") -> StreamingResponse:
+    """Streams the total and per holding returns as server-sent events, one `returns` event per change.
+
+    An event is sent on connect and whenever the price of a held security or a portfolio of the user
+    changes. A comment is sent every RETURNS_STREAM_HEARTBEAT_INTERVAL seconds to keep the stream open.
+
+    Args:
+        request (Request): The request.
+        token (str, optional): An access token, if not sent as an `Authorization: Bearer` header, as
+            EventSource can't set headers. Defaults to "".
+
+    Raises:
+        HTTPException: If the access token is missing or invalid.
+        HTTPException: If the valuation index could not be loaded.
+
+    Returns:
+        StreamingResponse: The text/event-stream.
+    """
+    authorization = request.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    user = verify_access_token(token) if token else None
+    if not user:
+        raise HTTPException(status_code=UNAUTHORISED_CODE, detail="NOT_AUTHENTICATED")
+
+    broadcaster = get_returns_broadcaster()
+    try:
+        queue: asyncio.Queue = await broadcaster.subscribe(user["id"])
+    except RuntimeError as e:
+        print("Exception Raised: ", e)
+        raise HTTPException(status_code=SERVICE_UNAVAILABLE, detail="RETURNS_STREAM_UNAVAILABLE")
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    returns = await asyncio.wait_for(queue.get(), RETURNS_STREAM_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"event: returns\ndata: {json.dumps(jsonable_encoder(returns))}\n\n"
+        finally:
+            broadcaster.unsubscribe(user["id"], queue)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
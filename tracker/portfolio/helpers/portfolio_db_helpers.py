@@ -1,21 +1,33 @@
+import random
+import time
 from datetime import datetime
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Query, Session
 
 from models.db_models import Portfolio, Securities
 from tracker.transactions.schemas.transaction_schemas import TradeTransaction
 from tracker.users.schemas.user_schemas import UserResponse
-from utils.database_utils import get_db_session
+from utils.cache_utils import read_through
+from utils.constants import (
+    PORTFOLIO_CACHE_KEY, PORTFOLIO_RETRY_BACKOFF_MS, PORTFOLIO_UPDATE_RETRIES, PORTFOLIO_VERSION_CONFLICT
+)
+from utils.database_utils import run_db_call
 
 
 def create_portfolio(
-    transaction_data: TradeTransaction, user_data: UserResponse, session = get_db_session()
+    transaction_data: TradeTransaction, user_data: UserResponse, session: Session, commit: bool = True
 ) -> Tuple[bool, str, Portfolio]:
     """Creates or adds a new portfolio to the database.
 
     Args:
         transaction_data (TradeTransaction): The transaction data for the portfolio.
         user_data (UserResponse): The users data.
-        session ([type], optional): The db session. Defaults to get_db_session().
+        session (Session): The db session.
+        commit (bool, optional): Whether to commit, else only flush and leave the db transaction to the caller.
+            Defaults to True.
 
     Returns:
         Tuple[bool, str, Portfolio]: A tuple of success, message and new portfolio object.
@@ -34,7 +46,10 @@ def create_portfolio(
 
     try:
         session.add(db_portfolio)
-        session.commit()
+        if commit:
+            session.commit()
+        else:
+            session.flush()
     except Exception as e:
         success = False
         message = "FAILED_TO_CREATE_PORTFOLIO"
@@ -44,136 +59,343 @@ def create_portfolio(
     return success, message, db_portfolio
 
 
-def update_portfolio(transaction_data: TradeTransaction, existing_portfolio: Portfolio, session = get_db_session()):
-    success: bool = True
-    message: str = "TRANSACTION_SUCCESSFUL"
-    portfolio_to_update = session.query(Portfolio).filter(
-        Portfolio.id == existing_portfolio.id
-    )
-    update_data = {
-        "updated_on": datetime.now()
-    }
+def compute_portfolio_position(
+    quantity: int, average_buy_price: float, transaction_type: str, transaction_amount: float, transaction_quantity: int
+) -> Tuple[int, float]:
+    """Applies a trade to a holding and returns the new quantity and average buy price.
 
-    if transaction_data.transaction_type == "BUY":
-        update_data["quantity"] = int(existing_portfolio.quantity + transaction_data.quantity)
-        new_price = (
-            (existing_portfolio.average_buy_price * existing_portfolio.quantity) + (transaction_data.transaction_amount * transaction_data.quantity)
-        ) / (existing_portfolio.quantity + transaction_data.quantity)
-        update_data["average_buy_price"] = float("{:.2f}".format(new_price))
-    elif transaction_data.transaction_type == "SELL":
-        update_data["quantity"] = int(existing_portfolio.quantity - transaction_data.quantity)
+    A BUY moves the average buy price to the weighted average of the holding and the trade,
+    a SELL only reduces the quantity.
 
-    try:
-        portfolio_to_update.update(
-            update_data, synchronize_session="evaluate"
+    Args:
+        quantity (int): The quantity currently held.
+        average_buy_price (float): The current average buy price.
+        transaction_type (str): BUY or SELL.
+        transaction_amount (float): The price per share of the trade.
+        transaction_quantity (int): The quantity traded.
+
+    Returns:
+        Tuple[int, float]: A tuple of the new quantity and the new average buy price.
+    """
+    if transaction_type == "BUY":
+        new_quantity = int(quantity + transaction_quantity)
+        new_price = ((average_buy_price * quantity) + (transaction_amount * transaction_quantity)) / new_quantity
+        return new_quantity, float("{:.2f}".format(new_price))
+
+    return int(quantity - transaction_quantity), average_buy_price
+
+
+def upsert_portfolio_positions(user_id: int, positions: Dict[int, Tuple[int, float]], session: Session):
+    """Writes the final quantity and average buy price of many holdings with one INSERT ... ON CONFLICT statement.
+
+    Does not commit, the caller owns the db transaction.
+
+    Args:
+        user_id (int): The user id.
+        positions (Dict[int, Tuple[int, float]]): The quantity and average buy price keyed by security id.
+        session (Session): The db session.
+    """
+    if not positions:
+        return
+
+    now = datetime.now()
+    portfolio_upsert = insert(Portfolio.__table__).values([
+        {
+            "security_id": security_id, "user_id": user_id, "quantity": quantity,
+            "average_buy_price": average_buy_price, "created_on": now, "updated_on": now
+        } for security_id, (quantity, average_buy_price) in positions.items()
+    ])
+    session.execute(
+        portfolio_upsert.on_conflict_do_update(
+            constraint="_portfolio_uc",
+            set_={
+                "quantity": portfolio_upsert.excluded.quantity,
+                "average_buy_price": portfolio_upsert.excluded.average_buy_price,
+                "updated_on": portfolio_upsert.excluded.updated_on,
+                "version": Portfolio.__table__.c.version + 1
+            }
         )
+    )
+
+
+def compare_and_set_portfolio(
+    portfolio_id: int, version: int, quantity: int, average_buy_price: float, session: Session, commit: bool = True
+) -> bool:
+    """Writes a portfolio only if nobody else has written it since it was read.
+
+    Args:
+        portfolio_id (int): The portfolio id.
+        version (int): The version of the portfolio the new values were computed from.
+        quantity (int): The new quantity.
+        average_buy_price (float): The new average buy price.
+        session (Session): The db session.
+        commit (bool, optional): Whether to commit the write, or roll back on a conflict. Callers writing more
+            than the portfolio pass False and commit or roll back the whole db transaction. Defaults to True.
+
+    Returns:
+        bool: Whether the portfolio was written, False if its version has moved on.
+    """
+    updated_rows = session.query(Portfolio).filter(
+        Portfolio.id == portfolio_id,
+        Portfolio.version == version
+    ).update(
+        {
+            "quantity": quantity,
+            "average_buy_price": average_buy_price,
+            "version": version + 1,
+            "updated_on": datetime.now()
+        }, synchronize_session=False
+    )
+    if not updated_rows:
+        if commit:
+            session.rollback()
+        return False
+
+    if commit:
         session.commit()
+    return True
+
+
+def wait_before_retry(attempt: int):
+    """Sleeps for an exponentially growing, jittered interval before retrying a conflicting write."""
+    time.sleep(random.uniform(0, PORTFOLIO_RETRY_BACKOFF_MS * (2 ** attempt)) / 1000)
+
+
+def reload_portfolio(portfolio_id: int, session: Session) -> Portfolio:
+    """Reads the latest committed state of a portfolio."""
+    return session.query(Portfolio).filter(Portfolio.id == portfolio_id).populate_existing().one()
+
+
+def update_portfolio(
+    transaction_data: TradeTransaction, existing_portfolio: Portfolio, session: Session, commit: bool = True
+) -> Tuple[bool, str]:
+    """Applies a trade to a portfolio without locking it.
+
+    The write only succeeds if the portfolio's version has not changed since `existing_portfolio` was read.
+    On a conflict the portfolio is read again and the trade is re-applied, up to PORTFOLIO_UPDATE_RETRIES times.
+
+    Args:
+        transaction_data (TradeTransaction): The trade to apply.
+        existing_portfolio (Portfolio): The portfolio the trade is applied to.
+        session (Session): The db session.
+        commit (bool, optional): Whether to commit. If False a conflict is not retried, the caller rolls back
+            its whole db transaction and retries it. Defaults to True.
+
+    Returns:
+        Tuple[bool, str]: A tuple of success and message, PORTFOLIO_VERSION_CONFLICT if every attempt conflicted.
+    """
+    current_portfolio = existing_portfolio
+    try:
+        for attempt in range(PORTFOLIO_UPDATE_RETRIES if commit else 1):
+            if attempt:
+                wait_before_retry(attempt)
+                current_portfolio = reload_portfolio(portfolio_id=existing_portfolio.id, session=session)
+
+            quantity, average_buy_price = compute_portfolio_position(
+                current_portfolio.quantity, current_portfolio.average_buy_price, transaction_data.transaction_type,
+                transaction_data.transaction_amount, transaction_data.quantity
+            )
+            if compare_and_set_portfolio(
+                portfolio_id=existing_portfolio.id, version=current_portfolio.version, quantity=quantity,
+                average_buy_price=average_buy_price, session=session, commit=commit
+            ):
+                return True, "TRANSACTION_SUCCESSFUL"
     except Exception as e:
-        success = False
-        message = "FAILED_TO_UPDATE_PORTFOLIO"
         print("Exception Raised: ", e)
         session.rollback()
+        return False, "FAILED_TO_UPDATE_PORTFOLIO"
 
-    return success, message
+    return False, PORTFOLIO_VERSION_CONFLICT
 
 
-def rollback_portfolio(updated_portfolio: Portfolio, session = get_db_session()) -> Tuple[bool, str]:
+def rollback_portfolio(
+    updated_portfolio: Portfolio, session: Session, recompute: Optional[Callable[[Portfolio], Portfolio]] = None,
+    commit: bool = True
+) -> Tuple[bool, str]:
     """Updates the portfolio with the old transaction data.
 
+    The write only succeeds if the portfolio's version is still the one `updated_portfolio` was computed from.
+    On a conflict the portfolio is read again and passed to `recompute`, up to PORTFOLIO_UPDATE_RETRIES times.
+    On success `updated_portfolio` holds the written values and version.
+
     Args:
         updated_portfolio (Portfolio): The updated portfolio data.
-        session ([type], optional): The db session. Defaults to get_db_session().
+        session (Session): The db session.
+        recompute (Optional[Callable[[Portfolio], Portfolio]], optional): Computes the updated portfolio from
+            the latest state of the portfolio. Defaults to None, in which case a conflict is not retried.
+        commit (bool, optional): Whether to commit. If False a conflict is not retried, the caller rolls back
+            its whole db transaction and retries it. Defaults to True.
 
     Returns:
-        Tuple[bool, str]: A tuple of success and message.
+        Tuple[bool, str]: A tuple of success and message, PORTFOLIO_VERSION_CONFLICT if every attempt conflicted.
     """
-    success: bool = True
-    message: str = "TRANSACTION_SUCCESSFUL"
-
-    portfolio_to_update = session.query(Portfolio).filter(
-        Portfolio.id == updated_portfolio.id
-    )
-    update_data = {
-        "updated_on": datetime.now(),
-        "quantity": updated_portfolio.quantity,
-        "average_buy_price": updated_portfolio.average_buy_price
-    }
-
+    new_portfolio = updated_portfolio
+    attempts = PORTFOLIO_UPDATE_RETRIES if recompute and commit else 1
     try:
-        portfolio_to_update.update(
-            update_data, synchronize_session="evaluate"
-        )
-        session.commit()
+        for attempt in range(attempts):
+            if attempt:
+                wait_before_retry(attempt)
+                new_portfolio = recompute(reload_portfolio(portfolio_id=updated_portfolio.id, session=session))
+
+            if compare_and_set_portfolio(
+                portfolio_id=updated_portfolio.id, version=new_portfolio.version, quantity=new_portfolio.quantity,
+                average_buy_price=new_portfolio.average_buy_price, session=session, commit=commit
+            ):
+                updated_portfolio.quantity = new_portfolio.quantity
+                updated_portfolio.average_buy_price = new_portfolio.average_buy_price
+                updated_portfolio.version = new_portfolio.version + 1
+                return True, "TRANSACTION_SUCCESSFUL"
     except Exception as e:
-        success = False
-        message = "FAILED_TO_UPDATE_PORTFOLIO"
         print("Exception Raised: ", e)
         session.rollback()
+        return False, "FAILED_TO_UPDATE_PORTFOLIO"
+
+    return False, PORTFOLIO_VERSION_CONFLICT
 
-    return success, message
+
+def portfolio_by_id_query(portfolio_id: int, user_id: int, session: Session, for_update: bool = False) -> Query:
+    """Builds the query of a user's portfolio by id, locking it until the end of the db transaction if `for_update`."""
+    query = session.query(Portfolio).filter(
+        Portfolio.id == portfolio_id,
+        Portfolio.user_id == user_id
+    )
+    if for_update:
+        query = query.with_for_update().populate_existing()
+    return query
 
 
-def get_portfolio_by_id(portfolio_id: int, user_id: int, session = get_db_session()) -> Portfolio:
+def get_portfolio_by_id(portfolio_id: int, user_id: int, session: Session, for_update: bool = False) -> Portfolio:
     """Gets data of portfolio against its id.
 
     Args:
         portfolio_id (int): The portfolio id for which data needs to be returned.
         user_id (int): The user id.
-        session ([type], optional): The db session. Defaults to get_db_session().
+        session (Session): The db session.
+        for_update (bool, optional): Lock the portfolio until the end of the db transaction. Defaults to False.
 
     Returns:
         Portfolio: [description]
     """
-    portfolio: Portfolio = session.query(Portfolio).filter(
-        Portfolio.id == portfolio_id,
-        Portfolio.user_id == user_id
+    portfolio: Portfolio = portfolio_by_id_query(
+        portfolio_id=portfolio_id, user_id=user_id, session=session, for_update=for_update
     ).first()
     return portfolio
 
 
-def get_portfolio_data(user_data: UserResponse) -> List:
+def holdings_query(user_id: int, session: Session) -> Query:
+    """Builds the query of a user's holdings with the name and ticker symbol of their securities."""
+    # Join securities in the same query instead of lazy loading them per portfolio.
+    return session.query(
+        Portfolio.id.label("portfolio_id"),
+        Securities.name.label("security_name"),
+        Securities.ticker_symbol.label("ticker_symbol"),
+        Portfolio.average_buy_price.label("average_buy_price"),
+        Portfolio.quantity.label("total_available_quantity")
+    ).join(
+        Securities, Portfolio.security_id == Securities.id
+    ).filter(Portfolio.user_id == user_id)
+
+
+def get_portfolio_data(user_data: UserResponse, session: Session) -> List:
     """Returns a list of all the portfolios currently that user holds.
 
     Args:
         user_data (UserResponse): The user data.
+        session (Session): The db session.
 
     Returns:
         List: The list of portfolios.
     """
-    session = get_db_session()
-    response = []
-    portfolio_list: List[Portfolio] = session.query(Portfolio).filter(Portfolio.user_id == user_data.id).all()
-
-    for portfolio in portfolio_list:
-        security: Securities = portfolio.security_data
-        response.append(
-            {
-                "portfolio_id": portfolio.id,
-                "security_name": security.name,
-                "ticker_symbol": security.ticker_symbol,
-                "average_buy_price": portfolio.average_buy_price,
-                "total_available_quantity": portfolio.quantity
-            }
-        )
+    holdings = holdings_query(user_id=user_data.id, session=session).all()
 
+    response = [holding._asdict() for holding in holdings]
     return response
 
 
-def calculate_portfolio_returns(user_data: UserResponse) -> Dict:
+def holdings_version_query(user_id: int, session: Session) -> Query:
+    """Builds the query of the count, the latest updated_on and the sum of the versions of a user's portfolios."""
+    return session.query(
+        func.count(Portfolio.id), func.max(Portfolio.updated_on), func.coalesce(func.sum(Portfolio.version), 0)
+    ).filter(Portfolio.user_id == user_id)
+
+
+def get_holdings_version(user_id: int, session: Session) -> Tuple[int, Optional[datetime], int]:
+    """Returns a version stamp of the user's holdings, every write to a portfolio moves its updated_on and version.
+
+    Args:
+        user_id (int): The user id.
+        session (Session): The db session.
+
+    Returns:
+        Tuple[int, Optional[datetime], int]: The number of portfolios, the latest updated_on and the sum of
+            the versions among them.
+    """
+    count, last_updated_on, versions = holdings_version_query(user_id=user_id, session=session).one()
+    return count, last_updated_on, versions
+
+
+async def cached_portfolio_data(user_data: UserResponse, session: Session, version: str) -> List:
+    """Read-through cached version of get_portfolio_data, shared across workers.
+
+    The entry is keyed by the version stamp read before loading, so a cached body is never older than
+    the stamp it is served under, and writes need no invalidation.
+
+    Args:
+        user_data (UserResponse): The user data.
+        session (Session): The db session.
+        version (str): The version stamp of the holdings, eg: their ETag.
+
+    Returns:
+        List: The list of portfolios.
+    """
+    async def load_portfolios() -> List:
+        return await run_db_call(get_portfolio_data, user_data=user_data, session=session)
+
+    return await read_through(PORTFOLIO_CACHE_KEY.format(user_data.id, version), load_portfolios)
+
+
+def returns_query(user_id: int, session: Session, breakdown: bool = False) -> Query:
+    """Builds the query of a user's total returns, or of the returns of every holding if `breakdown`."""
+    holding_returns = (Securities.current_price - Portfolio.average_buy_price) * Portfolio.quantity
+
+    if not breakdown:
+        # Let the database aggregate the returns in a single query.
+        return session.query(
+            func.coalesce(func.sum(holding_returns), 0.00)
+        ).select_from(Portfolio).join(
+            Securities, Portfolio.security_id == Securities.id
+        ).filter(Portfolio.user_id == user_id)
+
+    return session.query(
+        Portfolio.id.label("portfolio_id"),
+        Portfolio.security_id.label("security_id"),
+        Securities.ticker_symbol.label("ticker_symbol"),
+        Portfolio.average_buy_price.label("average_buy_price"),
+        Securities.current_price.label("current_price"),
+        Portfolio.quantity.label("quantity"),
+        holding_returns.label("returns")
+    ).join(
+        Securities, Portfolio.security_id == Securities.id
+    ).filter(Portfolio.user_id == user_id)
+
+
+def calculate_portfolio_returns(user_data: UserResponse, session: Session, breakdown: bool = False) -> Dict:
     """Calculates the total returns of the user's holdings.
 
     Args:
         user_data (UserResponse): The user data.
+        session (Session): The db session.
+        breakdown (bool, optional): Whether to include the returns of every holding. Defaults to False.
 
     Returns:
         Dict: The total returns dict.
     """
-    session = get_db_session()
-    portfolio_list: List[Portfolio] = session.query(Portfolio).filter(Portfolio.user_id == user_data.id).all()
+    if not breakdown:
+        total_returns = returns_query(user_id=user_data.id, session=session).scalar()
+        return {"total_returns": total_returns}
 
-    total_returns = 0.00
-    for portfolio in portfolio_list:
-        security: Securities = portfolio.security_data
-        total_returns += ((security.current_price - portfolio.average_buy_price) * portfolio.quantity)
+    holdings = returns_query(user_id=user_data.id, session=session, breakdown=True).all()
+    response = [holding._asdict() for holding in holdings]
+    total_returns = sum(holding["returns"] for holding in response)
 
-    return {"total_returns": total_returns}
+    return {"total_returns": total_returns, "holdings": response}
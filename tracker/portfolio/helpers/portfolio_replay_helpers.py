@@ -0,0 +1,225 @@
+"""Rebuilds portfolios from the transaction ledger, starting at the latest snapshot of every portfolio."""
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text, tuple_
+from sqlalchemy.orm import Query, Session
+
+from models.db_models import Portfolio, PortfolioSnapshot, Transaction
+from tracker.portfolio.helpers.portfolio_db_helpers import compute_portfolio_position
+from utils.constants import EXPORT_BATCH_SIZE, SNAPSHOT_INTERVAL
+
+
+# Every transaction of the user after the latest snapshot of its portfolio, in ledger order.
+LEDGER_AFTER_SNAPSHOTS = """
+    WITH latest_snapshots AS (
+        SELECT DISTINCT ON (snapshots.portfolio_id)
+            snapshots.portfolio_id, snapshots.transaction_created_on, snapshots.transaction_id
+        FROM portfolio_snapshots AS snapshots
+        JOIN portfolios ON portfolios.id = snapshots.portfolio_id
+        WHERE portfolios.user_id = %(user_id)s
+        ORDER BY snapshots.portfolio_id, snapshots.transaction_created_on DESC, snapshots.transaction_id DESC
+    )
+    SELECT transactions.portfolio_id, transactions.id, transactions.created_on, transactions.transaction_type,
+        transactions.transaction_amount, transactions.transaction_quantity
+    FROM transactions
+    JOIN portfolios ON portfolios.id = transactions.portfolio_id
+    LEFT JOIN latest_snapshots ON latest_snapshots.portfolio_id = transactions.portfolio_id
+    WHERE portfolios.user_id = %(user_id)s
+    AND (
+        latest_snapshots.portfolio_id IS NULL
+        OR (transactions.created_on, transactions.id)
+            > (latest_snapshots.transaction_created_on, latest_snapshots.transaction_id)
+    )
+    ORDER BY transactions.portfolio_id, transactions.created_on, transactions.id
+"""
+
+LATEST_SNAPSHOTS = """
+    SELECT DISTINCT ON (snapshots.portfolio_id)
+        snapshots.portfolio_id, snapshots.quantity, snapshots.average_buy_price
+    FROM portfolio_snapshots AS snapshots
+    JOIN portfolios ON portfolios.id = snapshots.portfolio_id
+    WHERE portfolios.user_id = :user_id
+    ORDER BY snapshots.portfolio_id, snapshots.transaction_created_on DESC, snapshots.transaction_id DESC
+"""
+
+
+def has_drifted(portfolio: Portfolio, quantity: int, average_buy_price: float) -> bool:
+    """Checks whether a stored portfolio differs from its replayed state.
+
+    The average buy price does not matter once nothing is held, a later BUY starts it afresh.
+    """
+    if portfolio.quantity != quantity:
+        return True
+    return bool(quantity) and abs(portfolio.average_buy_price - average_buy_price) >= 0.01
+
+
+def user_portfolios_query(user_id: int, session: Session, for_update: bool = False) -> Query:
+    """Builds the query of every portfolio of a user in id order, locked if `for_update`."""
+    query = session.query(Portfolio).filter(Portfolio.user_id == user_id).order_by(Portfolio.id)
+    if for_update:
+        query = query.with_for_update().populate_existing()
+    return query
+
+
+def snapshots_from_query(
+    portfolio_ids: List[int], created_on: datetime, transaction_id: int, session: Session
+) -> Query:
+    """Builds the query of the snapshots of the portfolios taken at or after the transaction (created_on, id)."""
+    return session.query(PortfolioSnapshot).filter(
+        PortfolioSnapshot.portfolio_id.in_(portfolio_ids),
+        tuple_(PortfolioSnapshot.transaction_created_on, PortfolioSnapshot.transaction_id)
+        >= tuple_(created_on, transaction_id)
+    )
+
+
+def replay_position_before(
+    portfolio_id: int, created_on: datetime, transaction_id: int, session: Session
+) -> Tuple[int, float]:
+    """Replays a portfolio's ledger up to, and excluding, the transaction (created_on, id).
+
+    Starts from the latest snapshot taken before that transaction, so only the transactions after it are read.
+
+    Args:
+        portfolio_id (int): The portfolio id.
+        created_on (datetime): The created_on of the first transaction not replayed.
+        transaction_id (int): The id of the first transaction not replayed.
+        session (Session): The db session.
+
+    Returns:
+        Tuple[int, float]: The quantity and average buy price held just before that transaction.
+    """
+    snapshot = session.query(
+        PortfolioSnapshot.transaction_created_on, PortfolioSnapshot.transaction_id,
+        PortfolioSnapshot.quantity, PortfolioSnapshot.average_buy_price
+    ).filter(
+        PortfolioSnapshot.portfolio_id == portfolio_id,
+        tuple_(PortfolioSnapshot.transaction_created_on, PortfolioSnapshot.transaction_id)
+        < tuple_(created_on, transaction_id)
+    ).order_by(
+        PortfolioSnapshot.transaction_created_on.desc(), PortfolioSnapshot.transaction_id.desc()
+    ).first()
+
+    query = session.query(
+        Transaction.transaction_type, Transaction.transaction_amount, Transaction.transaction_quantity
+    ).filter(
+        Transaction.portfolio_id == portfolio_id,
+        tuple_(Transaction.created_on, Transaction.id) < tuple_(created_on, transaction_id)
+    )
+    position: Tuple[int, float] = (0, 0.0)
+    if snapshot:
+        query = query.filter(
+            tuple_(Transaction.created_on, Transaction.id)
+            > tuple_(snapshot.transaction_created_on, snapshot.transaction_id)
+        )
+        position = (snapshot.quantity, snapshot.average_buy_price)
+
+    for transaction_type, amount, traded_quantity in query.order_by(
+        Transaction.created_on, Transaction.id
+    ).yield_per(EXPORT_BATCH_SIZE):
+        position = compute_portfolio_position(*position, transaction_type, amount, traded_quantity)
+    return position
+
+
+def invalidate_portfolio_snapshots(
+    portfolio_ids: List[int], created_on: datetime, transaction_id: int, session: Session
+):
+    """Drops the snapshots that include a transaction which is being changed or removed.
+
+    Does not commit, the caller owns the db transaction.
+
+    Args:
+        portfolio_ids (List[int]): The portfolios whose ledger changes.
+        created_on (datetime): The created_on of the oldest changed transaction.
+        transaction_id (int): The id of the oldest changed transaction.
+        session (Session): The db session.
+    """
+    snapshots_from_query(
+        portfolio_ids=portfolio_ids, created_on=created_on, transaction_id=transaction_id, session=session
+    ).delete(synchronize_session=False)
+
+
+def rebuild_user_portfolios(
+    user_id: int, session: Session, verify_only: bool = False, snapshot_interval: int = SNAPSHOT_INTERVAL
+) -> List[Dict]:
+    """Replays the ledger of every portfolio of a user and repairs the ones that have drifted.
+
+    The user's portfolios are locked for the duration of a repair. The transactions after the
+    latest snapshot of every portfolio are streamed with a server side cursor, and a new snapshot
+    is written every `snapshot_interval` transactions, so the next rebuild starts from there.
+
+    Args:
+        user_id (int): The user whose portfolios are rebuilt.
+        session (Session): The db session.
+        verify_only (bool, optional): Only report the drift, write nothing. Defaults to False.
+        snapshot_interval (int, optional): Transactions between two snapshots. Defaults to SNAPSHOT_INTERVAL.
+
+    Returns:
+        List[Dict]: The drifted portfolios with the stored and the replayed quantity and average buy price.
+    """
+    portfolios: Dict[int, Portfolio] = {
+        portfolio.id: portfolio
+        for portfolio in user_portfolios_query(user_id=user_id, session=session, for_update=not verify_only)
+    }
+    positions: Dict[int, Tuple[int, float]] = {
+        portfolio_id: (quantity, average_buy_price)
+        for portfolio_id, quantity, average_buy_price in session.execute(
+            text(LATEST_SNAPSHOTS), {"user_id": user_id}
+        )
+    }
+    new_snapshots: List[Dict] = []
+    replayed_count: Dict[int, int] = {}
+
+    cursor = session.connection().connection.cursor(name="portfolio_replay")
+    cursor.itersize = EXPORT_BATCH_SIZE
+    try:
+        cursor.execute(LEDGER_AFTER_SNAPSHOTS, {"user_id": user_id})
+        for portfolio_id, transaction_id, created_on, transaction_type, amount, traded_quantity in cursor:
+            quantity, average_buy_price = compute_portfolio_position(
+                *positions.get(portfolio_id, (0, 0.0)), transaction_type, amount, traded_quantity
+            )
+            positions[portfolio_id] = (quantity, average_buy_price)
+            replayed_count[portfolio_id] = replayed_count.get(portfolio_id, 0) + 1
+            if replayed_count[portfolio_id] % snapshot_interval == 0:
+                new_snapshots.append({
+                    "portfolio_id": portfolio_id,
+                    "transaction_id": transaction_id,
+                    "transaction_created_on": created_on,
+                    "quantity": quantity,
+                    "average_buy_price": average_buy_price,
+                    "created_on": datetime.now()
+                })
+    finally:
+        cursor.close()
+
+    drifted: List[Dict] = []
+    for portfolio_id, portfolio in portfolios.items():
+        quantity, average_buy_price = positions.get(portfolio_id, (0, 0.0))
+        if has_drifted(portfolio, quantity, average_buy_price):
+            drifted.append({
+                "portfolio_id": portfolio_id,
+                "security_id": portfolio.security_id,
+                "stored": (portfolio.quantity, portfolio.average_buy_price),
+                "replayed": (quantity, average_buy_price)
+            })
+
+    if verify_only:
+        session.rollback()
+        return drifted
+
+    if new_snapshots:
+        session.execute(PortfolioSnapshot.__table__.insert(), new_snapshots)
+    now = datetime.now()
+    for portfolio in drifted:
+        quantity, average_buy_price = portfolio["replayed"]
+        session.query(Portfolio).filter(Portfolio.id == portfolio["portfolio_id"]).update(
+            {
+                "quantity": quantity, "average_buy_price": average_buy_price, "version": Portfolio.version + 1,
+                "updated_on": now
+            },
+            synchronize_session=False
+        )
+    session.commit()
+
+    return drifted
+
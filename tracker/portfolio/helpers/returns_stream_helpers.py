@@ -0,0 +1,72 @@
+"""Pushes a user's returns to their open streams whenever the valuation index changes them."""
+import asyncio
+from collections import defaultdict
+from typing import Dict, Set
+
+from tracker.portfolio.helpers.valuation_index_helpers import ValuationIndex, get_valuation_index
+
+
+returns_broadcaster = None
+
+
+class ReturnsBroadcaster:
+    """Keeps the open streams of every user and publishes their returns from the valuation index.
+
+    Every stream has a queue of one event, a slow client skips to the latest returns.
+    """
+
+    def __init__(self, index: ValuationIndex):
+        self.index = index
+        self.streams: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+        index.on_change(self.publish)
+
+    async def subscribe(self, user_id: int) -> asyncio.Queue:
+        """Opens a stream for the user, its queue starts with the current returns.
+
+        Raises:
+            RuntimeError: If the index could not be loaded.
+        """
+        await self.index.ready.wait()
+        if not self.index.available:
+            raise RuntimeError(f"VALUATION_INDEX_UNAVAILABLE: {self.index.error}")
+        queue = asyncio.Queue(maxsize=1)
+        queue.put_nowait(self.index.returns(user_id, breakdown=True))
+        self.streams[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        self.streams[user_id].discard(queue)
+        if not self.streams[user_id]:
+            del self.streams[user_id]
+
+    def publish(self, user_ids: Set[int]):
+        for user_id in user_ids:
+            if user_id not in self.streams:
+                continue
+
+            returns = self.index.returns(user_id, breakdown=True)
+            for queue in self.streams[user_id]:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(returns)
+
+
+async def init_returns_broadcaster():
+    global returns_broadcaster
+
+    returns_broadcaster = ReturnsBroadcaster(get_valuation_index())
+
+
+async def close_returns_broadcaster():
+    global returns_broadcaster
+
+    returns_broadcaster = None
+
+
+def get_returns_broadcaster() -> ReturnsBroadcaster:
+    """Returns the broadcaster, creating one if init_returns_broadcaster has not run."""
+    global returns_broadcaster
+
+    if not returns_broadcaster:
+        returns_broadcaster = ReturnsBroadcaster(get_valuation_index())
+    return returns_broadcaster
@@ -0,0 +1,295 @@
+"""A process local index of every holding and every user's total returns, kept current by db notifications."""
+import asyncio
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from models.db_models import Portfolio, Securities
+from tracker.portfolio.helpers.portfolio_db_helpers import calculate_portfolio_returns
+from tracker.users.schemas.user_schemas import UserResponse
+from utils.constants import (
+    EXPORT_BATCH_SIZE, PORTFOLIO_CHANGES_CHANNEL, PRICE_CHANGES_CHANNEL, VALUATION_INDEX_MAX_RECONNECT_BACKOFF,
+    VALUATION_INDEX_RECONNECT_BACKOFF
+)
+from utils.database_utils import get_db_session, get_master_engine, run_db_call
+
+
+valuation_index = None
+
+
+def load_all_holdings(session: Session) -> Dict[int, Dict[int, Dict]]:
+    """Returns the holdings of every user with their returns, keyed by user id and security id."""
+    holdings: Dict[int, Dict[int, Dict]] = defaultdict(dict)
+    rows = session.query(
+        Portfolio.user_id, Portfolio.id, Portfolio.security_id, Securities.ticker_symbol,
+        Portfolio.average_buy_price, Securities.current_price, Portfolio.quantity
+    ).join(Securities, Portfolio.security_id == Securities.id).yield_per(EXPORT_BATCH_SIZE)
+
+    for user_id, portfolio_id, security_id, ticker_symbol, average_buy_price, current_price, quantity in rows:
+        holdings[user_id][security_id] = {
+            "portfolio_id": portfolio_id,
+            "security_id": security_id,
+            "ticker_symbol": ticker_symbol,
+            "average_buy_price": average_buy_price,
+            "current_price": current_price,
+            "quantity": quantity,
+            "returns": (current_price - average_buy_price) * quantity
+        }
+    return holdings
+
+
+def load_user_holdings(user_id: int) -> Dict[int, Dict]:
+    """Returns the user's holdings with their returns, keyed by security id."""
+    session = get_db_session()
+    try:
+        returns = calculate_portfolio_returns(user_data=UserResponse(id=user_id), session=session, breakdown=True)
+    finally:
+        session.close()
+    return {holding["security_id"]: holding for holding in returns["holdings"]}
+
+
+def load_with_new_session() -> Dict[int, Dict[int, Dict]]:
+    session = get_db_session()
+    try:
+        return load_all_holdings(session)
+    finally:
+        session.close()
+
+
+class ValuationIndex:
+    """The holdings of every user, indexed by security id, with every user's total returns.
+
+    A dedicated connection LISTENs on PRICE_CHANGES_CHANNEL and PORTFOLIO_CHANGES_CHANNEL. A price change
+    moves the total of every holder by the price delta times their quantity, a portfolio change reloads
+    the holdings of that user only. The latest notified price of every security is kept and wins over
+    a load that started before it was committed.
+
+    If the connection is lost the index is unavailable until it has reconnected and loaded again, as
+    the notifications sent meanwhile are lost. Readers fall back to the database until then.
+    """
+
+    def __init__(self):
+        self.holdings: Dict[int, Dict[int, Dict]] = {}
+        self.holders: Dict[int, Dict[int, Dict]] = defaultdict(dict)
+        self.totals: Dict[int, float] = {}
+        self.prices: Dict[int, float] = {}
+        # Set once the first load has finished or failed, `available` tells which.
+        self.ready = asyncio.Event()
+        self.available = False
+        self.error: Optional[Exception] = None
+        self.generation = 0
+        self.pending_users: Set[int] = set()
+        self.stale_users: Set[int] = set()
+        self.user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.listeners: List[Callable[[Set[int]], None]] = []
+        self.connection = None
+        self.disconnected = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Connects, starts listening and loads the index in the background."""
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def on_change(self, listener: Callable[[Set[int]], None]):
+        """Calls `listener` with the ids of the users whose returns changed."""
+        self.listeners.append(listener)
+
+    def is_current(self, user_id: int) -> bool:
+        """Whether the returns of the user can be served from the index."""
+        return self.available and user_id not in self.stale_users
+
+    async def run(self):
+        """Listens and loads the index, then reconnects and reloads it with a backoff whenever that fails."""
+        backoff = VALUATION_INDEX_RECONNECT_BACKOFF
+        while True:
+            try:
+                await run_in_threadpool(self.connect)
+                asyncio.get_event_loop().add_reader(self.connection.fileno(), self.receive_notifications)
+                # Notifications received while loading are kept, the LISTEN has to come first.
+                await self.load()
+                backoff = VALUATION_INDEX_RECONNECT_BACKOFF
+                await self.disconnected.wait()
+            except Exception as e:
+                print("Exception Raised: ", e)
+                self.error = e
+            finally:
+                self.available = False
+                self.disconnect()
+                self.ready.set()
+
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, VALUATION_INDEX_MAX_RECONNECT_BACKOFF)
+
+    def connect(self):
+        engine = get_master_engine()
+        connect_args, connect_kwargs = engine.dialect.create_connect_args(engine.url)
+        connection = psycopg2.connect(*connect_args, **connect_kwargs)
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {PRICE_CHANGES_CHANNEL}")
+            cursor.execute(f"LISTEN {PORTFOLIO_CHANGES_CHANNEL}")
+        self.connection = connection
+        self.disconnected.clear()
+
+    def disconnect(self):
+        """Stops reading the listening connection and closes it."""
+        if self.connection is None:
+            return
+
+        connection, self.connection = self.connection, None
+        try:
+            asyncio.get_event_loop().remove_reader(connection.fileno())
+            connection.close()
+        except Exception as e:
+            print("Exception Raised: ", e)
+        self.disconnected.set()
+
+    async def load(self):
+        """Replaces the whole index with the holdings in the database."""
+        self.generation += 1
+        self.prices = {}
+        holdings = await run_db_call(load_with_new_session)
+
+        changed_users = set(self.holdings) | set(holdings)
+        self.holdings, self.holders, self.totals = {}, defaultdict(dict), {}
+        for user_id, user_holdings in holdings.items():
+            self.set_holdings(user_id, user_holdings)
+        self.stale_users = set()
+        self.available = True
+        self.error = None
+        self.ready.set()
+
+        pending_users, self.pending_users = self.pending_users, set()
+        for user_id in pending_users:
+            await self.reload_user(user_id)
+        # The returns may have changed while the index was unavailable.
+        self.notify_listeners(changed_users)
+
+    async def reload_user(self, user_id: int):
+        """Reloads the holdings of the user, on a notification that one of their portfolios changed.
+
+        Reloads of a user run one at a time, so an older read never replaces a newer one. A reload started
+        before a full load is dropped, the load has read the holdings after it. The user is served from the
+        database while the reload keeps failing.
+
+        Args:
+            user_id (int): The user whose portfolio changed.
+        """
+        if not self.available:
+            self.pending_users.add(user_id)
+            return
+
+        async with self.user_locks[user_id]:
+            generation = self.generation
+            try:
+                holdings = await run_db_call(load_user_holdings, user_id)
+            except Exception as e:
+                print("Exception Raised: ", e)
+                self.stale_users.add(user_id)
+                return
+
+            if generation != self.generation:
+                return
+            self.stale_users.discard(user_id)
+            self.set_holdings(user_id, holdings)
+        self.notify_listeners({user_id})
+
+    def set_holdings(self, user_id: int, holdings: Dict[int, Dict]):
+        for security_id in self.holdings.pop(user_id, {}):
+            self.holders[security_id].pop(user_id, None)
+
+        for security_id, holding in holdings.items():
+            price = self.prices.setdefault(security_id, holding["current_price"])
+            holding["current_price"] = price
+            holding["returns"] = (price - holding["average_buy_price"]) * holding["quantity"]
+            self.holders[security_id][user_id] = holding
+        self.holdings[user_id] = holdings
+        self.totals[user_id] = sum(holding["returns"] for holding in holdings.values())
+
+    def apply_prices(self, prices: Dict[int, float]) -> Set[int]:
+        """Adjusts the holdings of the securities in `prices` and their holders' totals, returns the holders."""
+        affected_users = set()
+        for security_id, price in prices.items():
+            self.prices[security_id] = price
+            for user_id, holding in self.holders.get(security_id, {}).items():
+                delta = (price - holding["current_price"]) * holding["quantity"]
+                holding["current_price"] = price
+                holding["returns"] += delta
+                self.totals[user_id] += delta
+                affected_users.add(user_id)
+        return affected_users
+
+    def returns(self, user_id: int, breakdown: bool = False) -> Dict:
+        """The user's returns in the format of calculate_portfolio_returns."""
+        if not breakdown:
+            return {"total_returns": self.totals.get(user_id, 0.00)}
+
+        holdings = [dict(holding) for holding in self.holdings.get(user_id, {}).values()]
+        return {"total_returns": self.totals.get(user_id, 0.00), "holdings": holdings}
+
+    def notify_listeners(self, user_ids: Set[int]):
+        for listener in self.listeners:
+            try:
+                listener(user_ids)
+            except Exception as e:
+                print("Exception Raised: ", e)
+
+    def receive_notifications(self):
+        prices: Dict[int, float] = {}
+        try:
+            self.connection.poll()
+            while self.connection.notifies:
+                notification = self.connection.notifies.pop(0)
+                if notification.channel == PRICE_CHANGES_CHANNEL:
+                    security_id, price = notification.payload.split(":")
+                    prices[int(security_id)] = float(price)
+                else:
+                    asyncio.ensure_future(self.reload_user(int(notification.payload)))
+        except Exception as e:
+            # The connection is gone, `run` reconnects and reloads the index.
+            print("Exception Raised: ", e)
+            self.error = e
+            self.available = False
+            self.disconnect()
+
+        if prices:
+            affected_users = self.apply_prices(prices)
+            if affected_users:
+                self.notify_listeners(affected_users)
+
+
+async def init_valuation_index():
+    """Starts listening for changes and loads the index in the background."""
+    global valuation_index
+
+    valuation_index = ValuationIndex()
+    valuation_index.start()
+
+
+async def close_valuation_index():
+    global valuation_index
+
+    if valuation_index:
+        await valuation_index.stop()
+        valuation_index = None
+
+
+def get_valuation_index() -> ValuationIndex:
+    """Returns the running index, starting one if init_valuation_index has not run."""
+    global valuation_index
+
+    if not valuation_index:
+        valuation_index = ValuationIndex()
+        valuation_index.start()
+    return valuation_index
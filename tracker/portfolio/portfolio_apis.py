@@ -1,8 +1,9 @@
 from typing import List
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 
-from tracker.portfolio.handlers.portfolio_handler import get_portfolio, get_returns
-from tracker.portfolio.schemas.portfolio_schemas import PortfolioDataSchema
+from tracker.portfolio.handlers.portfolio_handler import get_portfolio, get_returns, stream_returns
+from tracker.portfolio.schemas.portfolio_schemas import PortfolioDataSchema, PortfolioReturnsSchema
 from utils.constants import BASE_RESPONSE_STATUS_CODES
 
 
@@ -14,5 +15,9 @@ portfolio_v1_apis = APIRouter(
 
 # Returns all the holdings the user has.
 portfolio_v1_apis.add_api_route("/holdings", get_portfolio, response_model=List[PortfolioDataSchema], methods=["GET"])
-# Returns the total return amount user has.
-portfolio_v1_apis.add_api_route("/returns", get_returns, methods=["GET"])
+# Returns the total return amount user has. Takes an optional input breakdown for per holding returns.
+portfolio_v1_apis.add_api_route(
+    "/returns", get_returns, response_model=PortfolioReturnsSchema, response_model_exclude_none=True, methods=["GET"]
+)
+# Streams the total and per holding returns as server-sent events whenever they change. Takes an access token.
+portfolio_v1_apis.add_api_route("/returns/stream", stream_returns, response_class=StreamingResponse, methods=["GET"])
@@ -1,3 +1,5 @@
+from typing import List, Optional
+
 from pydantic import BaseModel
 
 
@@ -8,3 +10,19 @@ class PortfolioDataSchema(BaseModel):
     ticker_symbol: str = ""
     average_buy_price: float = 0.00
     total_available_quantity: int = 0
+
+
+class HoldingReturnSchema(BaseModel):
+    """The returns of a single holding."""
+    portfolio_id: int = 0
+    ticker_symbol: str = ""
+    average_buy_price: float = 0.00
+    current_price: float = 0.00
+    quantity: int = 0
+    returns: float = 0.00
+
+
+class PortfolioReturnsSchema(BaseModel):
+    """The total returns with an optional per holding breakdown."""
+    total_returns: float = 0.00
+    holdings: Optional[List[HoldingReturnSchema]] = None
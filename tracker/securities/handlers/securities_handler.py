@@ -1,18 +1,33 @@
 from typing import List
 
-from fastapi import Depends, HTTPException
-
-from tracker.securities.schemas.security_schemas import BaseResponse, SecurityCreate, SecurityResponse, SecurityUpdate
-from tracker.securities.helpers.security_db_helpers import add_securities, get_security_details, update_securities
-from tracker.users.handlers.user_handler import authorise_user
-
-
-async def create_security(security_data: List[SecurityCreate], user = Depends(authorise_user)) -> BaseResponse:
+from fastapi import Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from sqlalchemy.orm import Session
+
+from tracker.securities.schemas.security_schemas import (
+    BaseResponse, PriceTick, PriceUpdateResponse, SecurityCreate, SecurityResponse, SecurityUpdate,
+    UpsertSecuritiesResponse
+)
+from tracker.securities.helpers.price_tick_helpers import get_price_coalescer
+from tracker.securities.helpers.security_db_helpers import (
+    add_securities, copy_security_prices, search_securities, update_securities, upsert_securities
+)
+from tracker.securities.helpers.security_master_helpers import get_security_master
+from tracker.users.handlers.user_handler import authorise_request
+from tracker.users.helpers.user_utils import verify_access_token
+from utils.constants import MAX_PAGE_SIZE, SECURITY_SEARCH_PAGE_SIZE
+from utils.database_utils import get_session, run_db_call
+from utils.etag_utils import etag_headers, etag_matches, make_etag, not_modified
+
+
+async def create_security(
+    security_data: List[SecurityCreate], user = Depends(authorise_request), session: Session = Depends(get_session)
+) -> BaseResponse:
     """Handler function that creates a security (share, fund, etc.)
 
     Args:
         security_data (List[SecurityCreate]): The list of securities to be added.
-        user (User, optional): The user details who is adding to the database. Defaults to Depends(authorise_user).
+        user (User, optional): The user details who is adding to the database. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Raises:
         HTTPException: If faiiled to add data to database.
@@ -23,21 +38,66 @@ async def create_security(security_data: List[SecurityCreate], user = Depends(au
     Returns:
         BaseResponse (Dict): The response.
     """
-    success, status_code, message = add_securities(security_data=security_data, user_data=user)
+    success, status_code, message = await run_db_call(
+        add_securities, security_data=security_data, user_data=user, session=session
+    )
     if not success:
         raise HTTPException(status_code=status_code, detail=message)
+    await get_security_master().refresh_now()
     return {
         "success": success,
         "message": message
     }
 
 
-async def update_security(updating_data: List[SecurityUpdate], user = Depends(authorise_user)) -> BaseResponse:
+async def upsert_security(
+    security_data: List[SecurityCreate], update_existing: bool = True, user = Depends(authorise_request),
+    session: Session = Depends(get_session)
+) -> UpsertSecuritiesResponse:
+    """Handler function that creates the new securities and updates or skips the existing ones, eg: an exchange master.
+
+    Args:
+        security_data (List[SecurityCreate]): The list of securities to be added.
+        update_existing (bool, optional): Update the securities already present instead of skipping them.
+            Defaults to True.
+        user (User, optional): The user details who is adding to the database. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
+
+    Raises:
+        HTTPException: If every chunk failed.
+
+    Returns:
+        UpsertSecuritiesResponse (Dict): The counts and the status of every ticker.
+    """
+    success, status_code, message, results = await run_db_call(
+        upsert_securities, security_data=security_data, user_data=user, session=session,
+        update_existing=update_existing
+    )
+    if not success:
+        raise HTTPException(status_code=status_code, detail=message)
+    await get_security_master().refresh_now()
+
+    statuses = [result["status"] for result in results]
+    return {
+        "success": success,
+        "message": message,
+        "created": statuses.count("CREATED"),
+        "updated": statuses.count("UPDATED"),
+        "skipped": statuses.count("SKIPPED"),
+        "failed": statuses.count("FAILED"),
+        "results": results
+    }
+
+
+async def update_security(
+    updating_data: List[SecurityUpdate], user = Depends(authorise_request), session: Session = Depends(get_session)
+) -> BaseResponse:
     """The handler function that updates the current price of the security defined.
 
     Args:
         updating_data (List[SecurityUpdate]): The list of securites to be updated alongwith the current_price.
-        user (User, optional): The user data who is updating. Defaults to Depends(authorise_user).
+        user (User, optional): The user data who is updating. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Raises:
         HTTPException: If any internal server error occurs.
@@ -45,23 +105,134 @@ async def update_security(updating_data: List[SecurityUpdate], user = Depends(au
     Returns:
         BaseResponse (Dict): The success response if data updated successfully.
     """
-    success, status_code, message = update_securities(update_data=updating_data, user_data=user)
+    success, status_code, message = await run_db_call(
+        update_securities, update_data=updating_data, user_data=user, session=session
+    )
     if not success:
         raise HTTPException(status_code=status_code, detail=message)
+    await get_security_master().refresh_now()
     return {
         "success": success,
         "message": message
     }
 
 
-async def security_listing(ticker_symbol: str = "") -> List[SecurityResponse]:
-    """The handler that lists all the active securities in the database.
+async def update_prices(
+    updating_data: List[SecurityUpdate], user = Depends(authorise_request), session: Session = Depends(get_session)
+) -> PriceUpdateResponse:
+    """The handler that updates the current price of many securities at once, eg: an end of day price file.
+
+    Args:
+        updating_data (List[SecurityUpdate]): The list of securites to be updated alongwith the current_price.
+        user (User, optional): The user data who is updating. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
+
+    Raises:
+        HTTPException: If any internal server error occurs.
+
+    Returns:
+        PriceUpdateResponse (Dict): The number of securities updated and the ids that matched no security.
+    """
+    success, status_code, message, report = await run_db_call(
+        copy_security_prices, update_data=updating_data, user_data=user, session=session
+    )
+    if not success:
+        raise HTTPException(status_code=status_code, detail=message)
+    await get_security_master().refresh_now()
+    return {
+        "success": success,
+        "message": message,
+        **report
+    }
+
+
+async def security_listing(request: Request, response: Response, ticker_symbol: str = "") -> List[SecurityResponse]:
+    """The handler that lists all the active securities, served from the in-process security master.
+
+    The ETag is derived from a hash of the content of the security master, a matching If-None-Match is
+    answered with a 304 without building the listing.
 
     Args:
+        request (Request): The request.
+        response (Response): The response, used to set the ETag.
         ticker_symbol (str, optional): The ticker symbol. Eg: TCS. Defaults to "".
 
     Returns:
         SecurityResponse (List): The list of all the securities alongwith its data.
     """
-    response: List = get_security_details(ticker_symbol=ticker_symbol)
-    return response
+    security_master = get_security_master()
+    etag = make_etag(security_master.content_hash)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    response.headers.update(etag_headers(etag))
+    securities: List = security_master.active_securities(ticker_symbol=ticker_symbol)
+    return securities
+
+
+async def security_search(
+    query: str = Query(..., min_length=1), fuzzy: bool = False,
+    limit: int = Query(SECURITY_SEARCH_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+    session: Session = Depends(get_session)
+) -> List[SecurityResponse]:
+    """The handler that searches the active securities by ticker symbol and name, eg: for a type-ahead.
+
+    Prefix searches are served from the trie of the in-process security master. Fuzzy searches run on
+    the pg_trgm indexes, and fall back to the prefix search if the database can't serve them.
+
+    Args:
+        query (str): The text typed. Eg: TC.
+        fuzzy (bool, optional): Also match similar tickers and names, eg: TSC for TCS. Defaults to False.
+        limit (int, optional): The page size. Defaults to SECURITY_SEARCH_PAGE_SIZE.
+        offset (int, optional): The number of results to skip. Defaults to 0.
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
+
+    Returns:
+        SecurityResponse (List): The page of matching securities, best matches first.
+    """
+    if fuzzy:
+        try:
+            securities: List = await run_db_call(
+                search_securities, query=query, session=session, limit=limit, offset=offset
+            )
+            return securities
+        except Exception as e:
+            print("Exception Raised: ", e)
+
+    return get_security_master().search(prefix=query, limit=limit, offset=offset)
+
+
+async def price_ticks(websocket: WebSocket, token: str = ""):
+    """Receives a live feed of prices, eg: {"ticker_symbol": "TCS", "price": 3542.01} or a list of them.
+
+    The ticks are coalesced per ticker and written to the database every PRICE_TICK_FLUSH_INTERVAL_MS,
+    the last tick of a ticker wins. Invalid ticks are answered with an error message and skipped.
+
+    Args:
+        websocket (WebSocket): The websocket connection.
+        token (str, optional): An access token, if not sent as an `Authorization: Bearer` header. Defaults to "".
+    """
+    authorization = websocket.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    user = verify_access_token(token) if token else None
+    if not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    coalescer = get_price_coalescer()
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+                ticks = [PriceTick(**tick) for tick in (message if isinstance(message, list) else [message])]
+            except (TypeError, ValueError):
+                # Malformed json, or a tick failing validation.
+                await websocket.send_json({"success": False, "message": "INVALID_TICK"})
+                continue
+
+            for tick in ticks:
+                coalescer.add(ticker_symbol=tick.ticker_symbol, price=tick.price, user_id=user["id"])
+    except WebSocketDisconnect:
+        pass
@@ -0,0 +1,92 @@
+"""Coalesces live price ticks in memory and writes them to the securities table on an interval."""
+import asyncio
+from typing import Dict, Optional, Tuple
+
+from tracker.securities.helpers.security_db_helpers import update_security_prices
+from tracker.securities.helpers.security_master_helpers import get_security_master
+from utils.constants import PRICE_TICK_FLUSH_INTERVAL_MS
+from utils.database_utils import get_db_session, run_db_call
+
+
+price_coalescer = None
+
+
+class PriceTickCoalescer:
+    """Keeps the latest price of every ticker and flushes them every `flush_interval_ms`.
+
+    Only the last tick of a ticker within an interval is written, so the database sees at most one
+    update per ticker per interval however fast the feed is.
+    """
+
+    def __init__(self, flush_interval_ms: int = PRICE_TICK_FLUSH_INTERVAL_MS):
+        self.flush_interval_ms = flush_interval_ms
+        self.pending: Dict[str, Tuple[float, int]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, ticker_symbol: str, price: float, user_id: int):
+        self.pending[ticker_symbol] = (price, user_id)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Stops the flush loop and writes the ticks still pending."""
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_ms / 1000)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+
+        prices, self.pending = self.pending, {}
+        try:
+            await run_db_call(self.write_prices, prices)
+        except Exception as e:
+            print("Exception Raised: ", e)
+            # Put the batch back for the next flush, a tick that came in since is newer and wins.
+            for ticker_symbol, tick in prices.items():
+                self.pending.setdefault(ticker_symbol, tick)
+            return
+        await get_security_master().refresh_now()
+
+    @staticmethod
+    def write_prices(prices: Dict[str, Tuple[float, int]]) -> int:
+        session = get_db_session()
+        try:
+            return update_security_prices(prices=prices, session=session)
+        finally:
+            session.close()
+
+
+async def init_price_coalescer():
+    global price_coalescer
+
+    price_coalescer = PriceTickCoalescer()
+    price_coalescer.start()
+
+
+async def close_price_coalescer():
+    global price_coalescer
+
+    if price_coalescer:
+        await price_coalescer.stop()
+        price_coalescer = None
+
+
+def get_price_coalescer() -> PriceTickCoalescer:
+    """Returns the running coalescer, starting one if init_price_coalescer has not run."""
+    global price_coalescer
+
+    if not price_coalescer:
+        price_coalescer = PriceTickCoalescer()
+        price_coalescer.start()
+    return price_coalescer
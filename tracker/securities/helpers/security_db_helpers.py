@@ -1,19 +1,57 @@
+import csv
+import io
 from datetime import datetime
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+
+from psycopg2.extras import execute_values
+from sqlalchemy import case, func, literal_column, or_, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Query, Session
 
 from models.db_models import Securities
 from tracker.securities.schemas.security_schemas import SecurityCreate, SecurityUpdate
 from tracker.users.schemas.user_schemas import UserResponse
-from utils.constants import INTERNAL_SERVER_ERROR, SUCCESS_STATUS_CODE, UNPROCESSABLE_ENTITY
-from utils.database_utils import get_db_session
-
-
-def get_security_tickers(ticker_list: List[str], session = get_db_session()) -> List:
+from utils.constants import (
+    BULK_INSERT_CHUNK_SIZE, INTERNAL_SERVER_ERROR, SECURITY_SEARCH_PAGE_SIZE, SUCCESS_STATUS_CODE, UNPROCESSABLE_ENTITY
+)
+
+
+CREATE_PRICE_STAGING_TABLE = """
+    CREATE TEMP TABLE security_price_staging (
+        row_number bigserial,
+        id integer,
+        current_price double precision
+    ) ON COMMIT DROP
+"""
+
+COPY_INTO_PRICE_STAGING = "COPY security_price_staging (id, current_price) FROM STDIN WITH (FORMAT csv)"
+
+# When an id is sent more than once, the last price sent wins.
+APPLY_STAGED_PRICES = """
+    UPDATE securities
+    SET current_price = prices.current_price, updated_on = :now, updated_by = :user_id
+    FROM (
+        SELECT DISTINCT ON (id) id, current_price
+        FROM security_price_staging
+        ORDER BY id, row_number DESC
+    ) AS prices
+    WHERE securities.id = prices.id
+"""
+
+UNKNOWN_STAGED_IDS = """
+    SELECT DISTINCT staging.id
+    FROM security_price_staging AS staging
+    WHERE NOT EXISTS (SELECT 1 FROM securities WHERE securities.id = staging.id)
+    ORDER BY staging.id
+"""
+
+
+def get_security_tickers(ticker_list: List[str], session: Session) -> List:
     """Returns a lits of securities based on the list of ticker_symbols provided.
 
     Args:
         ticker_list (List[str]): The list of ticker_symbol for which data is required.
-        session ([type], optional): A db session object. Defaults to get_db_session().
+        session (Session): The db session.
 
     Returns:
         List: The list of securities for the tickers mentioned.
@@ -54,12 +92,15 @@ def model_bulk_securities(security_data: List[SecurityCreate], user_id: int) ->
     return bulk_securities
 
 
-def add_securities(security_data: List[SecurityCreate], user_data: UserResponse) -> Tuple[bool, int, str]:
+def add_securities(
+    security_data: List[SecurityCreate], user_data: UserResponse, session: Session
+) -> Tuple[bool, int, str]:
     """The main function that adds the new list of securities to the database.
 
     Args:
         security_data (List[SecurityCreate]): The list of new securities that needs to be added.
         user_data (UserResponse): The details of User performing the operation.
+        session (Session): The db session.
 
     Returns:
         Tuple[bool, int, str]: A tuple of success, status_code and the message.
@@ -68,7 +109,6 @@ def add_securities(security_data: List[SecurityCreate], user_data: UserResponse)
     status_code: int = SUCCESS_STATUS_CODE
     message: str = "DATA_ADDED_SUCCESSFULLY"
 
-    session = get_db_session()
     ticker_list = [security.ticker_symbol for security in security_data]
     security_list: List[Securities] = get_security_tickers(ticker_list, session)
 
@@ -95,6 +135,146 @@ def add_securities(security_data: List[SecurityCreate], user_data: UserResponse)
     return (success, status_code, message)
 
 
+def upsert_security_chunk(rows: List[Dict], update_existing: bool, session: Session) -> Dict[str, str]:
+    """Inserts a chunk of securities with one INSERT ... ON CONFLICT ... RETURNING.
+
+    Args:
+        rows (List[Dict]): The securities, at most one per ticker symbol.
+        update_existing (bool): Update the securities already present instead of skipping them.
+        session (Session): The db session.
+
+    Returns:
+        Dict[str, str]: The created or updated tickers, the skipped ones are not returned.
+    """
+    securities = Securities.__table__
+    upsert = insert(securities).values(rows)
+    if update_existing:
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[securities.c.ticker_symbol],
+            set_={
+                "name": upsert.excluded.name,
+                "current_price": upsert.excluded.current_price,
+                "is_active": upsert.excluded.is_active,
+                "updated_on": upsert.excluded.updated_on,
+                "updated_by": upsert.excluded.updated_by
+            },
+            # Unchanged securities are skipped, and keep their updated_on.
+            where=or_(
+                securities.c.name.is_distinct_from(upsert.excluded.name),
+                securities.c.current_price.is_distinct_from(upsert.excluded.current_price),
+                securities.c.is_active.is_distinct_from(upsert.excluded.is_active)
+            )
+        )
+    else:
+        # Without a conflict target, a name taken by another ticker is skipped as well.
+        upsert = upsert.on_conflict_do_nothing()
+
+    # xmax is only 0 for a row version created by an insert.
+    returned = session.execute(
+        upsert.returning(securities.c.ticker_symbol, literal_column("xmax = 0").label("created"))
+    )
+    return {row.ticker_symbol: "CREATED" if row.created else "UPDATED" for row in returned}
+
+
+def stamp_rows(rows: List[Dict], now: datetime):
+    for row in rows:
+        row["created_on"] = now
+        row["updated_on"] = now
+
+
+def upsert_security_rows(rows: List[Dict], update_existing: bool, session: Session) -> Dict[str, str]:
+    """Upserts the securities one at a time, each in its own savepoint, and commits the ones that were written.
+
+    The fallback of a chunk that failed as a whole, only the securities that fail on their own are rolled back.
+
+    Args:
+        rows (List[Dict]): The securities, at most one per ticker symbol.
+        update_existing (bool): Update the securities already present instead of skipping them.
+        session (Session): The db session.
+
+    Returns:
+        Dict[str, str]: The created, updated or failed tickers, the skipped ones are not returned.
+    """
+    written: Dict[str, str] = {}
+    for row in rows:
+        stamp_rows([row], datetime.now())
+        savepoint = session.begin_nested()
+        try:
+            written.update(upsert_security_chunk([row], update_existing=update_existing, session=session))
+            savepoint.commit()
+        except Exception as e:
+            print("Exception Raised: ", e)
+            savepoint.rollback()
+            written[row["ticker_symbol"]] = "FAILED"
+
+    try:
+        session.commit()
+    except Exception as e:
+        print("Exception Raised: ", e)
+        session.rollback()
+        written = {row["ticker_symbol"]: "FAILED" for row in rows}
+    return written
+
+
+def upsert_securities(
+    security_data: List[SecurityCreate], user_data: UserResponse, session: Session, update_existing: bool = True
+) -> Tuple[bool, int, str, List[Dict]]:
+    """Creates the new securities and updates or skips the ones already present, in chunks.
+
+    Every chunk of BULK_INSERT_CHUNK_SIZE securities is a single statement, stamped with the time it
+    is written and committed on its own, so a catalog load of any size holds its locks for one chunk
+    at a time and every chunk is picked up by the next refresh of the security master. A chunk that fails,
+    eg: on a name already taken by another ticker, is rolled back and retried a security at a time,
+    so only the securities that fail on their own are reported as FAILED.
+
+    Args:
+        security_data (List[SecurityCreate]): The securities, if a ticker is sent twice the last one wins.
+        user_data (UserResponse): The details of User performing the operation.
+        session (Session): The db session.
+        update_existing (bool, optional): Update the securities already present instead of skipping them.
+            Defaults to True.
+
+    Returns:
+        Tuple[bool, int, str, List[Dict]]: A tuple of success, status_code, message and the status of every
+            ticker, CREATED, UPDATED, SKIPPED or FAILED.
+    """
+    user_data = UserResponse(**user_data)
+    rows: Dict[str, Dict] = {}
+    for security in security_data:
+        ticker_symbol = security.ticker_symbol.upper()
+        rows[ticker_symbol] = {
+            "name": security.name.upper(),
+            "ticker_symbol": ticker_symbol,
+            "current_price": security.current_price,
+            "is_active": security.is_active,
+            "updated_by": user_data.id
+        }
+
+    tickers = list(rows)
+    statuses: Dict[str, str] = {}
+    for start in range(0, len(tickers), BULK_INSERT_CHUNK_SIZE):
+        chunk = [rows[ticker_symbol] for ticker_symbol in tickers[start:start + BULK_INSERT_CHUNK_SIZE]]
+        # Stamped when written, the security master only re-reads SECURITY_MASTER_REFRESH_OVERLAP back.
+        stamp_rows(chunk, datetime.now())
+        try:
+            written = upsert_security_chunk(chunk, update_existing=update_existing, session=session)
+            session.commit()
+        except Exception as e:
+            print("Exception Raised: ", e)
+            session.rollback()
+            written = upsert_security_rows(chunk, update_existing=update_existing, session=session)
+
+        for row in chunk:
+            statuses[row["ticker_symbol"]] = written.get(row["ticker_symbol"], "SKIPPED")
+
+    results = [{"ticker_symbol": ticker_symbol, "status": status} for ticker_symbol, status in statuses.items()]
+    failed = sum(status == "FAILED" for status in statuses.values())
+    if failed == len(statuses) and failed:
+        return False, INTERNAL_SERVER_ERROR, "INTERNAL_SERVER_ERROR", results
+    message = f"{failed}_SECURITIES_FAILED" if failed else "DATA_ADDED_SUCCESSFULLY"
+    return True, SUCCESS_STATUS_CODE, message, results
+
+
 def model_bulk_update(update_data: List[SecurityUpdate], user_id: int) -> List:
     """Created a list of objects that needs to be updated in the database.
 
@@ -118,12 +298,15 @@ def model_bulk_update(update_data: List[SecurityUpdate], user_id: int) -> List:
     return bulk_securities
 
 
-def update_securities(update_data: List[SecurityUpdate], user_data: UserResponse) -> Tuple[bool, int, str]:
+def update_securities(
+    update_data: List[SecurityUpdate], user_data: UserResponse, session: Session
+) -> Tuple[bool, int, str]:
     """The main function that performs the update operation on the database.
 
     Args:
         update_data (List[SecurityUpdate]): The list of data that needs to be updated.
         user_data (UserResponse): The details of user updating the data.
+        session (Session): The db session.
 
     Returns:
         Tuple[bool, int, str]: A tuple of success, status_code and the message.
@@ -132,7 +315,6 @@ def update_securities(update_data: List[SecurityUpdate], user_data: UserResponse
     status_code: int = SUCCESS_STATUS_CODE
     message: str = "DATA_ADDED_SUCCESSFULLY"
 
-    session = get_db_session()
     # Model the user data.
     user_data = UserResponse(**user_data)
     # Models the received payload into the final updated columns.
@@ -147,10 +329,96 @@ def update_securities(update_data: List[SecurityUpdate], user_data: UserResponse
         success = False
         status_code = INTERNAL_SERVER_ERROR
         message = "INTERNAL_SERVER_ERROR"
+        session.rollback()
 
     return (success, status_code, message)
 
 
+def copy_security_prices(
+    update_data: List[SecurityUpdate], user_data: UserResponse, session: Session
+) -> Tuple[bool, int, str, Dict]:
+    """Updates the price of many securities with COPY into a temp table and a single UPDATE ... FROM.
+
+    Args:
+        update_data (List[SecurityUpdate]): The ids and the new prices.
+        user_data (UserResponse): The details of user updating the data.
+        session (Session): The db session.
+
+    Returns:
+        Tuple[bool, int, str, Dict]: A tuple of success, status_code, message and a report of the
+            updated count and the ids that matched no security.
+    """
+    report = {"updated": 0, "unknown_ids": []}
+    user_data = UserResponse(**user_data)
+
+    payload = io.StringIO()
+    writer = csv.writer(payload)
+    for security in update_data:
+        writer.writerow((security.id, security.current_price))
+    payload.seek(0)
+
+    try:
+        session.execute(text(CREATE_PRICE_STAGING_TABLE))
+        with session.connection().connection.cursor() as cursor:
+            cursor.copy_expert(COPY_INTO_PRICE_STAGING, payload)
+        report["updated"] = session.execute(
+            text(APPLY_STAGED_PRICES), {"now": datetime.now(), "user_id": user_data.id}
+        ).rowcount
+        report["unknown_ids"] = [row.id for row in session.execute(text(UNKNOWN_STAGED_IDS))]
+        session.commit()
+    except Exception as e:
+        print("Exception Raised: ", e)
+        session.rollback()
+        return False, INTERNAL_SERVER_ERROR, "INTERNAL_SERVER_ERROR", {"updated": 0, "unknown_ids": []}
+
+    return True, SUCCESS_STATUS_CODE, "DATA_UPDATED_SUCCESSFULLY", report
+
+
+def update_security_prices(prices: Dict[str, Tuple[float, int]], session: Session) -> int:
+    """Writes the latest price of many securities with a single UPDATE ... FROM (VALUES ...) statement.
+
+    Args:
+        prices (Dict[str, Tuple[float, int]]): The price and the id of the user who sent it, keyed by ticker symbol.
+        session (Session): The db session.
+
+    Raises:
+        Exception: If the update fails, after rolling it back, so that the caller can retry the prices.
+
+    Returns:
+        int: The number of securities updated.
+    """
+    if not prices:
+        return 0
+
+    # Sorted so that concurrent flushes from other workers lock the rows in the same order.
+    rows = [
+        (ticker_symbol, price, user_id, datetime.now())
+        for ticker_symbol, (price, user_id) in sorted(prices.items())
+    ]
+    try:
+        with session.connection().connection.cursor() as cursor:
+            execute_values(
+                cursor,
+                """
+                UPDATE securities
+                SET current_price = ticks.price, updated_by = ticks.updated_by, updated_on = ticks.updated_on
+                FROM (VALUES %s) AS ticks (ticker_symbol, price, updated_by, updated_on)
+                WHERE securities.ticker_symbol = ticks.ticker_symbol
+                """,
+                rows,
+                template="(%s, %s::double precision, %s::integer, %s::timestamp)",
+                page_size=len(rows)
+            )
+            updated_rows = cursor.rowcount
+        session.commit()
+    except Exception as e:
+        print("Exception Raised: ", e)
+        session.rollback()
+        raise
+
+    return updated_rows
+
+
 def transform_securities(security_data: List[Securities]) -> List:
     """The function transforms the received db data into a json response with the only required values.
 
@@ -174,27 +442,47 @@ def transform_securities(security_data: List[Securities]) -> List:
     return final_response
 
 
-def get_security_details(ticker_symbol: str) -> List:
-    """The main function that gets all the data from db and transforms it and returns.
+def search_securities_query(query: str, session: Session, fuzzy: bool = True) -> Query:
+    """Builds the query of the active securities matching the text typed, in the order of search_securities."""
+    term = query.strip().upper()
+    prefix = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    ticker_prefix = Securities.ticker_symbol.like(prefix, escape="\\")
+    name_prefix = or_(Securities.name.like(prefix, escape="\\"), Securities.name.like("% " + prefix, escape="\\"))
+
+    matches = [ticker_prefix, name_prefix]
+    if fuzzy:
+        matches += [Securities.ticker_symbol.op("%")(term), Securities.name.op("%")(term)]
+
+    return session.query(Securities).filter(
+        Securities.is_active == True,
+        or_(*matches)
+    ).order_by(
+        case([(ticker_prefix, 0), (name_prefix, 1)], else_=2),
+        func.greatest(func.similarity(Securities.ticker_symbol, term), func.similarity(Securities.name, term)).desc(),
+        Securities.ticker_symbol
+    )
+
+
+def search_securities(
+    query: str, session: Session, fuzzy: bool = True, limit: int = SECURITY_SEARCH_PAGE_SIZE, offset: int = 0
+) -> List:
+    """Searches the active securities by ticker symbol and name, served by the trigram indexes.
+
+    Ticker symbols starting with the query come first, then names with a word starting with it,
+    then, if fuzzy, the similar ones by descending trigram similarity.
 
     Args:
-        ticker_symbol (str): The ticker for which we need data.
+        query (str): The text typed. Eg: TCS.
+        session (Session): The db session.
+        fuzzy (bool, optional): Also match similar tickers and names, eg: TSC for TCS. Defaults to True.
+        limit (int, optional): The page size. Defaults to SECURITY_SEARCH_PAGE_SIZE.
+        offset (int, optional): The number of results to skip. Defaults to 0.
 
     Returns:
-        List: The list of transformed data to be shown to the user.
+        List: The page of transformed securities.
     """
-    session = get_db_session()
-    db_security_data = []
-    if ticker_symbol:
-        # If a ticker symbol is specified only get that specific data.
-        db_security_data = session.query(Securities).filter(
-            Securities.ticker_symbol == ticker_symbol.upper(),
-            Securities.is_active == True
-        ).all()
-    else:
-        # Get all active securities from the database.
-        db_security_data = session.query(Securities).filter(Securities.is_active == True).all()
+    db_security_data = search_securities_query(
+        query=query, session=session, fuzzy=fuzzy
+    ).limit(limit).offset(offset).all()
 
-    # Transform the received db data into a list of mandatory data objects.
-    response = transform_securities(db_security_data)
-    return response
+    return transform_securities(db_security_data)
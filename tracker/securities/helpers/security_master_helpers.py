@@ -0,0 +1,311 @@
+"""A process local copy of the securities table, kept fresh by polling the updated_on column."""
+import asyncio
+import hashlib
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Query, Session
+
+from models.db_models import Securities
+from utils.constants import (
+    SECURITY_MASTER_REFRESH_INTERVAL, SECURITY_MASTER_REFRESH_OVERLAP, SECURITY_SEARCH_PAGE_SIZE
+)
+from utils.database_utils import get_db_session, run_db_call
+
+
+security_master = None
+
+
+class SecurityTrie:
+    """A prefix tree from upper cased keys to the ids of the securities they belong to."""
+
+    def __init__(self):
+        self.children: Dict[str, "SecurityTrie"] = {}
+        self.security_ids: Set[int] = set()
+
+    def insert(self, key: str, security_id: int):
+        node = self
+        for character in key:
+            node = node.children.setdefault(character, SecurityTrie())
+        node.security_ids.add(security_id)
+
+    def remove(self, key: str, security_id: int):
+        """Removes the id from `key`, and the nodes left with neither ids nor children."""
+        path = [self]
+        for character in key:
+            node = path[-1].children.get(character)
+            if not node:
+                return
+            path.append(node)
+        path[-1].security_ids.discard(security_id)
+
+        for depth in range(len(key), 0, -1):
+            if path[depth].security_ids or path[depth].children:
+                break
+            del path[depth - 1].children[key[depth - 1]]
+
+    def search(self, prefix: str) -> Set[int]:
+        """Returns the ids of every key starting with `prefix`."""
+        node = self
+        for character in prefix:
+            node = node.children.get(character)
+            if not node:
+                return set()
+
+        security_ids: Set[int] = set()
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            security_ids |= node.security_ids
+            pending.extend(node.children.values())
+        return security_ids
+
+
+def trie_keys(security: Dict) -> Tuple[str, List[str]]:
+    """The key of the security in the ticker trie, and its keys in the name trie: the name and every later word."""
+    name = security["name"].upper()
+    return security["ticker_symbol"].upper(), [name] + name.split()[1:]
+
+
+def changed_securities_query(session: Session, since: Optional[datetime] = None) -> Query:
+    """Builds the query of the securities updated after `since`, less the refresh overlap, or of all of them."""
+    query = session.query(Securities)
+    if since:
+        query = query.filter(Securities.updated_on > since - SECURITY_MASTER_REFRESH_OVERLAP)
+    return query
+
+
+def security_entry(security: Securities) -> Dict:
+    return {
+        "id": security.id,
+        "name": security.name,
+        "ticker_symbol": security.ticker_symbol,
+        "current_price": security.current_price,
+        "is_active": security.is_active,
+        "updated_on": security.updated_on
+    }
+
+
+def row_digest(security: Dict) -> int:
+    """A digest of a security that is the same in every worker, unlike hash()."""
+    row = (
+        security["id"], security["name"], security["ticker_symbol"], security["current_price"],
+        security["is_active"], security["updated_on"]
+    )
+    return int.from_bytes(hashlib.sha1(repr(row).encode()).digest()[:8], "big")
+
+
+class SecurityMaster:
+    """Every security keyed by id and by ticker symbol, with tries of the active ones for prefix search.
+
+    The first refresh loads the whole table, later ones only read the rows with an updated_on after
+    the latest one seen, less SECURITY_MASTER_REFRESH_OVERLAP for rows committed late. The rows are
+    read on the threadpool and applied in place on the event loop, only the entries of the securities
+    that changed are touched. Worker threads only look up single ids, which a dict keeps consistent.
+
+    `content_hash` is the XOR of the digests of every security, kept up to date row by row, so it changes
+    with the content whatever the updated_on of the rows, and is the same in every worker.
+    """
+
+    def __init__(self):
+        self.by_id: Dict[int, Dict] = {}
+        self.by_ticker: Dict[str, Dict] = {}
+        self.ticker_trie = SecurityTrie()
+        self.name_trie = SecurityTrie()
+        self.content_hash: int = 0
+        self.last_seen: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def fetch_changes(self, session: Session) -> List[Dict]:
+        """Reads the securities changed since the last refresh.
+
+        Args:
+            session (Session): The db session.
+
+        Returns:
+            List[Dict]: The securities read.
+        """
+        query = changed_securities_query(session=session, since=self.last_seen)
+        changed = [security_entry(security) for security in query.all()]
+        session.rollback()
+        return changed
+
+    def apply_changes(self, changed: List[Dict]) -> int:
+        """Applies the securities read by fetch_changes in place.
+
+        Rows re-read because of the overlap, and rows older than the entry already applied, eg: from a
+        refresh that finished late, are skipped. The tries are only touched when the ticker symbol, the
+        name or is_active of a security changed.
+
+        Args:
+            changed (List[Dict]): The securities read.
+
+        Returns:
+            int: The number of securities that changed.
+        """
+        applied = 0
+        for entry in changed:
+            previous = self.by_id.get(entry["id"])
+            digest = row_digest(entry)
+            if previous:
+                if previous["updated_on"] and entry["updated_on"] and previous["updated_on"] > entry["updated_on"]:
+                    continue
+                previous_digest = row_digest(previous)
+                if previous_digest == digest:
+                    continue
+                self.content_hash ^= previous_digest
+            self.content_hash ^= digest
+
+            if previous and self.by_ticker.get(previous["ticker_symbol"]) is previous:
+                del self.by_ticker[previous["ticker_symbol"]]
+            self.by_ticker[entry["ticker_symbol"]] = entry
+
+            if not previous or any(
+                previous[field] != entry[field] for field in ("ticker_symbol", "name", "is_active")
+            ):
+                if previous and previous["is_active"]:
+                    self.remove_from_tries(previous)
+                if entry["is_active"]:
+                    self.add_to_tries(entry)
+
+            self.by_id[entry["id"]] = entry
+            applied += 1
+
+        latest = max((security["updated_on"] for security in changed if security["updated_on"]), default=None)
+        if latest and (not self.last_seen or latest > self.last_seen):
+            self.last_seen = latest
+        return applied
+
+    def refresh(self, session: Session) -> int:
+        """Reads and applies the securities changed since the last refresh, returns the number that changed."""
+        return self.apply_changes(self.fetch_changes(session))
+
+    def add_to_tries(self, security: Dict):
+        ticker_key, name_keys = trie_keys(security)
+        self.ticker_trie.insert(ticker_key, security["id"])
+        for key in name_keys:
+            self.name_trie.insert(key, security["id"])
+
+    def remove_from_tries(self, security: Dict):
+        ticker_key, name_keys = trie_keys(security)
+        self.ticker_trie.remove(ticker_key, security["id"])
+        for key in name_keys:
+            self.name_trie.remove(key, security["id"])
+
+    def get(self, security_id: int) -> Optional[Dict]:
+        return self.by_id.get(security_id)
+
+    def is_tradable(self, security_id: int) -> bool:
+        """Whether the security exists and is active."""
+        security = self.by_id.get(security_id)
+        return bool(security and security["is_active"])
+
+    def active_securities(self, ticker_symbol: str = "") -> List[Dict]:
+        """Returns the active securities in the listing format, only the one of `ticker_symbol` if given.
+
+        Args:
+            ticker_symbol (str, optional): The ticker symbol. Eg: TCS. Defaults to "".
+
+        Returns:
+            List[Dict]: The securities ordered by id.
+        """
+        if ticker_symbol:
+            security = self.by_ticker.get(ticker_symbol.upper())
+            securities = [security] if security else []
+        else:
+            securities = sorted(self.by_id.values(), key=lambda security: security["id"])
+
+        return [listing_entry(security) for security in securities if security["is_active"]]
+
+    def search(self, prefix: str, limit: int = SECURITY_SEARCH_PAGE_SIZE, offset: int = 0) -> List[Dict]:
+        """Searches the active securities by prefix of ticker symbol, name or a word of the name.
+
+        Ticker symbol matches come first, then name matches, each ordered by ticker symbol.
+
+        Args:
+            prefix (str): The text typed. Eg: TC.
+            limit (int, optional): The page size. Defaults to SECURITY_SEARCH_PAGE_SIZE.
+            offset (int, optional): The number of results to skip. Defaults to 0.
+
+        Returns:
+            List[Dict]: The page of securities in the listing format.
+        """
+        prefix = prefix.strip().upper()
+        by_id = self.by_id
+        ticker_ids = self.ticker_trie.search(prefix)
+        name_ids = self.name_trie.search(prefix) - ticker_ids
+
+        matches = []
+        for security_ids in (ticker_ids, name_ids):
+            securities = [by_id[security_id] for security_id in security_ids if security_id in by_id]
+            matches += sorted(
+                (security for security in securities if security["is_active"]),
+                key=lambda security: security["ticker_symbol"]
+            )
+        return [listing_entry(security) for security in matches[offset:offset + limit]]
+
+    def fetch_with_new_session(self) -> List[Dict]:
+        session = get_db_session()
+        try:
+            return self.fetch_changes(session)
+        finally:
+            session.close()
+
+    async def refresh_now(self):
+        """Refreshes right away, eg: after this process has written to the securities table."""
+        try:
+            self.apply_changes(await run_db_call(self.fetch_with_new_session))
+        except Exception as e:
+            print("Exception Raised: ", e)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SECURITY_MASTER_REFRESH_INTERVAL)
+            await self.refresh_now()
+
+
+def listing_entry(security: Dict) -> Dict:
+    return {
+        "id": security["id"],
+        "name": security["name"],
+        "ticker_symbol": security["ticker_symbol"],
+        "current_price": security["current_price"],
+        "updated_on": security["updated_on"]
+    }
+
+
+async def init_security_master():
+    """Loads the security master and starts refreshing it in the background."""
+    global security_master
+
+    security_master = SecurityMaster()
+    await security_master.refresh_now()
+    security_master.start()
+
+
+async def close_security_master():
+    global security_master
+
+    if security_master:
+        await security_master.stop()
+        security_master = None
+
+
+def get_security_master() -> SecurityMaster:
+    """Returns the security master, loading it synchronously if init_security_master has not run."""
+    global security_master
+
+    if not security_master:
+        security_master = SecurityMaster()
+        security_master.apply_changes(security_master.fetch_with_new_session())
+    return security_master
@@ -1,6 +1,7 @@
 import datetime
+from typing import List
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 
 
 class BaseResponse(BaseModel):
@@ -27,6 +28,27 @@ class SecurityUpdate(BaseModel):
     current_price: float = 0.0
 
 
+class PriceUpdateResponse(BaseResponse):
+    """The outcome of a bulk price update."""
+    updated: int = 0
+    unknown_ids: List[int] = []
+
+
+class SecurityUpsertResult(BaseModel):
+    """What an upsert did with a ticker: CREATED, UPDATED, SKIPPED or FAILED."""
+    ticker_symbol: str = ""
+    status: str = ""
+
+
+class UpsertSecuritiesResponse(BaseResponse):
+    """The outcome of a securities upsert."""
+    created: int = 0
+    updated: int = 0
+    skipped: int = 0
+    failed: int = 0
+    results: List[SecurityUpsertResult] = []
+
+
 class SecurityResponse(BaseModel):
     """Response Schema for all the data related to security."""
     id: int = 0
@@ -34,3 +56,21 @@ class SecurityResponse(BaseModel):
     ticker_symbol: str = ""
     current_price: float = 0.0
     updated_on: datetime.datetime = ""
+
+
+class PriceTick(BaseModel):
+    """A live price of a security, received over the price tick websocket."""
+    ticker_symbol: str
+    price: float
+
+    @validator("ticker_symbol")
+    def is_valid_ticker_symbol(cls, ticker_symbol):
+        if not ticker_symbol.strip():
+            raise ValueError("ticker_symbol is required.")
+        return ticker_symbol.strip().upper()
+
+    @validator("price")
+    def is_valid_price(cls, price):
+        if price <= 0:
+            raise ValueError("price should be greater than 0.")
+        return price
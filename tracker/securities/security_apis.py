@@ -2,8 +2,12 @@ from typing import List
 
 from fastapi import APIRouter
 
-from tracker.securities.handlers.securities_handler import create_security, security_listing, update_security
-from tracker.securities.schemas.security_schemas import BaseResponse, SecurityResponse
+from tracker.securities.handlers.securities_handler import (
+    create_security, price_ticks, security_listing, security_search, update_prices, update_security, upsert_security
+)
+from tracker.securities.schemas.security_schemas import (
+    BaseResponse, PriceUpdateResponse, SecurityResponse, UpsertSecuritiesResponse
+)
 from utils.constants import BASE_RESPONSE_STATUS_CODES
 
 
@@ -15,7 +19,15 @@ security_v1_apis = APIRouter(
 
 # The api displays all the active securites in the database. Takes an optional input ticker_symbol.
 security_v1_apis.add_api_route("/listing", security_listing, response_model=List[SecurityResponse], methods=["GET"])
+# The api to search active securities by prefix or fuzzily on ticker_symbol and name. Paginated with limit/offset.
+security_v1_apis.add_api_route("/search", security_search, response_model=List[SecurityResponse], methods=["GET"])
 # The api to create securities. Takes a list of securities to be added.
 security_v1_apis.add_api_route("/create", create_security, response_model=BaseResponse, methods=["POST"])
+# The api to create or update securities by ticker_symbol. Takes update_existing=false to skip the existing ones.
+security_v1_apis.add_api_route("/upsert", upsert_security, response_model=UpsertSecuritiesResponse, methods=["POST"])
 # The api to update securities. Takes a list of securities to be added.
 security_v1_apis.add_api_route("/update", update_security, response_model=BaseResponse, methods=["PUT"])
+# The api to update the prices of many securities at once. Returns the count updated and the unknown ids.
+security_v1_apis.add_api_route("/prices", update_prices, response_model=PriceUpdateResponse, methods=["PUT"])
+# The websocket that receives a live feed of prices. Authorised with an access token.
+security_v1_apis.add_api_websocket_route("/ticks", price_ticks)
@@ -1,23 +1,39 @@
-from typing import Dict
+from datetime import datetime
+from typing import Dict, List, Optional
 
-from fastapi import Depends, HTTPException
+from fastapi import Depends, File, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
 
 from tracker.transactions.helpers.transaction_db_helpers import (
-    delete_last_transaction, get_all_trades,
-    new_transaction, update_last_transaction, valid_transaction
+    delete_last_transaction, execute_bulk_trades, execute_trade, get_trade_history,
+    stream_trade_history, update_last_transaction, valid_transaction
+)
+from tracker.transactions.helpers.group_commit_helpers import get_trade_writer
+from tracker.transactions.helpers.transaction_import_helpers import import_trades
+from tracker.transactions.schemas.transaction_schemas import (
+    BaseResponse, BulkTradeResponse, DeleteTrade, ImportTradesResponse, TradeHistoryResponse, TradeTransaction,
+    UpdateTrade
 )
-from tracker.transactions.schemas.transaction_schemas import BaseResponse, DeleteTrade, TradeTransaction, UpdateTrade
 from tracker.users.schemas.user_schemas import UserResponse
-from tracker.users.handlers.user_handler import authorise_user
-from utils.constants import UNPROCESSABLE_ENTITY
+from tracker.users.handlers.user_handler import authorise_request
+from utils.constants import (
+    CONFLICT_STATUS_CODE, DEFAULT_PAGE_SIZE, EXPORT_MEDIA_TYPES, MAX_BULK_TRADES, MAX_PAGE_SIZE,
+    PORTFOLIO_VERSION_CONFLICT, UNPROCESSABLE_ENTITY, VALID_TRANSACTIONS
+)
+from utils.database_utils import get_session, run_db_call
 
 
-async def new_trade(transaction_data: TradeTransaction, user: UserResponse = Depends(authorise_user)) -> BaseResponse:
+async def new_trade(
+    transaction_data: TradeTransaction, user: UserResponse = Depends(authorise_request),
+    session: Session = Depends(get_session)
+) -> BaseResponse:
     """This function handles request to perform a new transaction or a new trade.
 
     Args:
         transaction_data (TradeTransaction): The major data required for a transaction to complete.
-        user (UserResponse, optional): The user performing the transaction. Defaults to Depends(authorise_user).
+        user (UserResponse, optional): The user performing the transaction. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Raises:
         HTTPException: If transaction is not valid.
@@ -25,29 +41,98 @@ async def new_trade(transaction_data: TradeTransaction, user: UserResponse = Dep
     Returns:
         BaseResponse: The response when transaction is completed.
     """
-    success: bool = False
-    message: str = "TRANSACTION_SUCCESSFUL"
-
-    valid, message, existing_data = valid_transaction(transaction_data=transaction_data, user_data=UserResponse(**user))
-    if not valid:
+    trade_writer = get_trade_writer()
+    if trade_writer and trade_writer.available:
+        # Let the group commit writer batch the trade with the other trades received meanwhile.
+        success, status_code, message, transaction_id = await trade_writer.submit(
+            transaction_data=transaction_data, user_data=UserResponse(**user)
+        )
+    else:
+        # Validate, record and apply the trade in a single db transaction.
+        success, status_code, message, transaction_id = await run_db_call(
+            execute_trade, transaction_data=transaction_data, user_data=UserResponse(**user), session=session
+        )
+    if status_code == UNPROCESSABLE_ENTITY:
         raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail=message)
 
-    # Proceed with the transaction.
-    success, message, transaction_id = new_transaction(
-        transaction_data=transaction_data, existing_portfolio=existing_data, user_data=UserResponse(**user)
-    )
     return {"success": success, "message": message, "ref_id": str(transaction_id)}
 
 
-async def update_trade(transaction_data: UpdateTrade, user: UserResponse = Depends(authorise_user)) -> BaseResponse:
+async def new_bulk_trade(
+    transactions: List[TradeTransaction], user: UserResponse = Depends(authorise_request),
+    session: Session = Depends(get_session)
+) -> BulkTradeResponse:
+    """Handles a batch of trades, eg: an end of day broker reconciliation.
+
+    Args:
+        transactions (List[TradeTransaction]): The trades to perform, oldest first.
+        user (UserResponse, optional): The user performing the transactions. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
+
+    Raises:
+        HTTPException: If the batch is empty or too large.
+        HTTPException: If the batch could not be written.
+
+    Returns:
+        BulkTradeResponse: The overall status and the outcome of every trade, in the order received.
+    """
+    if not transactions or len(transactions) > MAX_BULK_TRADES:
+        raise HTTPException(
+            status_code=UNPROCESSABLE_ENTITY, detail=f"BETWEEN 1 AND {MAX_BULK_TRADES} TRANSACTIONS ARE ALLOWED."
+        )
+
+    success, status_code, message, results = await run_db_call(
+        execute_bulk_trades, trades=transactions, user_data=UserResponse(**user), session=session
+    )
+    if not success:
+        raise HTTPException(status_code=status_code, detail=message)
+
+    return {"success": success, "message": message, "results": results}
+
+
+async def import_contract_note(
+    contract_note: UploadFile = File(...), user: UserResponse = Depends(authorise_request),
+    session: Session = Depends(get_session)
+) -> ImportTradesResponse:
+    """Imports a broker contract note csv, eg: the trade history of a newly onboarded client.
+
+    The csv needs a header row and the columns ticker_symbol, transaction_type, transaction_amount,
+    quantity and traded_on. Rows are applied oldest first, rows that can not be applied are reported back.
+
+    Args:
+        contract_note (UploadFile, optional): The csv file. Defaults to File(...).
+        user (UserResponse, optional): The user importing the trades. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
+
+    Raises:
+        HTTPException: If the file could not be read or imported.
+
+    Returns:
+        ImportTradesResponse: The number of imported and rejected rows, with the reason for every rejected row.
+    """
+    success, status_code, message, report = await run_db_call(
+        import_trades, contract_note=contract_note.file, user_id=user["id"], session=session
+    )
+    if not success:
+        raise HTTPException(status_code=status_code, detail=message)
+
+    return {"success": success, "message": message, **report}
+
+
+async def update_trade(
+    transaction_data: UpdateTrade, user: UserResponse = Depends(authorise_request),
+    session: Session = Depends(get_session)
+) -> BaseResponse:
     """Updates the last performed trade.
 
     Args:
         transaction_data (UpdateTrade): The updating data.
-        user (UserResponse, optional): The user data. Defaults to Depends(authorise_user).
+        user (UserResponse, optional): The user data. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Raises:
         HTTPException: If updating data is not valid.
+        HTTPException: If the portfolio kept changing while it was being updated.
 
     Returns:
         BaseResponse: The response with ref id.
@@ -55,23 +140,34 @@ async def update_trade(transaction_data: UpdateTrade, user: UserResponse = Depen
     success: bool = False
     message: str = "TRANSACTION_SUCCESSFUL"
 
-    valid, message, existing_data = valid_transaction(transaction_data=transaction_data, user_data=UserResponse(**user))
+    valid, message, existing_data = await run_db_call(
+        valid_transaction, transaction_data=transaction_data, user_data=UserResponse(**user), session=session
+    )
     if not valid:
         raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail=message)
 
     # Update the last transaction.
-    success, message = update_last_transaction(
-        new_transaction_data=transaction_data, existing_portfolio=existing_data, user_data=UserResponse(**user)
+    success, message = await run_db_call(
+        update_last_transaction,
+        new_transaction_data=transaction_data, existing_portfolio=existing_data, user_data=UserResponse(**user),
+        session=session
     )
+    if message == PORTFOLIO_VERSION_CONFLICT:
+        # The portfolio kept being traded while it was being updated. Nothing was written, the client may retry.
+        raise HTTPException(status_code=CONFLICT_STATUS_CODE, detail=message)
     return {"success": success, "message": message, "ref_id": transaction_data.updating_portfolio_id}
 
 
-async def delete_trade(transaction_data: DeleteTrade, user: UserResponse = Depends(authorise_user)) -> BaseResponse:
-    """This function handles the deletion of trade by rollbacking the last transaction.
+async def delete_trade(
+    transaction_data: DeleteTrade, user: UserResponse = Depends(authorise_request),
+    session: Session = Depends(get_session)
+) -> BaseResponse:
+    """This function handles the deletion of trades by rollbacking the last `count` transactions of a portfolio.
 
     Args:
         transaction_data (DeleteTrade): The data to be deleted.
-        user (UserResponse, optional): The user's data. Defaults to Depends(authorise_user).
+        user (UserResponse, optional): The user's data. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Returns:
         BaseResponse: The response/
@@ -79,30 +175,92 @@ async def delete_trade(transaction_data: DeleteTrade, user: UserResponse = Depen
     success: bool = False
     message: str = "DELETION_UNSUCCESSFUL"
 
-    success, message = delete_last_transaction(deleting_portfolio_data=transaction_data, user_data=UserResponse(**user))
+    success, message = await run_db_call(
+        delete_last_transaction, deleting_portfolio_data=transaction_data, user_data=UserResponse(**user), session=session
+    )
     return {"success": success, "message": message}
 
 
-async def get_trades(user: UserResponse = Depends(authorise_user)) -> Dict:
-    """Returns all the trades that are done by this user.
+async def get_trades(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: str = "",
+    ticker_symbol: str = "", transaction_type: str = "",
+    from_date: Optional[datetime] = None, to_date: Optional[datetime] = None,
+    user: UserResponse = Depends(authorise_request), session: Session = Depends(get_session)
+) -> TradeHistoryResponse:
+    """Returns one page of the trades that are done by this user, newest first.
 
     Args:
-        user (UserResponse, optional): The user related data.. Defaults to Depends(authorise_user).
+        limit (int, optional): The page size. Defaults to DEFAULT_PAGE_SIZE.
+        cursor (str, optional): The next_cursor returned with the previous page. Defaults to "".
+        ticker_symbol (str, optional): Only trades of this ticker. Eg: TCS. Defaults to "".
+        transaction_type (str, optional): Only BUY or SELL trades. Defaults to "".
+        from_date (Optional[datetime], optional): Only trades done on or after this time. Defaults to None.
+        to_date (Optional[datetime], optional): Only trades done on or before this time. Defaults to None.
+        user (UserResponse, optional): The user related data.. Defaults to Depends(authorise_request).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
+
+    Raises:
+        HTTPException: If transaction_type is not BUY or SELL.
 
     Returns:
-        Dict: A json of ticker_symbol and its respective trades.
+        TradeHistoryResponse: The trades and the cursor of the next page, null on the last page.
 
     Response Eg:
         {
-            "tcs": [
+            "trades": [
                 {
+                    "transaction_id": 42,
+                    "ticker_symbol": "TCS",
                     "transaction_date": "2021-07-13T01:00:00",
                     "transaction_type": "BUY",
-                    "transaction_quantity": 10
+                    "transaction_quantity": 10,
                     "transaction_amount": 3542.01
                 }
-            ]
+            ],
+            "next_cursor": "MjAyMS0wNy0xM1QwMTowMDowMHw0Mg=="
         }
     """
-    response: Dict = get_all_trades(user_data=UserResponse(**user))
+    if transaction_type and transaction_type not in VALID_TRANSACTIONS:
+        raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail="transaction_type can only be BUY or SELL.")
+
+    response: Dict = await run_db_call(
+        get_trade_history, user_data=UserResponse(**user), session=session, limit=limit, cursor=cursor,
+        ticker_symbol=ticker_symbol, transaction_type=transaction_type, from_date=from_date, to_date=to_date
+    )
     return response
+
+
+async def export_trades(
+    export_format: str = "ndjson", ticker_symbol: str = "", transaction_type: str = "",
+    from_date: Optional[datetime] = None, to_date: Optional[datetime] = None,
+    user: UserResponse = Depends(authorise_request)
+) -> StreamingResponse:
+    """Streams the user's full trade ledger, newest first.
+
+    Args:
+        export_format (str, optional): Either ndjson or csv. Defaults to "ndjson".
+        ticker_symbol (str, optional): Only trades of this ticker. Eg: TCS. Defaults to "".
+        transaction_type (str, optional): Only BUY or SELL trades. Defaults to "".
+        from_date (Optional[datetime], optional): Only trades done on or after this time. Defaults to None.
+        to_date (Optional[datetime], optional): Only trades done on or before this time. Defaults to None.
+        user (UserResponse, optional): The user related data. Defaults to Depends(authorise_request).
+
+    Raises:
+        HTTPException: If export_format or transaction_type is not valid.
+
+    Returns:
+        StreamingResponse: The ledger streamed as NDJSON lines or CSV rows.
+    """
+    if export_format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail="export_format can only be ndjson or csv.")
+    if transaction_type and transaction_type not in VALID_TRANSACTIONS:
+        raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail="transaction_type can only be BUY or SELL.")
+
+    trades = stream_trade_history(
+        user_data=UserResponse(**user), export_format=export_format, ticker_symbol=ticker_symbol,
+        transaction_type=transaction_type, from_date=from_date, to_date=to_date
+    )
+    return StreamingResponse(
+        trades, media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename=trades.{export_format}"}
+    )
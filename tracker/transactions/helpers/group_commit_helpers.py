@@ -0,0 +1,195 @@
+"""An in-process writer that commits the trades of many concurrent requests in one db transaction."""
+import asyncio
+import os
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from tracker.transactions.helpers.transaction_db_helpers import execute_trade
+from tracker.transactions.schemas.transaction_schemas import TradeTransaction
+from tracker.users.schemas.user_schemas import UserResponse
+from utils.constants import GROUP_COMMIT_MAX_BATCH_SIZE, GROUP_COMMIT_MAX_WAIT_MS, INTERNAL_SERVER_ERROR
+from utils.database_utils import get_db_session, run_db_call
+
+
+GROUP_COMMIT_ENABLED: bool = os.environ.get("GROUP_COMMIT_ENABLED", "").lower() in ("1", "true", "yes")
+
+trade_writer = None
+
+
+class GroupCommitWriter:
+    """Batches trades from concurrent requests and writes every batch with a single commit.
+
+    A single asyncio task takes up to `max_batch_size` trades off the queue, waiting at most
+    `max_wait_ms` after the first one, and applies them in one db transaction. Every trade runs
+    in its own savepoint, so a rejected or failing trade does not affect the rest of the batch.
+
+    If the task dies, the trades it holds and every queued trade are failed with the error, and the
+    writer is no longer `available`, so requests commit their trades themselves instead of waiting.
+    """
+
+    def __init__(self, max_batch_size: int = GROUP_COMMIT_MAX_BATCH_SIZE, max_wait_ms: int = GROUP_COMMIT_MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue: Optional[asyncio.Queue] = None
+        self.batch: List[Tuple[TradeTransaction, UserResponse, asyncio.Future]] = []
+        self.closing = False
+        self.error: Optional[Exception] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def available(self) -> bool:
+        """Whether the writer takes trades, False once it is stopping or has died."""
+        return self.task is not None and not self.task.done() and not self.closing
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Writes the queued trades and stops the writer."""
+        self.closing = True
+        if not self.task.done():
+            await self.queue.put(None)
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, transaction_data: TradeTransaction, user_data: UserResponse) -> Tuple[bool, int, str, int]:
+        """Queues a trade and waits for the batch it lands in to be committed.
+
+        Args:
+            transaction_data (TradeTransaction): The received transaction data.
+            user_data (UserResponse): The user data.
+
+        Raises:
+            RuntimeError: If the writer is not available, or died before writing the trade.
+
+        Returns:
+            Tuple[bool, int, str, int]: A tuple of success, status_code, message and transaction id.
+        """
+        if not self.available:
+            raise RuntimeError("TRADE_WRITER_UNAVAILABLE")
+
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((transaction_data, user_data, future))
+        return await future
+
+    async def run(self):
+        try:
+            stopping = False
+            while not stopping:
+                self.batch = []
+                stopping = await self.collect_batch()
+                if self.batch:
+                    await self.write(self.batch)
+                self.batch = []
+        except Exception as e:
+            print("Exception Raised: ", e)
+            self.error = e
+        finally:
+            # Nothing takes trades off the queue any more, fail the ones left instead of letting them wait.
+            self.closing = True
+            error = self.error or RuntimeError("TRADE_WRITER_STOPPED")
+            self.fail(self.batch, error)
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item:
+                    self.fail([item], error)
+
+    async def collect_batch(self) -> bool:
+        """Takes the next batch off the queue into `self.batch`, returns whether the writer was asked to stop."""
+        item = await self.queue.get()
+        if item is None:
+            return True
+
+        self.batch.append(item)
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(self.batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return True
+            self.batch.append(item)
+        return False
+
+    async def write(self, batch: List[Tuple[TradeTransaction, UserResponse, asyncio.Future]]):
+        """Writes a batch and resolves the future of every trade, or fails them all with the error."""
+        try:
+            results = await run_db_call(self.write_batch, [(trade, user) for trade, user, _ in batch])
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            print("Exception Raised: ", e)
+            self.fail(batch, e)
+
+    @staticmethod
+    def fail(batch: List[Tuple[TradeTransaction, UserResponse, asyncio.Future]], error: Exception):
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def write_batch(self, batch: List[Tuple[TradeTransaction, UserResponse]]) -> List[Tuple[bool, int, str, int]]:
+        """Applies a batch of trades in one db transaction.
+
+        The trades are applied sorted by user and security, so two batches lock portfolios in the same
+        order. Trades on the same holding keep the order they were received in.
+
+        Args:
+            batch (List[Tuple[TradeTransaction, UserResponse]]): The trades and the users performing them.
+
+        Returns:
+            List[Tuple[bool, int, str, int]]: The outcome of every trade, in the order of the batch.
+        """
+        results: List[Tuple[bool, int, str, int]] = [None] * len(batch)
+        session: Session = get_db_session()
+        try:
+            for index in sorted(range(len(batch)), key=lambda index: (batch[index][1].id, batch[index][0].security_id)):
+                transaction_data, user_data = batch[index]
+                savepoint = session.begin_nested()
+                results[index] = execute_trade(
+                    transaction_data=transaction_data, user_data=user_data, session=session, commit=False
+                )
+                if results[index][0]:
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+            session.commit()
+        except Exception as e:
+            print("Exception Raised: ", e)
+            session.rollback()
+            results = [(False, INTERNAL_SERVER_ERROR, "TRANSACTION_FAILED", 0)] * len(batch)
+        finally:
+            session.close()
+
+        return results
+
+
+async def init_trade_writer():
+    """Starts the group commit writer if GROUP_COMMIT_ENABLED is set."""
+    global trade_writer
+
+    if GROUP_COMMIT_ENABLED:
+        trade_writer = GroupCommitWriter()
+        trade_writer.start()
+
+
+async def close_trade_writer():
+    global trade_writer
+
+    if trade_writer:
+        await trade_writer.stop()
+        trade_writer = None
+
+
+def get_trade_writer() -> Optional[GroupCommitWriter]:
+    """Returns the group commit writer, None if trades are committed one request at a time."""
+    return trade_writer
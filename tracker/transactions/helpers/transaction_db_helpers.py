@@ -1,100 +1,323 @@
+import csv
+import io
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from copy import deepcopy
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 from fastapi import HTTPException
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Query, Session
 
-from models.db_models import Portfolio, Transaction
+from models.db_models import Portfolio, Securities, Transaction
 from tracker.portfolio.helpers.portfolio_db_helpers import (
+    compute_portfolio_position,
     create_portfolio,
     get_portfolio_by_id,
+    reload_portfolio,
     rollback_portfolio,
     update_portfolio,
+    upsert_portfolio_positions,
+    wait_before_retry,
 )
+from tracker.portfolio.helpers.portfolio_replay_helpers import invalidate_portfolio_snapshots, replay_position_before
+from tracker.securities.helpers.security_master_helpers import get_security_master
 from tracker.transactions.schemas.transaction_schemas import DeleteTrade, TradeTransaction, UpdateTrade
 from tracker.users.schemas.user_schemas import UserResponse
-from utils.constants import UNPROCESSABLE_ENTITY
+from utils.constants import (
+    BULK_INSERT_CHUNK_SIZE, DEFAULT_PAGE_SIZE, EXPORT_BATCH_SIZE, INTERNAL_SERVER_ERROR, PORTFOLIO_UPDATE_RETRIES,
+    PORTFOLIO_VERSION_CONFLICT, SUCCESS_STATUS_CODE, UNPROCESSABLE_ENTITY
+)
 from utils.database_utils import get_db_session
 
 
-def valid_transaction(transaction_data: TradeTransaction, user_data: UserResponse) -> Tuple[bool, str, Portfolio]:
+def validate_trade(held_quantity: Optional[int], transaction_type: str, quantity: int) -> Tuple[bool, str]:
+    """Checks whether a trade can be done against the quantity currently held.
+
+    Args:
+        held_quantity (Optional[int]): The quantity held, None if the user has no portfolio for the security.
+        transaction_type (str): BUY or SELL.
+        quantity (int): The quantity traded.
+
+    Returns:
+        Tuple[bool, str]: A tuple of is_valid and the message.
+    """
+    if transaction_type == "SELL" and held_quantity is None:
+        # If we don't have any quantity.
+        return False, "NO_QUANTITY_AVAILABLE_TO_SELL"
+    if transaction_type == "SELL" and quantity > held_quantity:
+        # Check if we have enough quantity to sell.
+        return False, "NOT_ENOUGH_QUANTITY_TO_SELL"
+    return True, ""
+
+
+def lock_portfolio_query(security_id: int, user_id: int, session: Session) -> Query:
+    """Builds the query of the user's portfolio for a security, locking it until the end of the db transaction."""
+    return session.query(Portfolio).filter(
+        Portfolio.security_id == security_id,
+        Portfolio.user_id == user_id
+    ).with_for_update().populate_existing()
+
+
+def lock_portfolios_query(user_id: int, security_ids: Set[int], session: Session) -> Query:
+    """Builds the query of the user's portfolios for many securities, locked in id order so batches don't deadlock."""
+    return session.query(Portfolio).filter(
+        Portfolio.user_id == user_id, Portfolio.security_id.in_(security_ids)
+    ).order_by(Portfolio.id).with_for_update().populate_existing()
+
+
+def lock_portfolio(security_id: int, user_id: int, session: Session) -> Optional[Portfolio]:
+    """Returns the user's portfolio for a security, locked until the end of the db transaction.
+
+    Args:
+        security_id (int): The security id.
+        user_id (int): The user id.
+        session (Session): The db session.
+
+    Returns:
+        Optional[Portfolio]: The locked portfolio, None if the user never held the security.
+    """
+    return lock_portfolio_query(security_id=security_id, user_id=user_id, session=session).first()
+
+
+def tradable_securities(security_ids: Set[int], session: Session) -> Set[int]:
+    """Returns the ids among `security_ids` of the securities that exist and are active.
+
+    Looked up in the security master first. The ones it does not know as tradable are read from the db, as a
+    security created or reactivated by another worker only reaches the master on its next refresh.
+
+    Args:
+        security_ids (Set[int]): The security ids.
+        session (Session): The db session.
+
+    Returns:
+        Set[int]: The ids of the tradable securities.
+    """
+    security_master = get_security_master()
+    tradable = {security_id for security_id in security_ids if security_master.is_tradable(security_id)}
+    missing = security_ids - tradable
+    if missing:
+        tradable |= {
+            security_id for security_id, in session.query(Securities.id).filter(
+                Securities.id.in_(missing),
+                Securities.is_active == True
+            )
+        }
+    return tradable
+
+
+def valid_transaction(
+    transaction_data: TradeTransaction, user_data: UserResponse, session: Session
+) -> Tuple[bool, str, Portfolio]:
     """Validates the received transaction.
 
     Args:
         transaction_data (TradeTransaction): The received transaction data.
         user_data (UserResponse): The users information.
+        session (Session): The db session.
 
     Returns:
         Tuple[bool, str, Portfolio]: A tuple of is_valid, the message and if portfolio exists then portfolio object.
     """
-    is_valid: bool = True
-    message: str = ""
-
-    session = get_db_session()
     existing_portfolio: Portfolio = session.query(Portfolio).filter(
         Portfolio.security_id == transaction_data.security_id,
         Portfolio.user_id == user_data.id
     ).first()
 
-    if existing_portfolio and transaction_data.transaction_type == "SELL":
-        # Check if we have enough quantity to sell.
-        if transaction_data.quantity > existing_portfolio.quantity:
-            is_valid = False
-            message = "NOT_ENOUGH_QUANTITY_TO_SELL"
-    if not existing_portfolio and transaction_data.transaction_type == "SELL":
-        # If we don't have any quantity.
-        is_valid = False
-        message = "NO_QUANTITY_AVAILABLE_TO_SELL"
+    is_valid, message = validate_trade(
+        held_quantity=existing_portfolio.quantity if existing_portfolio else None,
+        transaction_type=transaction_data.transaction_type, quantity=transaction_data.quantity
+    )
 
     return (is_valid, message, existing_portfolio)
 
 
-def create_transaction(
-    transaction_data: TradeTransaction, existing_portfolio: Portfolio,
-    user_id: int, session = get_db_session()
-) -> Tuple[bool, str, str]:
-    """Creates a new transaction in database.
+def execute_trade(
+    transaction_data: TradeTransaction, user_data: UserResponse, session: Session, commit: bool = True
+) -> Tuple[bool, int, str, int]:
+    """Validates and records a trade and updates the user's portfolio in a single db transaction.
+
+    The portfolio row is locked with SELECT ... FOR UPDATE, so concurrent trades on the same
+    holding are validated one after the other. A first BUY creates the portfolio with an
+    INSERT ... ON CONFLICT DO NOTHING on _portfolio_uc, so two concurrent first buys don't collide.
+    Unknown and inactive securities are rejected before touching the portfolio, see tradable_securities.
 
     Args:
-        transaction_data (TradeTransaction): The data to be added.
-        existing_portfolio (Portfolio): Any existing portfolio for the portfolio id.
-        user_id (int): The user id.
-        session (session, optional): The db session. Defaults to get_db_session().
+        transaction_data (TradeTransaction): The received transaction data.
+        user_data (UserResponse): The user data.
+        session (Session): The db session.
+        commit (bool, optional): Whether to commit or roll back, callers batching trades do it themselves.
+            Defaults to True.
 
     Returns:
-        Tuple[bool, str, str]: A tuple of is_success, the message and transaction id.
+        Tuple[bool, int, str, int]: A tuple of success, status_code, message and transaction id.
     """
-    success: bool = True
-    message: str = "TRANSACTION_SUCCESSFUL"
-    transaction_id: int = 0
-
-    transaction_data = {
-        "portfolio_id": existing_portfolio.id,
-        "transaction_type": transaction_data.transaction_type,
-        "transaction_amount": transaction_data.transaction_amount,
-        "transaction_quantity": transaction_data.quantity,
-        "is_valid_trade": True,
-        "created_on": datetime.now(),
-        "user_id": user_id
-    }
-    db_transaction: Transaction = Transaction(**transaction_data)
+    if not tradable_securities({transaction_data.security_id}, session):
+        return False, UNPROCESSABLE_ENTITY, "INVALID_SECURITY", 0
 
     try:
+        portfolio: Portfolio = lock_portfolio(transaction_data.security_id, user_data.id, session)
+        if not portfolio and transaction_data.transaction_type == "BUY":
+            now = datetime.now()
+            session.execute(
+                insert(Portfolio.__table__).values(
+                    security_id=transaction_data.security_id, user_id=user_data.id,
+                    average_buy_price=0.00, quantity=0, created_on=now, updated_on=now
+                ).on_conflict_do_nothing(constraint="_portfolio_uc")
+            )
+            portfolio = lock_portfolio(transaction_data.security_id, user_data.id, session)
+
+        is_valid, message = validate_trade(
+            held_quantity=portfolio.quantity if portfolio else None,
+            transaction_type=transaction_data.transaction_type, quantity=transaction_data.quantity
+        )
+        if not is_valid:
+            if commit:
+                # Release the row lock.
+                session.rollback()
+            return False, UNPROCESSABLE_ENTITY, message, 0
+
+        quantity, average_buy_price = compute_portfolio_position(
+            portfolio.quantity, portfolio.average_buy_price, transaction_data.transaction_type,
+            transaction_data.transaction_amount, transaction_data.quantity
+        )
+        session.query(Portfolio).filter(Portfolio.id == portfolio.id).update(
+            {
+                "quantity": quantity, "average_buy_price": average_buy_price, "version": Portfolio.version + 1,
+                "updated_on": datetime.now()
+            },
+            synchronize_session=False
+        )
+        db_transaction = Transaction(
+            portfolio_id=portfolio.id,
+            transaction_type=transaction_data.transaction_type,
+            transaction_amount=transaction_data.transaction_amount,
+            transaction_quantity=transaction_data.quantity,
+            is_valid_trade=True,
+            created_on=datetime.now(),
+            user_id=user_data.id
+        )
         session.add(db_transaction)
-        session.commit()
+        session.flush()
         transaction_id = db_transaction.id
 
+        if commit:
+            session.commit()
+    except Exception as e:
+        print("Exception Raised: ", e)
+        if commit:
+            session.rollback()
+        return False, INTERNAL_SERVER_ERROR, "TRANSACTION_FAILED", 0
+
+    return True, SUCCESS_STATUS_CODE, "TRANSACTION_SUCCESSFUL", transaction_id
+
+
+def execute_bulk_trades(
+    trades: List[TradeTransaction], user_data: UserResponse, session: Session
+) -> Tuple[bool, int, str, List[Dict]]:
+    """Validates and applies a batch of trades in a single db transaction.
+
+    The trades are grouped by security and every group's quantity and average buy price is
+    folded in memory, in the order received, with the same rules as a single trade.
+    All accepted trades are then written with chunked bulk inserts and one portfolio upsert.
+
+    Args:
+        trades (List[TradeTransaction]): The trades to apply, oldest first.
+        user_data (UserResponse): The user data.
+        session (Session): The db session.
+
+    Returns:
+        Tuple[bool, int, str, List[Dict]]: A tuple of success, status_code, message and the per trade results.
+    """
+    results = [{"index": index, "success": True, "message": "TRANSACTION_SUCCESSFUL"} for index in range(len(trades))]
+    active_ids = tradable_securities({trade.security_id for trade in trades}, session)
+
+    try:
+        # Create the missing portfolios up front so that every holding touched can be locked.
+        bought_ids = {trade.security_id for trade in trades if trade.transaction_type == "BUY"} & active_ids
+        if bought_ids:
+            now = datetime.now()
+            session.execute(
+                insert(Portfolio.__table__).values([
+                    {
+                        "security_id": security_id, "user_id": user_data.id, "average_buy_price": 0.00,
+                        "quantity": 0, "created_on": now, "updated_on": now
+                    } for security_id in sorted(bought_ids)
+                ]).on_conflict_do_nothing(constraint="_portfolio_uc")
+            )
+
+        portfolios: Dict[int, Portfolio] = {}
+        if active_ids:
+            portfolios = {
+                portfolio.security_id: portfolio for portfolio in lock_portfolios_query(
+                    user_id=user_data.id, security_ids=active_ids, session=session
+                ).all()
+            }
+
+        positions = {
+            security_id: (portfolio.quantity, portfolio.average_buy_price)
+            for security_id, portfolio in portfolios.items()
+        }
+        new_transactions = []
+        now = datetime.now()
+        for index, trade in enumerate(trades):
+            if trade.security_id not in active_ids:
+                results[index].update(success=False, message="INVALID_SECURITY")
+                continue
+
+            position = positions.get(trade.security_id)
+            is_valid, message = validate_trade(
+                held_quantity=position[0] if position else None,
+                transaction_type=trade.transaction_type, quantity=trade.quantity
+            )
+            if not is_valid:
+                results[index].update(success=False, message=message)
+                continue
+
+            positions[trade.security_id] = compute_portfolio_position(
+                position[0], position[1], trade.transaction_type, trade.transaction_amount, trade.quantity
+            )
+            new_transactions.append(
+                {
+                    "portfolio_id": portfolios[trade.security_id].id,
+                    "transaction_type": trade.transaction_type,
+                    "transaction_amount": trade.transaction_amount,
+                    "transaction_quantity": trade.quantity,
+                    "is_valid_trade": True,
+                    "created_on": now,
+                    "user_id": user_data.id
+                }
+            )
+
+        if new_transactions:
+            traded_ids = {transaction["portfolio_id"] for transaction in new_transactions}
+            upsert_portfolio_positions(
+                user_id=user_data.id, session=session, positions={
+                    security_id: position for security_id, position in positions.items()
+                    if portfolios[security_id].id in traded_ids
+                }
+            )
+            for start in range(0, len(new_transactions), BULK_INSERT_CHUNK_SIZE):
+                session.execute(
+                    Transaction.__table__.insert().values(new_transactions[start:start + BULK_INSERT_CHUNK_SIZE])
+                )
+
+        session.commit()
     except Exception as e:
-        success = False
-        message = "TRANSACTION_FAILED"
         print("Exception Raised: ", e)
         session.rollback()
+        return False, INTERNAL_SERVER_ERROR, "TRANSACTION_FAILED", []
 
-    return success, message, transaction_id
+    accepted = len(new_transactions)
+    message = "TRANSACTIONS_SUCCESSFUL" if accepted == len(trades) else f"{len(trades) - accepted}_TRANSACTIONS_REJECTED"
+    return True, SUCCESS_STATUS_CODE, message, results
 
 
 def update_transaction(
-    update_data: UpdateTrade, transaction_id: int, new_portfolio_id: int, session = get_db_session()
+    update_data: UpdateTrade, transaction_id: int, new_portfolio_id: int, session: Session,
+    created_on: Optional[datetime] = None, commit: bool = True
 ) -> Tuple[bool, str]:
     """Update the previous transaction entry with a new data.
 
@@ -102,7 +325,10 @@ def update_transaction(
         update_data (UpdateTrade): The data to be updated.
         transaction_id (int): The transaction id to be updated,
         new_portfolio_id (int): The new portfolio id to point that transaction to.
-        session ([type], optional): The db session.. Defaults to get_db_session().
+        session (Session): The db session.
+        created_on (Optional[datetime], optional): The created_on of the transaction, when known, so that only
+            its partition is read. Defaults to None.
+        commit (bool, optional): Whether to commit, else the caller owns the db transaction. Defaults to True.
 
     Returns:
         Tuple[bool, str]: A tuple of success and message.
@@ -114,6 +340,9 @@ def update_transaction(
     transaction_to_update = session.query(Transaction).filter(
         Transaction.id == transaction_id
     )
+    if created_on:
+        transaction_to_update = transaction_to_update.filter(Transaction.created_on == created_on)
+    existing_transaction: Transaction = transaction_to_update.one()
     update_data = {
         "portfolio_id": new_portfolio_id,
         "transaction_type": update_data.transaction_type,
@@ -122,11 +351,17 @@ def update_transaction(
     }
 
     try:
+        # The snapshots from this transaction onwards no longer match the ledger.
+        invalidate_portfolio_snapshots(
+            portfolio_ids=[existing_transaction.portfolio_id, new_portfolio_id],
+            created_on=existing_transaction.created_on, transaction_id=transaction_id, session=session
+        )
         # Update the transaction.
         transaction_to_update.update(
             update_data, synchronize_session="evaluate"
         )
-        session.commit()
+        if commit:
+            session.commit()
     except Exception as e:
         success = False
         message = "FAILED_TO_UPDATE_TRANSACTION"
@@ -136,77 +371,6 @@ def update_transaction(
     return success, message
 
 
-def delete_transaction(transaction_id: int, session = get_db_session()) -> Tuple[bool, str]:
-    """Delete a transaction by transaction id from a db.
-
-    Args:
-        transaction_id (int): The transaction id to be deleted.
-        session ([type], optional): The db session. Defaults to get_db_session().
-
-    Returns:
-        Tuple[bool, str]: A tuple of success and messgae.
-    """
-    success: bool = True
-    message: str = "DELETION_SUCCESSFUL"
-
-    transaction_to_delete = session.query(Transaction).filter(
-        Transaction.id == transaction_id
-    ).one()
-
-    try:
-        session.delete(transaction_to_delete)
-        session.commit()
-    except Exception as e:
-        success = False
-        message = "FAILED_TO_DELETE_TRANSACTION"
-        print("Exception Raised: ", e)
-        session.rollback()
-
-    return success, message
-
-
-def new_transaction(
-    transaction_data: TradeTransaction, existing_portfolio: Portfolio, user_data: UserResponse
-) -> Tuple[bool, str, str]:
-    """Adds a new transaction for a security and updates the user's portfolio.
-
-    Args:
-        transaction_data (TradeTransaction): The received transaction data.
-        existing_portfolio (Portfolio): The portfolio existing in db.
-        user_data (UserResponse): The user data.
-
-    Returns:
-        Tuple[bool, str, str]: A tuple of is_success, message and transaction id.
-    """
-    session = get_db_session()
-    is_success: bool = True
-    message: str = "TRANSACTION_SUCCESSFUL"
-    transaction_id: int = 0
-
-    if existing_portfolio:
-        # Add new transaction.
-        is_success, message, transaction_id = create_transaction(
-            transaction_data=transaction_data, existing_portfolio=existing_portfolio,
-            user_id=user_data.id, session=session
-        )
-        if is_success:
-            is_success, message = update_portfolio(
-                transaction_data=transaction_data, existing_portfolio=existing_portfolio, session=session
-            )
-    if not existing_portfolio:
-        # create new portfolio.
-        is_success, message, new_portfolio = create_portfolio(
-            transaction_data=transaction_data, user_data=user_data, session=session
-        )
-        if is_success:
-            is_success, message, transaction_id = create_transaction(
-                transaction_data=transaction_data, existing_portfolio=new_portfolio,
-                user_id=user_data.id, session=session
-            )
-
-    return is_success, message, transaction_id
-
-
 def get_temp_portfolio(old_transaction_data: Transaction, current_portfolio: Portfolio) -> Portfolio:
     """Creates a temporary portfolio with the rolled back data.
 
@@ -238,12 +402,9 @@ def get_temp_portfolio(old_transaction_data: Transaction, current_portfolio: Por
         else:
             raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail="TRANSACTION CANNOT BE UPDATED, CHECK QUANTITY")
     else:
-        # If had sell the add to roll back the transaction.
+        # If had sell the add to roll back the transaction, a sell never moved the average buy price.
         new_quantity = int(current_portfolio.quantity + old_transaction_data.transaction_quantity)
-        last_price = (
-        (current_portfolio.average_buy_price * current_portfolio.quantity) +\
-            (old_transaction_data.transaction_amount * old_transaction_data.transaction_quantity)
-        ) / new_quantity
+        last_price = current_portfolio.average_buy_price
 
     temp_portfolio.average_buy_price = float("{:.2f}".format(last_price))
     temp_portfolio.quantity = new_quantity
@@ -251,20 +412,59 @@ def get_temp_portfolio(old_transaction_data: Transaction, current_portfolio: Por
     return temp_portfolio
 
 
-def update_last_transaction(
-    new_transaction_data: UpdateTrade, existing_portfolio: Portfolio, user_data: UserResponse
-) -> Tuple[bool, str, str]:
-    """The main function that updates the last transaction. Might be complex to understand but lets keep it simple.
+def last_transactions_query(portfolio_id: int, session: Session, count: int = 1) -> Query:
+    """Builds the query of the latest `count` transactions of a portfolio, newest first."""
+    return session.query(Transaction).filter(
+        Transaction.portfolio_id == portfolio_id
+    ).order_by(
+        Transaction.created_on.desc(), Transaction.id.desc()
+    ).limit(count)
+
+
+def transactions_by_id_query(transaction_ids: List[int], oldest_created_on: datetime, session: Session) -> Query:
+    """Builds the query of transactions by id, all created on or after `oldest_created_on`.
+
+    The created_on bound lets postgres skip the partitions older than the oldest transaction.
+    """
+    return session.query(Transaction).filter(
+        Transaction.id.in_(transaction_ids),
+        Transaction.created_on >= oldest_created_on
+    )
+
+
+def get_last_transactions(portfolio_id: int, session: Session, count: int = 1) -> List[Transaction]:
+    """Returns the latest transactions of a portfolio, newest first.
+
+    Served by the (portfolio_id, created_on DESC, id DESC) index, so only the returned rows are read.
+
+    Args:
+        portfolio_id (int): The portfolio id.
+        session (Session): The db session.
+        count (int, optional): The number of transactions to return. Defaults to 1.
+
+    Returns:
+        List[Transaction]: The latest transactions, empty if the portfolio has none.
+    """
+    return last_transactions_query(portfolio_id=portfolio_id, session=session, count=count).all()
+
+
+def apply_last_transaction_update(
+    new_transaction_data: UpdateTrade, existing_portfolio: Portfolio, user_data: UserResponse, session: Session
+) -> Tuple[bool, str]:
+    """Rolls back the last transaction and applies the new data, without committing.
+
+    Every portfolio write is a single compare and set, PORTFOLIO_VERSION_CONFLICT means the caller has to
+    roll back and retry the whole update.
 
     Args:
         new_transaction_data (UpdateTrade): The updating data.
         existing_portfolio (Portfolio): The data of portfolio that needs to be updated with new transaction.
         user_data (UserResponse): The user data.
+        session (Session): The db session.
 
     Returns:
-        Tuple[bool, str, str]: A tuple of is_success, message and a reference id.
+        Tuple[bool, str]: A tuple of is_success and message.
     """
-    session = get_db_session()
     is_success: bool = True
     message: str = "TRANSACTION_UPDATED_SUCCESSFULLY"
 
@@ -273,32 +473,42 @@ def update_last_transaction(
         portfolio_id=new_transaction_data.updating_portfolio_id, user_id=user_data.id, session=session
     )
 
+    last_transactions: List[Transaction] = get_last_transactions(
+        portfolio_id=portfolio_to_update.id, session=session
+    ) if portfolio_to_update else []
+
     if not portfolio_to_update:
         # If no portfolio found then raise error.
         is_success = False
         message = "INVALID PORTFOLIO ID."
+    elif not last_transactions:
+        # If the portfolio has no transaction to update.
+        is_success = False
+        message = "NO TRANSACTION TO UPDATE."
     elif not existing_portfolio:
         # If portfolio to be rollbacked exists but the portfolio to update does not exist.
         # Suppose you bought 5 shares of tcs in last transaction and you need to update that transaction to BUY 2 shares of infosys
         # then portfolio_to_update will be your last tcs transaction
         # and existing_portfolio will be infosys share.
         # But in the past you have never bought infosys share so existing_portfolio will be None.
-        last_transaction: Transaction = portfolio_to_update.transactions[-1]  # Last transaction.
+        last_transaction: Transaction = last_transactions[0]  # Last transaction.
         # Create a temporary portfolio with rolled back data.
         temp_portfolio: Portfolio = get_temp_portfolio(
             old_transaction_data=last_transaction, current_portfolio=portfolio_to_update
         )
         # Rollback your transaction.
-        rollback_portfolio(updated_portfolio=temp_portfolio, session=session)
-        # Create a new portfolio.
-        is_success, message, new_portfolio = create_portfolio(
-            transaction_data=new_transaction_data, user_data=user_data, session=session
-        )
+        is_success, message = rollback_portfolio(updated_portfolio=temp_portfolio, session=session, commit=False)
+        if is_success:
+            # Create a new portfolio.
+            is_success, message, new_portfolio = create_portfolio(
+                transaction_data=new_transaction_data, user_data=user_data, session=session, commit=False
+            )
         if is_success:
             # If portfolio created then update the transaction.
             is_success, message = update_transaction(
                 update_data=new_transaction_data, transaction_id=last_transaction.id,
-                new_portfolio_id=new_portfolio.id, session=session
+                new_portfolio_id=new_portfolio.id, session=session, created_on=last_transaction.created_on,
+                commit=False
             )
     elif existing_portfolio.id:
         # If portfolio to be rollbacked and the portfolio to update exists.
@@ -306,49 +516,106 @@ def update_last_transaction(
         # and you have bought both of them in the past.
         # then portfolio_to_update will be your last tcs transaction
         # from 5 shares to 2 shares of infosys.
-        last_transaction: Transaction = portfolio_to_update.transactions[-1]  # Last transaction.
+        last_transaction: Transaction = last_transactions[0]  # Last transaction.
         # A temporary portfolio to rollback.
         temp_portfolio: Portfolio = get_temp_portfolio(
             old_transaction_data=last_transaction, current_portfolio=portfolio_to_update
         )
         # Rollback the portfolio.
-        rollback_portfolio(updated_portfolio=temp_portfolio, session=session)
-        # Update the old transaction with the new data.
-        is_success, message = update_transaction(
-            update_data=new_transaction_data, transaction_id=last_transaction.id,
-            new_portfolio_id=existing_portfolio.id, session=session
-        )
+        is_success, message = rollback_portfolio(updated_portfolio=temp_portfolio, session=session, commit=False)
+        if is_success:
+            # Update the old transaction with the new data.
+            is_success, message = update_transaction(
+                update_data=new_transaction_data, transaction_id=last_transaction.id,
+                new_portfolio_id=existing_portfolio.id, session=session, created_on=last_transaction.created_on,
+                commit=False
+            )
         if is_success and existing_portfolio.id == portfolio_to_update.id:
             # If existing and updating portfolio are same. (tcs and tcs)
             is_success, message = update_portfolio(
-                transaction_data=new_transaction_data, existing_portfolio=temp_portfolio, session=session
+                transaction_data=new_transaction_data, existing_portfolio=temp_portfolio, session=session,
+                commit=False
             )
         elif is_success and existing_portfolio.id != portfolio_to_update.id:
             # If existing and updating portfolio are different. (tcs and infy)
             is_success, message = update_portfolio(
-                transaction_data=new_transaction_data, existing_portfolio=existing_portfolio, session=session
+                transaction_data=new_transaction_data, existing_portfolio=existing_portfolio, session=session,
+                commit=False
             )
 
     return is_success, message
 
 
-def delete_last_transaction(deleting_portfolio_data: DeleteTrade, user_data: UserResponse) -> Tuple[bool, str]:
-    """The main function that performs the deletion operation on a portfolio's transaction.
+def update_last_transaction(
+    new_transaction_data: UpdateTrade, existing_portfolio: Portfolio, user_data: UserResponse, session: Session
+) -> Tuple[bool, str]:
+    """The main function that updates the last transaction. Might be complex to understand but lets keep it simple.
+
+    The rollback of the old portfolio, the transaction update and the new portfolio write are committed
+    together. If a portfolio was traded meanwhile, all of it is rolled back and retried from the latest
+    state, up to PORTFOLIO_UPDATE_RETRIES times, so a PORTFOLIO_VERSION_CONFLICT leaves nothing written.
+
+    Args:
+        new_transaction_data (UpdateTrade): The updating data.
+        existing_portfolio (Portfolio): The data of portfolio that needs to be updated with new transaction.
+        user_data (UserResponse): The user data.
+        session (Session): The db session.
+
+    Returns:
+        Tuple[bool, str]: A tuple of is_success and message.
+    """
+    for attempt in range(PORTFOLIO_UPDATE_RETRIES):
+        if attempt:
+            wait_before_retry(attempt)
+            if existing_portfolio is not None and existing_portfolio.id:
+                existing_portfolio = reload_portfolio(portfolio_id=existing_portfolio.id, session=session)
+
+        is_success, message = apply_last_transaction_update(
+            new_transaction_data=new_transaction_data, existing_portfolio=existing_portfolio,
+            user_data=user_data, session=session
+        )
+        if is_success:
+            try:
+                session.commit()
+            except Exception as e:
+                print("Exception Raised: ", e)
+                session.rollback()
+                return False, "FAILED_TO_UPDATE_TRANSACTION"
+            return is_success, message
+
+        session.rollback()
+        if message != PORTFOLIO_VERSION_CONFLICT:
+            return is_success, message
+
+    return False, PORTFOLIO_VERSION_CONFLICT
+
+
+def delete_last_transaction(
+    deleting_portfolio_data: DeleteTrade, user_data: UserResponse, session: Session
+) -> Tuple[bool, str]:
+    """The main function that performs the deletion operation on a portfolio's transactions.
+
+    Deletes the last `count` transactions of the portfolio in a single db transaction. The portfolio is set to
+    the replay of the ledger left, from its latest remaining snapshot, so it matches rebuild_portfolios.py.
 
     Args:
         deleting_portfolio_data (DeleteTrade): The data to be deleted.
         user_data (UserResponse): The user's data.
+        session (Session): The db session.
 
     Returns:
         Tuple[bool, str]: A tuple of success and message.
     """
-    session = get_db_session()
     is_success: bool = True
     message: str = "TRANSACTION_DELETED_SUCCESSFULLY"
 
+    # Lock the portfolio so that no trade lands on it while it is being rolled back.
     portfolio_to_delete: Portfolio = get_portfolio_by_id(
-        portfolio_id=deleting_portfolio_data.portfolio_id, user_id=user_data.id, session=session
+        portfolio_id=deleting_portfolio_data.portfolio_id, user_id=user_data.id, session=session, for_update=True
     )
+    last_transactions: List[Transaction] = get_last_transactions(
+        portfolio_id=portfolio_to_delete.id, session=session, count=deleting_portfolio_data.count
+    ) if portfolio_to_delete else []
 
     if not portfolio_to_delete:
         # If portfolio not found.
@@ -358,46 +625,239 @@ def delete_last_transaction(deleting_portfolio_data: DeleteTrade, user_data: Use
         # If quantity is 0 for that portfolio.
         is_success = False
         message = "NOT ENOUGH QUANTITY TO DELETE."
+    elif len(last_transactions) < deleting_portfolio_data.count:
+        # If the portfolio has fewer transactions than asked for.
+        is_success = False
+        message = "NOT ENOUGH TRANSACTIONS TO DELETE."
     else:
-        last_transaction: Transaction = portfolio_to_delete.transactions[-1]
-        # Create a temp portfolio for rolling back.
-        temp_portfolio: Portfolio = get_temp_portfolio(
-            old_transaction_data=last_transaction, current_portfolio=portfolio_to_delete
-        )
-        # Rollback the portfolio.
-        rollback_portfolio(updated_portfolio=temp_portfolio, session=session)
-        # Delete the transaction.
-        is_success, message = delete_transaction(transaction_id=last_transaction.id, session=session)
+        try:
+            # Replay the ledger left once the transactions are deleted, unwinding them one by one would
+            # compound the rounding of the average buy price.
+            quantity, average_buy_price = replay_position_before(
+                portfolio_id=portfolio_to_delete.id, created_on=last_transactions[-1].created_on,
+                transaction_id=last_transactions[-1].id, session=session
+            )
+            session.query(Portfolio).filter(Portfolio.id == portfolio_to_delete.id).update(
+                {
+                    "updated_on": datetime.now(),
+                    "quantity": quantity,
+                    "average_buy_price": average_buy_price,
+                    "version": Portfolio.version + 1
+                }, synchronize_session=False
+            )
+            # The snapshots from the oldest deleted transaction onwards no longer match the ledger.
+            invalidate_portfolio_snapshots(
+                portfolio_ids=[portfolio_to_delete.id], created_on=last_transactions[-1].created_on,
+                transaction_id=last_transactions[-1].id, session=session
+            )
+            transactions_by_id_query(
+                transaction_ids=[last_transaction.id for last_transaction in last_transactions],
+                oldest_created_on=last_transactions[-1].created_on, session=session
+            ).delete(synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            is_success = False
+            message = "FAILED_TO_DELETE_TRANSACTION"
+            print("Exception Raised: ", e)
+            session.rollback()
+
+    if not is_success:
+        # Release the lock.
+        session.rollback()
 
     return is_success, message
 
 
-def get_all_trades(user_data: UserResponse) -> Dict:
-    """Gets all the trades for the database against a user id.
+def encode_history_cursor(created_on: datetime, transaction_id: int) -> str:
+    """Encodes the position of the last returned trade into an opaque cursor.
+
+    Args:
+        created_on (datetime): The created_on of the last returned trade.
+        transaction_id (int): The id of the last returned trade.
+
+    Returns:
+        str: The cursor to be sent to the client.
+    """
+    raw_cursor = f"{created_on.isoformat()}|{transaction_id}"
+    return urlsafe_b64encode(raw_cursor.encode("utf-8")).decode("utf-8")
+
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decodes a cursor received from the client.
+
+    Args:
+        cursor (str): The cursor returned with the previous page.
+
+    Raises:
+        HTTPException: If the cursor is malformed.
+
+    Returns:
+        Tuple[datetime, int]: A tuple of created_on and id of the last returned trade.
+    """
+    try:
+        created_on, transaction_id = urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8").split("|")
+        return datetime.fromisoformat(created_on), int(transaction_id)
+    except Exception as e:
+        print("Exception Raised: ", e)
+        raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail="INVALID_CURSOR")
+
+
+def trade_history_query(
+    user_id: int, session: Session, ticker_symbol: str = "", transaction_type: str = "",
+    from_date: Optional[datetime] = None, to_date: Optional[datetime] = None
+) -> Query:
+    """Builds the query over a user's trades with the optional filters applied.
+
+    Args:
+        user_id (int): The user whose trades are queried.
+        session (Session): The db session.
+        ticker_symbol (str, optional): Only trades of this ticker. Defaults to "".
+        transaction_type (str, optional): Only BUY or SELL trades. Defaults to "".
+        from_date (Optional[datetime], optional): Only trades done on or after this time. Defaults to None.
+        to_date (Optional[datetime], optional): Only trades done on or before this time. Defaults to None.
+
+    Returns:
+        Query: The query, newest trade first.
+    """
+    query = session.query(
+        Transaction.id.label("transaction_id"),
+        Securities.ticker_symbol.label("ticker_symbol"),
+        Transaction.created_on.label("transaction_date"),
+        Transaction.transaction_type.label("transaction_type"),
+        Transaction.transaction_quantity.label("transaction_quantity"),
+        Transaction.transaction_amount.label("transaction_amount")
+    ).join(
+        Portfolio, Transaction.portfolio_id == Portfolio.id
+    ).join(
+        Securities, Portfolio.security_id == Securities.id
+    ).filter(Transaction.user_id == user_id)
+
+    if ticker_symbol:
+        query = query.filter(Securities.ticker_symbol == ticker_symbol.upper())
+    if transaction_type:
+        query = query.filter(Transaction.transaction_type == transaction_type)
+    if from_date:
+        query = query.filter(Transaction.created_on >= from_date)
+    if to_date:
+        query = query.filter(Transaction.created_on <= to_date)
+
+    return query.order_by(Transaction.created_on.desc(), Transaction.id.desc())
+
+
+def get_trade_history(
+    user_data: UserResponse, session: Session, limit: int = DEFAULT_PAGE_SIZE, cursor: str = "",
+    ticker_symbol: str = "", transaction_type: str = "",
+    from_date: Optional[datetime] = None, to_date: Optional[datetime] = None
+) -> Dict:
+    """Gets one page of the user's trades, newest first.
+
+    Pages are addressed with a keyset cursor on (created_on, id), so every page costs
+    the same no matter how deep into the history the client is.
 
     Args:
         user_data (UserResponse): The user for which trades are to be returned.
+        session (Session): The db session.
+        limit (int, optional): The page size. Defaults to DEFAULT_PAGE_SIZE.
+        cursor (str, optional): The next_cursor of the previous page. Defaults to "".
+        ticker_symbol (str, optional): Only trades of this ticker. Defaults to "".
+        transaction_type (str, optional): Only BUY or SELL trades. Defaults to "".
+        from_date (Optional[datetime], optional): Only trades done on or after this time. Defaults to None.
+        to_date (Optional[datetime], optional): Only trades done on or before this time. Defaults to None.
 
     Returns:
-        Dict: The response dict.
+        Dict: The page of trades and the cursor of the next page.
     """
-    session = get_db_session()
-    response = {}
-    portfolio_list: List[Portfolio] = session.query(Portfolio).filter(Portfolio.user_id == user_data.id).all()
-
-    for portfolio in portfolio_list:
-        ticker: str = portfolio.security_data.ticker_symbol
-        transactions_list: List[Transaction] = portfolio.transactions
-        serialised_transactions = []
-        for transaction in transactions_list:
-            serialised_transactions.append(
-                {
-                    "transaction_date": transaction.created_on,
-                    "transaction_type": transaction.transaction_type,
-                    "transaction_quantity": transaction.transaction_quantity,
-                    "transaction_amount": transaction.transaction_amount
-                }
-            )
-        response[ticker] = serialised_transactions
+    query = trade_history_query(
+        user_id=user_data.id, session=session, ticker_symbol=ticker_symbol,
+        transaction_type=transaction_type, from_date=from_date, to_date=to_date
+    )
+    if cursor:
+        last_created_on, last_transaction_id = decode_history_cursor(cursor)
+        query = query.filter(
+            tuple_(Transaction.created_on, Transaction.id) < tuple_(last_created_on, last_transaction_id),
+            # Postgres can't prune partitions on a row comparison, so bound created_on on its own too.
+            Transaction.created_on <= last_created_on
+        )
+
+    # Fetch one extra row to know if there is a next page.
+    trades = [trade._asdict() for trade in query.limit(limit + 1).all()]
+    next_cursor = None
+    if len(trades) > limit:
+        trades = trades[:limit]
+        next_cursor = encode_history_cursor(trades[-1]["transaction_date"], trades[-1]["transaction_id"])
+
+    return {"trades": trades, "next_cursor": next_cursor}
+
+
+EXPORT_COLUMNS: Tuple[str, ...] = (
+    "transaction_id", "ticker_symbol", "transaction_date",
+    "transaction_type", "transaction_quantity", "transaction_amount"
+)
+
 
-    return response
+def serialise_export_batch(trades: List[Dict], export_format: str, write_header: bool = False) -> str:
+    """Serialises a batch of trades into NDJSON lines or CSV rows.
+
+    Args:
+        trades (List[Dict]): The trades to be serialised.
+        export_format (str): Either ndjson or csv.
+        write_header (bool, optional): Whether to start the csv with the header row. Defaults to False.
+
+    Returns:
+        str: The serialised chunk.
+    """
+    if export_format == "ndjson":
+        return "".join(json.dumps(trade) + "\n" for trade in trades)
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    if write_header:
+        writer.writeheader()
+    writer.writerows(trades)
+    return buffer.getvalue()
+
+
+def stream_trade_history(
+    user_data: UserResponse, export_format: str, ticker_symbol: str = "", transaction_type: str = "",
+    from_date: Optional[datetime] = None, to_date: Optional[datetime] = None
+) -> Iterator[str]:
+    """Streams the user's whole trade ledger as NDJSON or CSV chunks.
+
+    Rows are read through a server side cursor a batch at a time, so memory stays flat
+    regardless of the size of the ledger. The cursor holds its connection for as long as
+    the client keeps reading, so it uses its own session rather than the request's.
+
+    Args:
+        user_data (UserResponse): The user whose trades are exported.
+        export_format (str): Either ndjson or csv.
+        ticker_symbol (str, optional): Only trades of this ticker. Defaults to "".
+        transaction_type (str, optional): Only BUY or SELL trades. Defaults to "".
+        from_date (Optional[datetime], optional): Only trades done on or after this time. Defaults to None.
+        to_date (Optional[datetime], optional): Only trades done on or before this time. Defaults to None.
+
+    Yields:
+        Iterator[str]: The serialised chunks of at most EXPORT_BATCH_SIZE trades.
+    """
+    session = get_db_session()
+    try:
+        query = trade_history_query(
+            user_id=user_data.id, session=session, ticker_symbol=ticker_symbol,
+            transaction_type=transaction_type, from_date=from_date, to_date=to_date
+        ).execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+        batch = []
+        write_header = export_format == "csv"
+        for trade in query:
+            trade = trade._asdict()
+            if trade["transaction_date"]:
+                trade["transaction_date"] = trade["transaction_date"].isoformat()
+            batch.append(trade)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                yield serialise_export_batch(batch, export_format, write_header)
+                batch = []
+                write_header = False
+
+        if batch or write_header:
+            yield serialise_export_batch(batch, export_format, write_header)
+    finally:
+        session.close()
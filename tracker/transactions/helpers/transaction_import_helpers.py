@@ -0,0 +1,271 @@
+"""Helpers that import a broker contract note into a user's ledger with set based SQL."""
+from datetime import datetime
+from typing import IO, Dict, List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from tracker.portfolio.helpers.portfolio_db_helpers import compute_portfolio_position, upsert_portfolio_positions
+from tracker.transactions.helpers.transaction_db_helpers import validate_trade
+from utils.constants import (
+    EXPORT_BATCH_SIZE, INTERNAL_SERVER_ERROR, MAX_IMPORT_REJECTIONS_REPORTED, SUCCESS_STATUS_CODE, UNPROCESSABLE_ENTITY
+)
+
+
+# The columns of the contract note csv, in order. traded_on may be left empty to use the import time.
+IMPORT_COLUMNS: Tuple[str, ...] = ("ticker_symbol", "transaction_type", "transaction_amount", "quantity", "traded_on")
+
+CREATE_STAGING_TABLE = """
+    CREATE TEMP TABLE trade_import_staging (
+        row_number bigserial,
+        ticker_symbol text,
+        transaction_type text,
+        transaction_amount text,
+        quantity text,
+        traded_on text,
+        security_id integer,
+        amount double precision,
+        traded_quantity integer,
+        created_on timestamp,
+        rejection_reason text
+    ) ON COMMIT DROP
+"""
+
+CREATE_TRY_TIMESTAMP = """
+    CREATE OR REPLACE FUNCTION pg_temp.try_timestamp(value text) RETURNS timestamp AS $$
+    BEGIN
+        RETURN value::timestamp;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+COPY_INTO_STAGING = f"""
+    COPY trade_import_staging ({", ".join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv, HEADER true)
+"""
+
+RESOLVE_SECURITIES = """
+    UPDATE trade_import_staging AS staging
+    SET security_id = securities.id
+    FROM securities
+    WHERE securities.ticker_symbol = upper(trim(staging.ticker_symbol))
+    AND securities.is_active = true
+"""
+
+REJECT_INVALID_ROWS = r"""
+    UPDATE trade_import_staging
+    SET rejection_reason = CASE
+        WHEN security_id IS NULL THEN 'UNKNOWN_TICKER'
+        WHEN transaction_type IS NULL THEN 'INVALID_TRANSACTION_TYPE'
+        WHEN upper(trim(transaction_type)) NOT IN ('BUY', 'SELL') THEN 'INVALID_TRANSACTION_TYPE'
+        WHEN transaction_amount IS NULL THEN 'INVALID_TRANSACTION_AMOUNT'
+        WHEN trim(transaction_amount) !~ '^[0-9]+(\.[0-9]+)?$' THEN 'INVALID_TRANSACTION_AMOUNT'
+        WHEN trim(transaction_amount)::numeric <= 0 THEN 'INVALID_TRANSACTION_AMOUNT'
+        WHEN quantity IS NULL THEN 'INVALID_QUANTITY'
+        WHEN trim(quantity) !~ '^[0-9]{1,9}$' THEN 'INVALID_QUANTITY'
+        WHEN trim(quantity)::integer <= 0 THEN 'INVALID_QUANTITY'
+        WHEN nullif(trim(traded_on), '') IS NOT NULL AND pg_temp.try_timestamp(trim(traded_on)) IS NULL
+            THEN 'INVALID_TRADED_ON'
+    END
+"""
+
+CAST_VALID_ROWS = """
+    UPDATE trade_import_staging
+    SET transaction_type = upper(trim(transaction_type)),
+        amount = trim(transaction_amount)::double precision,
+        traded_quantity = trim(quantity)::integer,
+        created_on = coalesce(pg_temp.try_timestamp(nullif(trim(traded_on), '')), :now)
+    WHERE rejection_reason IS NULL
+"""
+
+# Trades are folded on top of the current position, so a trade dated before the latest one in the ledger
+# would be applied out of order. Those are rejected, the ledger has to be corrected trade by trade.
+REJECT_BACKDATED_ROWS = """
+    UPDATE trade_import_staging AS staging
+    SET rejection_reason = 'BEFORE_LATEST_TRADE'
+    FROM portfolios
+    CROSS JOIN LATERAL (
+        SELECT created_on
+        FROM transactions
+        WHERE transactions.portfolio_id = portfolios.id
+        ORDER BY created_on DESC, id DESC
+        LIMIT 1
+    ) AS latest
+    WHERE portfolios.user_id = :user_id
+    AND portfolios.security_id = staging.security_id
+    AND staging.rejection_reason IS NULL
+    AND staging.created_on < latest.created_on
+"""
+
+CREATE_MISSING_PORTFOLIOS = """
+    INSERT INTO portfolios (security_id, user_id, average_buy_price, quantity, created_on, updated_on)
+    SELECT DISTINCT security_id, :user_id, 0, 0, CAST(:now AS timestamp), CAST(:now AS timestamp)
+    FROM trade_import_staging
+    WHERE rejection_reason IS NULL AND transaction_type = 'BUY'
+    ON CONFLICT ON CONSTRAINT _portfolio_uc DO NOTHING
+"""
+
+LOCK_PORTFOLIOS = """
+    SELECT security_id, quantity, average_buy_price
+    FROM portfolios
+    WHERE user_id = :user_id
+    AND security_id IN (SELECT security_id FROM trade_import_staging WHERE rejection_reason IS NULL)
+    ORDER BY id
+    FOR UPDATE
+"""
+
+VALID_ROWS_IN_TRADE_ORDER = """
+    SELECT row_number, security_id, transaction_type, amount, traded_quantity
+    FROM trade_import_staging
+    WHERE rejection_reason IS NULL
+    ORDER BY security_id, created_on, row_number
+"""
+
+REJECT_ROWS = """
+    UPDATE trade_import_staging
+    SET rejection_reason = :reason
+    WHERE row_number = ANY(:row_numbers)
+"""
+
+INSERT_TRANSACTIONS = """
+    INSERT INTO transactions (
+        portfolio_id, transaction_type, transaction_amount, transaction_quantity, is_valid_trade, created_on, user_id
+    )
+    SELECT portfolios.id, CAST(staging.transaction_type AS transaction_type_enum), staging.amount,
+        staging.traded_quantity, true, staging.created_on, :user_id
+    FROM trade_import_staging AS staging
+    JOIN portfolios ON portfolios.security_id = staging.security_id AND portfolios.user_id = :user_id
+    WHERE staging.rejection_reason IS NULL
+    ORDER BY staging.created_on, staging.row_number
+"""
+
+# A trade dated at the time of the latest trade may sort before it, so the snapshots from then on are dropped.
+INVALIDATE_SNAPSHOTS = """
+    DELETE FROM portfolio_snapshots AS snapshots
+    USING (
+        SELECT portfolios.id AS portfolio_id, min(staging.created_on) AS created_on
+        FROM trade_import_staging AS staging
+        JOIN portfolios ON portfolios.security_id = staging.security_id AND portfolios.user_id = :user_id
+        WHERE staging.rejection_reason IS NULL
+        GROUP BY portfolios.id
+    ) AS imported
+    WHERE snapshots.portfolio_id = imported.portfolio_id
+    AND snapshots.transaction_created_on >= imported.created_on
+"""
+
+REJECTION_REPORT = """
+    SELECT row_number, ticker_symbol, rejection_reason, count(*) OVER () AS total_rejected
+    FROM trade_import_staging
+    WHERE rejection_reason IS NOT NULL
+    ORDER BY row_number
+    LIMIT :limit
+"""
+
+
+def fold_staged_trades(
+    session: Session, positions: Dict[int, Tuple[int, float]]
+) -> Tuple[Dict[int, Tuple[int, float]], Dict[str, List[int]]]:
+    """Folds the valid staged trades into the held positions, a security at a time.
+
+    The rows are read through a server side cursor, so only the positions are held in memory.
+
+    Args:
+        session (Session): The db session, with the staging table filled.
+        positions (Dict[int, Tuple[int, float]]): The locked quantity and average buy price keyed by security id.
+
+    Returns:
+        Tuple[Dict[int, Tuple[int, float]], Dict[str, List[int]]]: A tuple of the final positions of the traded
+        securities and the rejected row numbers keyed by rejection reason.
+    """
+    traded_positions = {}
+    rejected_rows: Dict[str, List[int]] = {}
+
+    cursor = session.connection().connection.cursor(name="trade_import_fold")
+    cursor.itersize = EXPORT_BATCH_SIZE
+    try:
+        cursor.execute(VALID_ROWS_IN_TRADE_ORDER)
+        for row_number, security_id, transaction_type, amount, traded_quantity in cursor:
+            position = traded_positions.get(security_id, positions.get(security_id))
+            is_valid, message = validate_trade(
+                held_quantity=position[0] if position else None,
+                transaction_type=transaction_type, quantity=traded_quantity
+            )
+            if not is_valid:
+                rejected_rows.setdefault(message, []).append(row_number)
+                continue
+            traded_positions[security_id] = compute_portfolio_position(
+                position[0], position[1], transaction_type, amount, traded_quantity
+            )
+    finally:
+        cursor.close()
+
+    return traded_positions, rejected_rows
+
+
+def import_trades(contract_note: IO, user_id: int, session: Session) -> Tuple[bool, int, str, Dict]:
+    """Imports a contract note csv into the user's transactions and portfolios in one db transaction.
+
+    The file is streamed into a staging table with COPY, tickers are resolved and rows are
+    validated with set based updates, and the accepted rows are inserted with one
+    INSERT ... SELECT. Only the running position of every traded security is folded in python,
+    as the average buy price is rounded after every trade. Rows with a blank column, and rows dated
+    before the latest trade of their holding, are rejected with their own reason.
+
+    Args:
+        contract_note (IO): The csv file, with a header row and the columns in IMPORT_COLUMNS.
+        user_id (int): The user whose ledger is imported.
+        session (Session): The db session.
+
+    Returns:
+        Tuple[bool, int, str, Dict]: A tuple of success, status_code, message and the import report.
+    """
+    now = datetime.now()
+    report = {"imported": 0, "rejected": 0, "rejections": []}
+
+    try:
+        session.execute(text(CREATE_STAGING_TABLE))
+        session.execute(text(CREATE_TRY_TIMESTAMP))
+        with session.connection().connection.cursor() as cursor:
+            cursor.copy_expert(COPY_INTO_STAGING, contract_note)
+    except Exception as e:
+        print("Exception Raised: ", e)
+        session.rollback()
+        return False, UNPROCESSABLE_ENTITY, "INVALID_CONTRACT_NOTE", report
+
+    try:
+        session.execute(text(RESOLVE_SECURITIES))
+        session.execute(text(REJECT_INVALID_ROWS))
+        session.execute(text(CAST_VALID_ROWS), {"now": now})
+        session.execute(text(REJECT_BACKDATED_ROWS), {"user_id": user_id})
+        session.execute(text(CREATE_MISSING_PORTFOLIOS), {"user_id": user_id, "now": now})
+        positions = {
+            security_id: (quantity, average_buy_price)
+            for security_id, quantity, average_buy_price in session.execute(
+                text(LOCK_PORTFOLIOS), {"user_id": user_id}
+            )
+        }
+
+        traded_positions, rejected_rows = fold_staged_trades(session, positions)
+        for reason, row_numbers in rejected_rows.items():
+            session.execute(text(REJECT_ROWS), {"reason": reason, "row_numbers": row_numbers})
+
+        upsert_portfolio_positions(user_id=user_id, positions=traded_positions, session=session)
+        session.execute(text(INVALIDATE_SNAPSHOTS), {"user_id": user_id})
+        report["imported"] = session.execute(text(INSERT_TRANSACTIONS), {"user_id": user_id}).rowcount
+
+        for row_number, ticker_symbol, rejection_reason, total_rejected in session.execute(
+            text(REJECTION_REPORT), {"limit": MAX_IMPORT_REJECTIONS_REPORTED}
+        ):
+            report["rejected"] = total_rejected
+            report["rejections"].append(
+                {"row_number": row_number, "ticker_symbol": ticker_symbol, "reason": rejection_reason}
+            )
+
+        session.commit()
+    except Exception as e:
+        print("Exception Raised: ", e)
+        session.rollback()
+        return False, INTERNAL_SERVER_ERROR, "IMPORT_FAILED", {"imported": 0, "rejected": 0, "rejections": []}
+
+    return True, SUCCESS_STATUS_CODE, "IMPORT_SUCCESSFUL", report
@@ -1,6 +1,9 @@
+import datetime
+from typing import List, Optional
+
 from pydantic import BaseModel, validator
 
-from utils.constants import VALID_TRANSACTIONS
+from utils.constants import MAX_ROLLBACK_TRANSACTIONS, VALID_TRANSACTIONS
 
 
 class BaseResponse(BaseModel):
@@ -36,6 +39,20 @@ class TradeTransaction(BaseModel):
         return quantity
 
 
+class BulkTradeResult(BaseModel):
+    """The outcome of a single trade of a bulk request."""
+    index: int = 0
+    success: bool = False
+    message: str = ""
+
+
+class BulkTradeResponse(BaseModel):
+    """Response for a bulk trade request."""
+    success: bool = False
+    message: str = ""
+    results: List[BulkTradeResult] = []
+
+
 class UpdateTrade(TradeTransaction):
     """Trade updating schema."""
     updating_portfolio_id: int = 0
@@ -50,9 +67,48 @@ class UpdateTrade(TradeTransaction):
 class DeleteTrade(BaseModel):
     """Trade deleting schema."""
     portfolio_id: int = 0
+    count: int = 1
 
     @validator("portfolio_id")
     def is_valid_delete_portfolio_id(cls, portfolio_id):
         if portfolio_id == 0:
             raise ValueError("Invalid portfolio id.")
         return portfolio_id
+
+    @validator("count")
+    def is_valid_count(cls, count):
+        if count < 1 or count > MAX_ROLLBACK_TRANSACTIONS:
+            raise ValueError(f"count should be between 1 and {MAX_ROLLBACK_TRANSACTIONS}.")
+        return count
+
+
+class TradeHistorySchema(BaseModel):
+    """A single trade in the trade history."""
+    transaction_id: int = 0
+    ticker_symbol: str = ""
+    transaction_date: datetime.datetime = None
+    transaction_type: str = ""
+    transaction_quantity: int = 0
+    transaction_amount: float = 0.0
+
+
+class TradeHistoryResponse(BaseModel):
+    """A page of the trade history."""
+    trades: List[TradeHistorySchema] = []
+    next_cursor: Optional[str] = None
+
+
+class ImportRejection(BaseModel):
+    """A contract note row that was not imported."""
+    row_number: int = 0
+    ticker_symbol: Optional[str] = None
+    reason: str = ""
+
+
+class ImportTradesResponse(BaseModel):
+    """The outcome of a contract note import."""
+    success: bool = False
+    message: str = ""
+    imported: int = 0
+    rejected: int = 0
+    rejections: List[ImportRejection] = []
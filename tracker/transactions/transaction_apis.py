@@ -1,9 +1,11 @@
 from fastapi import APIRouter
 
 from tracker.transactions.handlers.transaction_handler import (
-    delete_trade, get_trades, new_trade, update_trade
+    delete_trade, export_trades, get_trades, import_contract_note, new_bulk_trade, new_trade, update_trade
+)
+from tracker.transactions.schemas.transaction_schemas import (
+    BaseResponse, BulkTradeResponse, ImportTradesResponse, TradeHistoryResponse
 )
-from tracker.transactions.schemas.transaction_schemas import BaseResponse
 from utils.constants import BASE_RESPONSE_STATUS_CODES
 
 
@@ -13,11 +15,17 @@ transaction_v1_apis = APIRouter(
     responses=BASE_RESPONSE_STATUS_CODES,
 )
 
-# Returns all the trades done.
-transaction_v1_apis.add_api_route("/history", get_trades, methods=["GET"])
+# Returns the trades done, a page at a time. Takes optional filters for ticker, transaction type and date range.
+transaction_v1_apis.add_api_route("/history", get_trades, response_model=TradeHistoryResponse, methods=["GET"])
+# Streams the whole trade ledger as ndjson or csv. Takes the same filters as the history api.
+transaction_v1_apis.add_api_route("/history/export", export_trades, methods=["GET"])
 # To perform a new transaction or trade.
 transaction_v1_apis.add_api_route("/trade", new_trade, response_model=BaseResponse, methods=["POST"])
+# To perform a batch of trades at once. Returns the outcome of every trade.
+transaction_v1_apis.add_api_route("/trade/bulk", new_bulk_trade, response_model=BulkTradeResponse, methods=["POST"])
+# To import a broker contract note csv. Returns the number of imported rows and the rejected rows.
+transaction_v1_apis.add_api_route("/import", import_contract_note, response_model=ImportTradesResponse, methods=["POST"])
 # To update the last transaction.
 transaction_v1_apis.add_api_route("/update", update_trade, response_model=BaseResponse, methods=["PUT"])
-# To delete the last transaction.
+# To delete the last transaction, or the last `count` transactions, of a portfolio.
 transaction_v1_apis.add_api_route("/rollback", delete_trade, response_model=BaseResponse, methods=["DELETE"])
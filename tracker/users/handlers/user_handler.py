@@ -1,20 +1,30 @@
 """Handler file that handles all the requests received on user api's."""
+from typing import Optional
+
 from fastapi import Depends, HTTPException
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBasic, HTTPBasicCredentials, HTTPBearer
+from sqlalchemy.orm import Session
 
 from tracker.users.helpers.user_db_helper import add_new_user, existing_user
-from tracker.users.schemas.user_schemas import UserCreate, UserResponse
-from tracker.users.helpers.user_utils import authorised
-from utils.constants import UNAUTHORISED_CODE, UNPROCESSABLE_ENTITY
+from tracker.users.schemas.user_schemas import AccessTokenResponse, UserCreate, UserResponse
+from tracker.users.helpers.user_utils import (
+    authorised, credential_cache, generate_access_token, verify_access_token
+)
+from utils.constants import ACCESS_TOKEN_TTL, UNAUTHORISED_CODE, UNPROCESSABLE_ENTITY
+from utils.database_utils import get_session, run_db_call
 
 
 security = HTTPBasic()
+optional_security = HTTPBasic(auto_error=False)
+token_security = HTTPBearer(auto_error=False)
+
 
-async def create_user(user: UserCreate) -> UserResponse:
+async def create_user(user: UserCreate, session: Session = Depends(get_session)) -> UserResponse:
     """Creates a user and adds an entry to the database.
 
     Args:
         user (UserCreate): The serialised request payload.
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Raises:
         HTTPException: If user already exists.
@@ -23,12 +33,12 @@ async def create_user(user: UserCreate) -> UserResponse:
         Response: The response to be given after successful creation.
     """
     new_user = {}
-    if existing_user(user.userid):
+    if await run_db_call(existing_user, user.userid, session):
         # If user already exists in database then raise Http Exception.
         raise HTTPException(status_code=UNPROCESSABLE_ENTITY, detail="USER_ALREADY_EXISTS")
     else:
         # If new user add to database.
-        user = add_new_user(user)
+        user = await run_db_call(add_new_user, user, session)
 
     new_user = {
         "id": user.id,
@@ -39,11 +49,14 @@ async def create_user(user: UserCreate) -> UserResponse:
     return new_user
 
 
-async def authorise_user(credentials: HTTPBasicCredentials = Depends(security)) -> UserResponse:
+async def authorise_user(
+    credentials: HTTPBasicCredentials = Depends(security), session: Session = Depends(get_session)
+) -> UserResponse:
     """The following function is responsible for maintaining the users authorisation.
 
     Args:
         credentials (HTTPBasicCredentials, optional): The username and password. Defaults to Depends(security).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
 
     Raises:
         HTTPException: If user does not exist.
@@ -52,10 +65,15 @@ async def authorise_user(credentials: HTTPBasicCredentials = Depends(security))
     Returns:
         UserResponse: The response to be given if user is authorised.
     """
-    authorised_user = {}
     cur_username = credentials.username
     cur_password = credentials.password
-    user = existing_user(cur_username)
+    authorised_user = credential_cache.get(cur_username, cur_password)
+    if authorised_user:
+        # These credentials were verified recently, skip the db lookup and hashing.
+        return authorised_user
+
+    # The password hash is read from the database only, it is never put in the shared cache.
+    user = await run_db_call(existing_user, cur_username, session)
     if not user:
         # If no user is returned from the database.
         raise HTTPException(status_code=UNAUTHORISED_CODE, detail="USER_NOT_FOUND")
@@ -69,4 +87,69 @@ async def authorise_user(credentials: HTTPBasicCredentials = Depends(security))
         "userid": user.userid,
         "is_active": user.is_active
     }
+    credential_cache.put(cur_username, cur_password, authorised_user)
+    return authorised_user
+
+
+async def issue_access_token(user: UserResponse = Depends(authorise_user)) -> AccessTokenResponse:
+    """Exchanges the basic auth credentials for a short lived signed access token.
+
+    Args:
+        user (UserResponse, optional): The user data. Defaults to Depends(authorise_user).
+
+    Returns:
+        AccessTokenResponse: The bearer token and the seconds for which it is valid.
+    """
+    return {
+        "access_token": generate_access_token(user),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_TTL
+    }
+
+
+async def authorise_token(credentials: HTTPAuthorizationCredentials = Depends(token_security)) -> UserResponse:
+    """Authorises a request carrying a bearer access token, without a database round trip.
+
+    Args:
+        credentials (HTTPAuthorizationCredentials, optional): The bearer token. Defaults to Depends(token_security).
+
+    Raises:
+        HTTPException: If the token is missing, tampered with or expired.
+
+    Returns:
+        UserResponse: The user data carried by the token.
+    """
+    authorised_user = verify_access_token(credentials.credentials) if credentials else None
+    if not authorised_user:
+        raise HTTPException(
+            status_code=UNAUTHORISED_CODE, detail="INVALID_OR_EXPIRED_TOKEN", headers={"WWW-Authenticate": "Bearer"}
+        )
     return authorised_user
+
+
+async def authorise_request(
+    token: Optional[HTTPAuthorizationCredentials] = Depends(token_security),
+    credentials: Optional[HTTPBasicCredentials] = Depends(optional_security),
+    session: Session = Depends(get_session)
+) -> UserResponse:
+    """Authorises a request with either a bearer access token or basic auth credentials.
+
+    Args:
+        token (Optional[HTTPAuthorizationCredentials], optional): The bearer token. Defaults to Depends(token_security).
+        credentials (Optional[HTTPBasicCredentials], optional): The username and password.
+            Defaults to Depends(optional_security).
+        session (Session, optional): The request's db session. Defaults to Depends(get_session).
+
+    Raises:
+        HTTPException: If neither a valid token nor valid credentials are sent.
+
+    Returns:
+        UserResponse: The authorised user data.
+    """
+    if token:
+        return await authorise_token(token)
+    if credentials:
+        return await authorise_user(credentials, session)
+    raise HTTPException(
+        status_code=UNAUTHORISED_CODE, detail="NOT_AUTHENTICATED", headers={"WWW-Authenticate": "Basic, Bearer"}
+    )
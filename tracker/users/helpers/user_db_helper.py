@@ -2,19 +2,20 @@
 from datetime import datetime
 
 from fastapi import HTTPException
+from sqlalchemy.orm import Session
 
 from models.db_models import User
 from tracker.users.schemas.user_schemas import UserCreate
-from tracker.users.helpers.user_utils import hash_generate
+from tracker.users.helpers.user_utils import credential_cache, hash_generate
 from utils.constants import INTERNAL_SERVER_ERROR
-from utils.database_utils import get_db_session
 
 
-def existing_user(user_id: str) -> User:
+def existing_user(user_id: str, session: Session) -> User:
     """Fetches for the user data using the user id.
 
     Args:
         user_id (str): The user id to be searched for.
+        session (Session): The db session.
 
     Raises:
         HTTPException: If exception occues while querying on db.
@@ -22,7 +23,6 @@ def existing_user(user_id: str) -> User:
     Returns:
         User: The data of user from database.
     """
-    session = get_db_session()
     user = None
     try:
         # Query for checking user in db.
@@ -34,11 +34,12 @@ def existing_user(user_id: str) -> User:
     return user
 
 
-def add_new_user(new_user: UserCreate) -> User:
+def add_new_user(new_user: UserCreate, session: Session) -> User:
     """Adds a new user to the database.
 
     Args:
         new_user (UserCreate): The data of the new user.
+        session (Session): The db session.
 
     Raises:
         HTTPException: If exception occurs while adding user to db.
@@ -46,7 +47,6 @@ def add_new_user(new_user: UserCreate) -> User:
     Returns:
         User: The data of user added in database.
     """
-    session = get_db_session()
     user = {}
     try:
         # Adds user data to database.
@@ -61,6 +61,8 @@ def add_new_user(new_user: UserCreate) -> User:
         session.add(user)
         session.commit()
         session.refresh(user)
+        # Drop any credentials cached for this user id.
+        credential_cache.invalidate(user.userid)
 
     except Exception as e:
         print("Exception Raised: ", e)
@@ -1,9 +1,35 @@
 """Common elements to be used throught the project."""
 import hashlib
+import hmac
+import json
+import os
 import secrets
+import threading
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from utils.constants import ACCESS_TOKEN_TTL, CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL
 
 
 secret_key = "b3BlbnNzaC1rZXktdjEAAAAABG5vbmUAAAAEbm9uZQAAAAAAAAABAAAAMwAAAAtzc2gtZWQyNTUxOQAAACCQcN775SDLvNoGp+V80GxVFe5D22mEPotbfs5u7CGVGgAAAJg54EI7OeBCOwAAAAtzc2gtZWQyNTUxOQAAACCQcN775SDLvNoGp+V80GxVFe5D22mEPotbfs5u7CGVGgAAAEACNR2efACy2PGTbX3VUcdC07hIld5OIUo3ZNnvEexYcpBw3vvlIMu82gan5XzQbFUV7kPbaYQ+i1t+zm7sIZUaAAAAFXJpc2hpa2VzaHZnQGdtYWlsLmNvbQ=="  # noqa
+# Signs the access tokens. Has no default, a key committed to the repo would let anyone mint tokens.
+token_secret_key = os.environ.get("TOKEN_SECRET_KEY", "")
+
+
+def check_token_secret_key():
+    """Fails the startup if TOKEN_SECRET_KEY is not set.
+
+    Raises:
+        RuntimeError: If TOKEN_SECRET_KEY is unset or empty.
+    """
+    if not token_secret_key:
+        raise RuntimeError(
+            "TOKEN_SECRET_KEY is not set. Set it to a random secret shared by every worker, "
+            "eg: python -c 'import secrets; print(secrets.token_urlsafe(32))'"
+        )
+
 
 def hash_generate(string, secret=secret_key):
     """Used to generated hash for the input.
@@ -33,3 +59,129 @@ def authorised(
     if not (correct_username and correct_password):
         is_authorised = False
     return is_authorised
+
+
+class CredentialCache:
+    """A bounded LRU cache of credentials that were verified against the database.
+
+    Entries are keyed by a keyed digest of the username and password, so plain text
+    passwords are never held in memory, and expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def credential_key(username: str, password: str) -> str:
+        """Returns the cache key for a pair of credentials."""
+        credentials = f"{username}\x00{password}".encode("utf-8")
+        return hmac.new(secret_key.encode("utf-8"), credentials, hashlib.sha256).hexdigest()
+
+    def get(self, username: str, password: str) -> Optional[Dict]:
+        """Returns the cached user for these credentials if they were verified within the ttl.
+
+        Args:
+            username (str): The received username.
+            password (str): The received password.
+
+        Returns:
+            Optional[Dict]: The authorised user data, None on a miss.
+        """
+        key = self.credential_key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            expires_at, _, user = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(user)
+
+    def put(self, username: str, password: str, user: Dict):
+        """Caches the user for a pair of credentials that has just been verified.
+
+        Args:
+            username (str): The verified username.
+            password (str): The verified password.
+            user (Dict): The authorised user data.
+        """
+        key = self.credential_key(username, password)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, username, dict(user))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        """Drops every cached entry of a user. To be called whenever the user is created or changed.
+
+        Args:
+            username (str): The user whose entries are dropped.
+        """
+        with self._lock:
+            stale_keys = [key for key, (_, cached_username, _) in self._entries.items() if cached_username == username]
+            for key in stale_keys:
+                del self._entries[key]
+
+    def clear(self):
+        """Drops every cached entry."""
+        with self._lock:
+            self._entries.clear()
+
+
+credential_cache = CredentialCache(max_size=CREDENTIAL_CACHE_SIZE, ttl=CREDENTIAL_CACHE_TTL)
+
+
+def sign_token_body(body: str) -> str:
+    """Returns the url safe HMAC-SHA256 signature of a token body."""
+    check_token_secret_key()
+    signature = hmac.new(token_secret_key.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return urlsafe_b64encode(signature).decode("utf-8").rstrip("=")
+
+
+def generate_access_token(user: Dict, expires_in: int = ACCESS_TOKEN_TTL) -> str:
+    """Generates a signed access token that carries the authorised user's data.
+
+    Args:
+        user (Dict): The authorised user data.
+        expires_in (int, optional): Seconds for which the token is valid. Defaults to ACCESS_TOKEN_TTL.
+
+    Returns:
+        str: The token, as `<base64 json payload>.<base64 signature>`.
+    """
+    payload = {
+        "id": user["id"],
+        "name": user["name"],
+        "userid": user["userid"],
+        "is_active": user["is_active"],
+        "exp": int(time.time()) + expires_in
+    }
+    body = urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8")).decode("utf-8").rstrip("=")
+    return f"{body}.{sign_token_body(body)}"
+
+
+def verify_access_token(token: str) -> Optional[Dict]:
+    """Verifies the signature and expiry of an access token.
+
+    Args:
+        token (str): The received access token.
+
+    Returns:
+        Optional[Dict]: The user data carried by the token, None if the token is invalid or expired.
+    """
+    try:
+        body, signature = token.split(".")
+        if not secrets.compare_digest(signature, sign_token_body(body)):
+            return None
+        payload = json.loads(urlsafe_b64decode(body + "=" * (-len(body) % 4)))
+    except Exception:
+        return None
+
+    if payload.pop("exp", 0) < time.time():
+        return None
+    return payload
@@ -16,3 +16,10 @@ class UserCreate(UserBase):
 class UserResponse(UserBase):
     """Response model after user creation."""
     id: int = 0
+
+
+class AccessTokenResponse(BaseModel):
+    """Response model for a newly issued access token."""
+    access_token: str = ""
+    token_type: str = "bearer"
+    expires_in: int = 0
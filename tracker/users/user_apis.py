@@ -1,8 +1,8 @@
 """All api's related to user reside over here."""
 from fastapi import APIRouter
 
-from tracker.users.handlers.user_handler import authorise_user, create_user
-from tracker.users.schemas.user_schemas import UserResponse
+from tracker.users.handlers.user_handler import authorise_user, create_user, issue_access_token
+from tracker.users.schemas.user_schemas import AccessTokenResponse, UserResponse
 from utils.constants import BASE_RESPONSE_STATUS_CODES
 
 
@@ -16,3 +16,5 @@ user_v1_apis = APIRouter(
 user_v1_apis.add_api_route("/auth", authorise_user, response_model=UserResponse, methods=["GET"])
 # Create User Api.
 user_v1_apis.add_api_route("/create", create_user, response_model=UserResponse, methods=["POST"])
+# Exchanges basic auth credentials for a short lived bearer token.
+user_v1_apis.add_api_route("/token", issue_access_token, response_model=AccessTokenResponse, methods=["POST"])
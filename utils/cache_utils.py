@@ -0,0 +1,149 @@
+"""A read-through cache shared across workers through redis, with an in-process fallback."""
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+from utils.constants import CACHE_TTL, IN_MEMORY_CACHE_SIZE
+
+
+REDIS_DEFAULT_DSN: str = os.environ.get("REDIS_DEFAULT_DSN", "")
+
+cache_backend = None
+
+
+class InMemoryCacheBackend:
+    """A bounded LRU cache local to the process. Used when redis is not configured or reachable."""
+
+    def __init__(self, max_size: int = IN_MEMORY_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def close(self):
+        self._entries.clear()
+
+
+class RedisCacheBackend:
+    """A cache shared by every worker, backed by redis."""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.redis = None
+
+    async def connect(self):
+        import aioredis
+
+        self.redis = await aioredis.create_redis_pool(self.dsn)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.redis.get(key, encoding="utf-8")
+
+    async def set(self, key: str, value: str, ttl: int):
+        await self.redis.set(key, value, expire=ttl)
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self.redis.delete(*keys)
+
+    async def close(self):
+        self.redis.close()
+        await self.redis.wait_closed()
+
+
+async def init_cache():
+    """Connects to redis if REDIS_DEFAULT_DSN is set, otherwise falls back to the in-process cache."""
+    global cache_backend
+
+    if REDIS_DEFAULT_DSN:
+        backend = RedisCacheBackend(REDIS_DEFAULT_DSN)
+        try:
+            await backend.connect()
+            cache_backend = backend
+            return
+        except Exception as e:
+            print("Exception Raised: ", e)
+    cache_backend = InMemoryCacheBackend()
+
+
+async def close_cache():
+    global cache_backend
+
+    if cache_backend:
+        await cache_backend.close()
+        cache_backend = None
+
+
+def get_cache_backend():
+    """Returns the configured cache backend, the in-process one if init_cache has not run."""
+    global cache_backend
+
+    if not cache_backend:
+        cache_backend = InMemoryCacheBackend()
+    return cache_backend
+
+
+async def read_through(key: str, loader: Callable[[], Awaitable[Any]], ttl: int = CACHE_TTL) -> Any:
+    """Returns the cached value of a key, loading and caching it on a miss.
+
+    A failing cache never fails the request, the loader is used instead.
+    Empty results are not cached.
+
+    Args:
+        key (str): The cache key.
+        loader (Callable[[], Awaitable[Any]]): Loads the value from the database.
+        ttl (int, optional): Seconds for which the value is cached. Defaults to CACHE_TTL.
+
+    Returns:
+        Any: The json compatible value.
+    """
+    backend = get_cache_backend()
+    try:
+        cached_value = await backend.get(key)
+        if cached_value is not None:
+            return json.loads(cached_value)
+    except Exception as e:
+        print("Exception Raised: ", e)
+
+    value = jsonable_encoder(await loader())
+    if value:
+        try:
+            await backend.set(key, json.dumps(value), ttl)
+        except Exception as e:
+            print("Exception Raised: ", e)
+    return value
+
+
+async def invalidate(*keys: str):
+    """Drops the keys from the cache. To be called after the underlying rows are written.
+
+    Args:
+        *keys (str): The cache keys to drop.
+    """
+    try:
+        await get_cache_backend().delete(*keys)
+    except Exception as e:
+        print("Exception Raised: ", e)
@@ -1,10 +1,14 @@
+from datetime import timedelta
 from typing import Dict
 
 
 SUCCESS_STATUS_CODE: int = 200
+NOT_MODIFIED_STATUS_CODE: int = 304
 INTERNAL_SERVER_ERROR: int = 500
 UNPROCESSABLE_ENTITY: int = 422
 UNAUTHORISED_CODE: int = 401
+CONFLICT_STATUS_CODE: int = 409
+SERVICE_UNAVAILABLE: int = 503
 
 BASE_RESPONSE_STATUS_CODES: Dict = {
     401: {"description": "UNAUTHORISED"},
@@ -13,3 +17,67 @@ BASE_RESPONSE_STATUS_CODES: Dict = {
 }
 
 VALID_TRANSACTIONS = ("BUY", "SELL")
+
+DEFAULT_PAGE_SIZE: int = 100
+MAX_PAGE_SIZE: int = 1000
+SECURITY_SEARCH_PAGE_SIZE: int = 20
+
+EXPORT_BATCH_SIZE: int = 1000
+EXPORT_MEDIA_TYPES: Dict = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+# Verified credentials are trusted for this many seconds before hitting the database again.
+CREDENTIAL_CACHE_TTL: int = 300
+CREDENTIAL_CACHE_SIZE: int = 10000
+
+# Access tokens are valid for this many seconds.
+ACCESS_TOKEN_TTL: int = 900
+
+# Read-through cache settings and keys.
+CACHE_TTL: int = 300
+IN_MEMORY_CACHE_SIZE: int = 10000
+# Holdings are cached per user and version stamp, a write moves the stamp instead of invalidating the entry.
+PORTFOLIO_CACHE_KEY: str = "portfolio:{}:{}"
+
+# Bulk trade ingestion limits.
+MAX_BULK_TRADES: int = 50000
+BULK_INSERT_CHUNK_SIZE: int = 1000
+
+# Contract note import limits.
+MAX_IMPORT_REJECTIONS_REPORTED: int = 1000
+
+# The most trades that can be rolled back in one call.
+MAX_ROLLBACK_TRANSACTIONS: int = 100
+
+# Transactions replayed between two portfolio snapshots.
+SNAPSHOT_INTERVAL: int = 1000
+
+# Group commit writer limits, used when GROUP_COMMIT_ENABLED is set.
+GROUP_COMMIT_MAX_BATCH_SIZE: int = 100
+GROUP_COMMIT_MAX_WAIT_MS: int = 5
+
+# Optimistic portfolio updates, retried with an exponential backoff when the portfolio was written meanwhile.
+PORTFOLIO_UPDATE_RETRIES: int = 5
+PORTFOLIO_RETRY_BACKOFF_MS: int = 10
+PORTFOLIO_VERSION_CONFLICT: str = "PORTFOLIO_VERSION_CONFLICT"
+
+# Months of transactions partitions kept ahead of the current one.
+TRANSACTION_PARTITION_MONTHS_AHEAD: int = 3
+
+# Interval at which the coalesced price ticks are written to the securities table.
+PRICE_TICK_FLUSH_INTERVAL_MS: int = 200
+
+# Seconds between two refreshes of the security master, and how far back every refresh re-reads.
+SECURITY_MASTER_REFRESH_INTERVAL: int = 1
+SECURITY_MASTER_REFRESH_OVERLAP: timedelta = timedelta(seconds=5)
+
+# Channels notified by the db triggers that drive the returns stream, and the seconds between two heartbeats.
+PRICE_CHANGES_CHANNEL: str = "security_price_changes"
+PORTFOLIO_CHANGES_CHANNEL: str = "portfolio_changes"
+RETURNS_STREAM_HEARTBEAT_INTERVAL: int = 15
+
+# Seconds before the valuation index reconnects its listening connection, doubled on every failure up to the max.
+VALUATION_INDEX_RECONNECT_BACKOFF: int = 1
+VALUATION_INDEX_MAX_RECONNECT_BACKOFF: int = 60
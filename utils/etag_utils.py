@@ -0,0 +1,34 @@
+"""Conditional GET helpers, ETags are derived from a cheap version stamp of the data instead of the payload."""
+import hashlib
+from typing import Any, Dict
+
+from fastapi import Request, Response
+
+from utils.constants import NOT_MODIFIED_STATUS_CODE
+
+
+def make_etag(*version_parts: Any) -> str:
+    """Returns a strong ETag for the version stamp made of `version_parts`, eg: a count and a max(updated_on)."""
+    stamp = "|".join(str(part) for part in version_parts)
+    return '"{}"'.format(hashlib.sha1(stamp.encode()).hexdigest())
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the If-None-Match header of the request lists `etag`, weak ETags and * included."""
+    if_none_match = request.headers.get("if-none-match", "")
+    if not if_none_match:
+        return False
+
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    # If-None-Match compares weakly, W/"x" matches "x".
+    candidates = [candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates]
+    return "*" in candidates or etag in candidates
+
+
+def etag_headers(etag: str) -> Dict[str, str]:
+    # Clients may keep the payload, but have to revalidate it on every request.
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=NOT_MODIFIED_STATUS_CODE, headers=etag_headers(etag))